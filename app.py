@@ -6,13 +6,20 @@ from flask_jwt_extended import JWTManager
 from werkzeug import run_simple
 from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
-from blocklist import BLOCKLIST
+from blocklist import is_revoked
+from commands import strava_cli
 from logger import logger
+from metrics import init_app as init_metrics
 from resources.user import UserRegister, User, UserLogin, UserLogout, TokenRefresh
 from resources.strava_auth import StravaAuth
 from resources.subject import Subject, SubjectList
 from resources.webhooks import Webhook
 from resources.activity import SubjectActivities, ActivitiesById, ActivityStreamData
+from resources.activity_summary import ActivitySummary, SubjectActivitySummaries
+from resources.job import Job, SubjectJobs
+from resources.training_load import TrainingLoad, SubjectTrainingLoad
+from resources.metrics import Metrics
+from resources.export import StudyExportArchive, SubjectExportArchive
 
 from db import db
 
@@ -28,6 +35,8 @@ backend.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 backend.config['PROPAGATE_EXCEPTIONS'] = True
 backend.secret_key = 'YOUR_SECRET_KEY'
 api = Api(backend)
+init_metrics(backend)
+backend.cli.add_command(strava_cli)
 
 jwt = JWTManager(backend)
 
@@ -38,7 +47,7 @@ app = DispatcherMiddleware(frontend, {
 
 @jwt.token_in_blocklist_loader
 def check_if_token_in_blocklist(jwt_header, jwt_payload):
-    return jwt_payload['jti'] in BLOCKLIST
+    return is_revoked(jwt_payload['jti'], jwt_payload['exp'])
 
 
 @jwt.expired_token_loader
@@ -95,6 +104,19 @@ api.add_resource(SubjectActivities, '/subject/<string:subject_id>/activities')
 api.add_resource(ActivitiesById, '/activities/<int:strava_activity_id>')
 
 api.add_resource(ActivityStreamData, '/activities/<int:strava_activity_id>/stream')
+api.add_resource(ActivitySummary, '/activities/<int:strava_activity_id>/summary')
+api.add_resource(SubjectActivitySummaries, '/subject/<string:subject_id>/summaries')
+
+api.add_resource(TrainingLoad, '/training_load')
+api.add_resource(SubjectTrainingLoad, '/subject/<string:subject_id>/training_load')
+
+api.add_resource(Job, '/jobs/<int:job_id>')
+api.add_resource(SubjectJobs, '/subject/<string:subject_id>/jobs')
+
+api.add_resource(StudyExportArchive, '/export')
+api.add_resource(SubjectExportArchive, '/subject/<string:subject_id>/export')
+
+api.add_resource(Metrics, '/metrics')
 
 
 @frontend.route("/")
@@ -0,0 +1,229 @@
+import asyncio
+import json
+import os
+import tempfile
+import time
+from collections import defaultdict
+from datetime import timezone
+
+import aiohttp
+from flask import current_app
+
+from constants import STRAVA_API_URL, STRAVA_CONNECT_TIMEOUT, STRAVA_READ_TIMEOUT, STRAVA_MAX_RETRIES, STUDY_END
+from db import db
+from logger import logger
+from metrics import observe_strava_request
+from models.activity import ActivityModel, STREAM_REQUEST_PARAMS, parse_strava_date
+from models.subject import SubjectModel, parse_activity_page
+from response_cache import invalidate
+from strava_client import RETRY_STATUS_CODES, StravaClient
+from token_provider import cached_access_token, refresh_access_token
+
+# Study wide backfill (`flask strava backfill`): the activity lists and missing streams of many subjects at once,
+# with all Strava requests of all subjects sharing one concurrency limit. The requests run on an asyncio event
+# loop, the db is only used from the loop's thread, between awaits: every page of activities is upserted as it
+# arrives (ActivityModel.bulk_ingest), streams are committed in batches of `stream_batch`. Encoding and writing
+# the stream files runs in threads (ActivityModel.write_stream_files), not on the loop.
+# Progress is checkpointed to a json file after every page and stream batch, so a new run resumes where an
+# interrupted one stopped.
+
+PER_PAGE = 200
+
+
+class BackfillCheckpoint:
+    # {"full_resync": bool, "subjects": {subject_id: {"after": ..., "page": last page ingested,
+    #                                                 "listed": bool, "latest_start": ..., "done": bool}}}
+    def __init__(self, path: str, full_resync: bool):
+        self.path = path
+        self.data = {'full_resync': full_resync, 'subjects': dict()}
+
+    def load(self) -> bool:
+        # True if a checkpoint of an interrupted backfill with the same options was found
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        if data.get('full_resync') != self.data['full_resync']:
+            raise ValueError(f'{self.path} is the checkpoint of a backfill with other options, '
+                             f'resume it with the same options or pass --restart')
+        self.data = data
+        return True
+
+    def subject(self, subject_id: str) -> dict:
+        return self.data['subjects'].setdefault(subject_id, {'page': 0, 'listed': False, 'done': False})
+
+    def save(self):
+        # written to a temporary file of its own first, an interruption while saving keeps the previous checkpoint
+        # and two backfills saving at the same time never write to the same file
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(self.path)),
+                                         prefix=f'{os.path.basename(self.path)}.', suffix='.tmp',
+                                         delete=False) as f:
+            try:
+                json.dump(self.data, f)
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+        os.replace(f.name, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Backfill:
+    def __init__(self, checkpoint: BackfillCheckpoint, concurrency: int, stream_batch: int,
+                 full_resync: bool = True, streams: bool = True, echo=print):
+        self.checkpoint = checkpoint
+        self.concurrency = concurrency
+        self.stream_batch = stream_batch
+        self.full_resync = full_resync
+        self.streams = streams
+        self.echo = echo
+        self.counts = {'subjects': 0, 'subjects_failed': 0, 'activities_found': 0, 'inserted': 0,
+                       'streams_downloaded': 0, 'streams_failed': 0}
+
+    def run(self, subjects: list) -> dict:
+        asyncio.run(self._run(subjects))
+        return self.counts
+
+    async def _run(self, subjects: list):
+        self.app = current_app._get_current_object()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        self.token_locks = defaultdict(asyncio.Lock)
+        timeout = aiohttp.ClientTimeout(sock_connect=STRAVA_CONNECT_TIMEOUT, sock_read=STRAVA_READ_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as self.session:
+            await asyncio.gather(*(self._backfill_subject(subject) for subject in subjects))
+
+    async def _backfill_subject(self, subject: SubjectModel):
+        state = self.checkpoint.subject(subject.subject_id)
+        if state['done']:
+            return
+        try:
+            if not state['listed']:
+                await self._list_activities(subject, state)
+            if self.streams:
+                await self._download_streams(subject, state)
+        except Exception as err:
+            # the other subjects go on, this one is continued by the next run
+            logger.exception(err)
+            db.session.rollback()
+            self.counts['subjects_failed'] += 1
+            self.echo(f'Subject {subject.subject_id} failed: {err}')
+            return
+        state['done'] = True
+        self.checkpoint.save()
+        self.counts['subjects'] += 1
+        self.echo(f'Subject {subject.subject_id} done')
+
+    async def _list_activities(self, subject: SubjectModel, state: dict):
+        if 'after' not in state:
+            state['after'] = subject.sync_window_start(full_resync=self.full_resync)
+        page = state['page'] + 1
+        while True:
+            params = {'after': state['after'], 'before': STUDY_END, 'per_page': PER_PAGE, 'page': page}
+            status, activities = await self._get(subject, '/athlete/activities', params)
+            if status != 200:
+                raise RuntimeError(f'Activities request for subject {subject.subject_id} returned {status}')
+            if not activities:
+                break
+            records = parse_activity_page(activities)
+            counts = ActivityModel.bulk_ingest(records, subject)
+            self.counts['activities_found'] += len(records)
+            self.counts['inserted'] += counts['inserted']
+            if records:
+                latest_start = int(max(parse_strava_date(record.start_date) for record in records)
+                                   .replace(tzinfo=timezone.utc).timestamp())
+                state['latest_start'] = max(state.get('latest_start') or 0, latest_start)
+            state['page'] = page
+            self.checkpoint.save()
+            page += 1
+        # the window reaches back to the study start (or the cursor), so the cursor may move on
+        subject.advance_sync_cursor(state.get('latest_start'))
+        state['listed'] = True
+        self.checkpoint.save()
+
+    async def _download_streams(self, subject: SubjectModel, state: dict):
+        # the activities still without streams, so a resumed backfill continues with the ones not stored yet
+        pending = ActivityModel.find_without_stream(subject_id=subject.subject_id)
+        for start in range(0, len(pending), self.stream_batch):
+            batch = pending[start:start + self.stream_batch]
+            stream_sets = await asyncio.gather(*(self._get(subject, f'/activities/{activity.strava_activity_id}'
+                                                                     f'/streams', STREAM_REQUEST_PARAMS)
+                                                 for activity in batch))
+            # e.g. manually added activities have no streams
+            downloaded = [(activity, stream_set) for activity, (status, stream_set) in zip(batch, stream_sets)
+                          if status == 200]
+            self.counts['streams_failed'] += len(batch) - len(downloaded)
+            # encoded and written to disk in threads, the event loop goes on with the other requests meanwhile
+            loop = asyncio.get_running_loop()
+            written = await asyncio.gather(*(loop.run_in_executor(None, ActivityModel.write_stream_files,
+                                                                  activity.strava_activity_id, stream_set,
+                                                                  activity.stream_file_path, activity.stream_sha256)
+                                             for activity, stream_set in downloaded))
+            # recorded and committed without an await in between, no other subject's changes interleave
+            for (activity, _), files in zip(downloaded, written):
+                activity.store_written_streams(*files, commit=False)
+                self.counts['streams_downloaded'] += 1
+            invalidate(subject.subject_id)
+            db.session.commit()
+            state['streams'] = state.get('streams', 0) + len(batch)
+            self.checkpoint.save()
+
+    async def _get(self, subject: SubjectModel, path: str, params: dict) -> tuple:
+        # (status, json body) of a Strava API request, retried like StravaClient.request. An expired token
+        # (401) is refreshed once.
+        url = f'{STRAVA_API_URL.rstrip("/")}{path}'
+        params = {key: str(value) for key, value in params.items()}
+        access_token = await self._access_token(subject)
+        attempt = 0
+        refreshed = False
+        while True:
+            async with self.semaphore:
+                start = time.perf_counter()
+                try:
+                    async with self.session.get(url, params=params,
+                                                headers={'Authorization': f'Bearer {access_token}'}) as response:
+                        status = response.status
+                        body = await response.json() if status == 200 else None
+                        headers = response.headers
+                except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+                    observe_strava_request(url, 'error', time.perf_counter() - start)
+                    if attempt >= STRAVA_MAX_RETRIES:
+                        raise
+                    reason = type(err).__name__
+                    delay = StravaClient.backoff(attempt)
+                else:
+                    observe_strava_request(url, status, time.perf_counter() - start, headers)
+                    if status == 401 and not refreshed:
+                        access_token = await self._access_token(subject, rejected_token=access_token)
+                        refreshed = True
+                        continue
+                    if status not in RETRY_STATUS_CODES or attempt >= STRAVA_MAX_RETRIES:
+                        return status, body
+                    reason = f'status {status}'
+                    delay = StravaClient.backoff(attempt, headers.get('Retry-After'))
+            # waiting for the retry does not hold a slot of the concurrency limit
+            logger.warning(f'Strava GET {url} failed ({reason}), retry {attempt + 1}/{STRAVA_MAX_RETRIES} '
+                           f'in {delay:.1f}s')
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _access_token(self, subject: SubjectModel, rejected_token: str = None) -> str:
+        # A valid access token of the subject. The many requests of a subject share one refresh: they wait for a
+        # lock per subject, and the first one refreshes the token in a thread, so the event loop is not blocked
+        # by the Strava and db round trips meanwhile. The others then find the new token.
+        access_token = cached_access_token(subject)
+        if access_token is not None and access_token != rejected_token:
+            return access_token
+        async with self.token_locks[subject.subject_id]:
+            access_token = cached_access_token(subject)
+            if access_token is not None and access_token != rejected_token:
+                return access_token
+            return await asyncio.get_running_loop().run_in_executor(None, self._refresh, subject.id, rejected_token)
+
+    def _refresh(self, subject_pk: int, rejected_token: str) -> str:
+        # runs in an executor thread, with an app context (and db session) of its own
+        with self.app.app_context():
+            return refresh_access_token(SubjectModel.query.get(subject_pk), rejected_token=rejected_token)
@@ -0,0 +1,212 @@
+# End-to-end benchmark of the app against the offline Strava stand-in (benchmarks/fake_strava.py):
+# - full sync throughput: sync jobs of all subjects as run by the worker, including the stream downloads
+# - webhook latency: acknowledgement of a delivered event, and time until the worker has applied it
+# - stream endpoint response time, json and binary format
+# - peak RSS of the app process (the fake runs in a subprocess and is not included)
+# The results are compared with the committed baseline (benchmarks/baseline.json, replaced with --save-baseline),
+# the exit code is 1 if a metric regressed by more than the tolerance or there is no baseline.
+#
+# Run from the repository root: python -m benchmarks.e2e_sync [--athletes 2 --activities 1000 --latency 0.02]
+import argparse
+import json
+import logging
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+# metric -> True if higher is better
+METRICS = {
+    'sync_activities_per_s': True,
+    'sync_seconds': False,
+    'webhook_ack_p95_ms': False,
+    'webhook_apply_p95_ms': False,
+    'stream_json_p95_ms': False,
+    'stream_binary_p95_ms': False,
+    'peak_rss_mb': False,
+}
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))] if values else 0.0
+
+
+def start_fake(args) -> tuple:
+    port = free_port()
+    fake = subprocess.Popen([sys.executable, '-m', 'benchmarks.fake_strava', '--port', str(port),
+                             '--athletes', str(args.athletes), '--activities', str(args.activities),
+                             '--latency', str(args.latency), '--rate-limit', str(args.rate_limit)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f'http://127.0.0.1:{port}'
+    for _ in range(100):
+        try:
+            requests.post(f'{url}/oauth/token', timeout=1)
+            return fake, url
+        except requests.ConnectionError:
+            time.sleep(0.1)
+    fake.kill()
+    raise RuntimeError('Fake Strava did not start')
+
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix='strava_bench_')
+    fake, fake_url = start_fake(args)
+    # the app reads its configuration at import time
+    os.environ['STRAVA_API_URL'] = f'{fake_url}/api/v3'
+    os.environ['STRAVA_OAUTH_URL'] = f'{fake_url}/oauth/token'
+    os.environ['STREAM_DIR'] = os.path.join(workdir, 'streams')
+    os.environ['DATABASE_URL'] = args.database_url or f'sqlite:///{os.path.join(workdir, "bench.db")}'
+    os.makedirs(os.environ['STREAM_DIR'])
+    from constants import LOG_DIR
+    os.makedirs(LOG_DIR, exist_ok=True)
+
+    from flask_jwt_extended import create_access_token
+    from werkzeug.serving import make_server
+    from app import app, backend
+    from db import db
+    from models.activity import ActivityModel
+    from models.job import JobModel
+    from models.subject import SubjectModel
+    from tasks import SYNC_ACTIVITIES, run_job
+    from webhook_processor import process_webhook_events
+    db.init_app(backend)
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', free_port(), app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    app_url = f'http://127.0.0.1:{server.server_port}/api'
+    results = dict()
+    try:
+        with backend.app_context():
+            db.create_all()
+            headers = {'Authorization': f'Bearer {create_access_token(identity=1)}'}
+            for athlete_id in range(1, args.athletes + 1):
+                tokens = requests.post(f'{fake_url}/oauth/token',
+                                       data={'grant_type': 'authorization_code', 'code': f'code-{athlete_id}'}).json()
+                SubjectModel(subject_id=f'bench-{athlete_id}', data=tokens).save_to_db()
+            jobs = [JobModel.enqueue(SYNC_ACTIVITIES, subject_id=f'bench-{athlete_id}').id
+                    for athlete_id in range(1, args.athletes + 1)]
+
+        # full sync, one job after the other like a single worker
+        start = time.perf_counter()
+        for _ in jobs:
+            with backend.app_context():
+                run_job(JobModel.claim_next('bench'))
+        results['sync_seconds'] = time.perf_counter() - start
+        with backend.app_context():
+            failed = [job_id for job_id in jobs if JobModel.find_by_id(job_id).status != JobModel.SUCCEEDED]
+            if failed:
+                raise RuntimeError(f'Sync jobs {failed} did not succeed')
+            activities = ActivityModel.query.count()
+            stream_ids = [a.strava_activity_id for a in ActivityModel.query.filter(ActivityModel.stream_file_path != '')
+                          .order_by(ActivityModel.id).limit(args.stream_requests)]
+        results['activities_synced'] = activities
+        results['sync_activities_per_s'] = activities / results['sync_seconds']
+
+        # webhooks: Strava delivers the event, the endpoint stores it, the worker applies it
+        ack, apply = [], []
+        for i in range(args.webhooks):
+            delivery = requests.post(f'{fake_url}/fake/webhooks', json={
+                'callback_url': f'{app_url}/webhooks', 'owner_id': 1 + i % args.athletes, 'aspect_type': 'create',
+            }).json()
+            if delivery['status_code'] != 200:
+                raise RuntimeError(f'Webhook delivery answered with {delivery["status_code"]}')
+            ack.append(delivery['seconds'])
+            start = time.perf_counter()
+            with backend.app_context():
+                process_webhook_events('bench')
+            apply.append(delivery['seconds'] + time.perf_counter() - start)
+        results['webhook_ack_p95_ms'] = percentile(ack, 0.95) * 1000
+        results['webhook_apply_p95_ms'] = percentile(apply, 0.95) * 1000
+
+        # stream endpoint
+        with requests.Session() as session:
+            for stream_format in ('json', 'binary'):
+                timings = []
+                for strava_activity_id in stream_ids:
+                    start = time.perf_counter()
+                    r = session.get(f'{app_url}/activities/{strava_activity_id}/stream',
+                                    params={'format': stream_format}, headers=headers)
+                    r.raise_for_status()
+                    timings.append(time.perf_counter() - start)
+                results[f'stream_{stream_format}_p95_ms'] = percentile(timings, 0.95) * 1000
+    finally:
+        server.shutdown()
+        fake.terminate()
+        fake.wait()
+    # ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    results['config'] = {key: getattr(args, key)
+                         for key in ('athletes', 'activities', 'latency', 'webhooks', 'stream_requests')}
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    # metrics that are worse than the baseline by more than tolerance (relative)
+    regressions = []
+    for metric, higher_is_better in METRICS.items():
+        if metric not in baseline or metric not in results or not baseline[metric]:
+            continue
+        change = (results[metric] - baseline[metric]) / baseline[metric]
+        if (-change if higher_is_better else change) > tolerance:
+            regressions.append(f'{metric}: {results[metric]:.1f} vs baseline {baseline[metric]:.1f} '
+                               f'({change:+.0%})')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end sync benchmark against a fake Strava API')
+    parser.add_argument('--athletes', type=int, default=2)
+    parser.add_argument('--activities', type=int, default=1000, help='activities per athlete')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every fake Strava response')
+    parser.add_argument('--rate-limit', type=int, default=100000, help='fake Strava requests per 15 minutes')
+    parser.add_argument('--webhooks', type=int, default=20, help='webhook events to deliver')
+    parser.add_argument('--stream-requests', type=int, default=50, help='activities to request streams of')
+    parser.add_argument('--database-url', help='defaults to a temporary SQLite database')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative regression')
+    args = parser.parse_args()
+
+    results = run(args)
+    for metric in ['activities_synced'] + list(METRICS):
+        print(f'{metric:24} {results[metric]:10.1f}')
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+        print(f'Baseline written to {args.baseline}')
+        return
+    if not os.path.exists(args.baseline):
+        # a missing baseline must not pass the regression check
+        print(f'No baseline at {args.baseline}, store one with --save-baseline')
+        sys.exit(1)
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('config') != results['config']:
+        print(f'Warning: baseline was measured with {baseline.get("config")}')
+    regressions = compare(results, baseline, args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if regressions:
+        sys.exit(1)
+    print(f'No regressions against {args.baseline}')
+
+
+if __name__ == '__main__':
+    main()
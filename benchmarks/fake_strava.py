@@ -0,0 +1,269 @@
+# Offline stand-in for the parts of the Strava API used by this app: OAuth token exchange/refresh,
+# athlete activity listing, activity detail, streams and webhook event delivery (POST /fake/webhooks with
+# callback_url, owner_id, aspect_type and for updates/deletes object_id).
+# Point the app at it with STRAVA_API_URL=http://<host>:<port>/api/v3 and STRAVA_OAUTH_URL=http://<host>:<port>/oauth/token
+#
+# Run standalone with: python -m benchmarks.fake_strava --port 5005 --athletes 5 --activities 2000 --latency 0.05
+import argparse
+import itertools
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import requests
+from flask import Flask, jsonify, request
+from werkzeug.serving import make_server
+
+ACTIVITY_TYPES = ['Run', 'Run', 'Run', 'TrailRun', 'Ride', 'Walk']
+FIRST_START = datetime(2021, 10, 25, 6, 0, tzinfo=timezone.utc)
+
+
+class FakeStrava:
+    def __init__(self, athletes: int = 1, activities: int = 1000, latency: float = 0.0,
+                 rate_limit_15min: int = 600, rate_limit_daily: int = 30000, token_lifetime: int = 21600,
+                 seed: int = 0):
+        self.latency = latency
+        self.rate_limits = (rate_limit_15min, rate_limit_daily)
+        self.token_lifetime = token_lifetime
+        self.rng = np.random.default_rng(seed)
+        self._ids = itertools.count(7000000000)
+        self._token_counter = itertools.count(1)
+        self._lock = threading.Lock()
+        self.usage = [0, 0]
+        self.window_start = time.time()
+
+        # athlete id -> {'activities': {id: activity}, ...}
+        self.athletes = dict()
+        self.tokens = dict()  # access or refresh token -> athlete id
+        self.codes = dict()  # oauth code -> athlete id
+        for athlete_id in range(1, athletes + 1):
+            self.add_athlete(athlete_id, activities)
+        self.app = self.create_app()
+
+    # synthetic data
+
+    def add_athlete(self, athlete_id: int, activities: int):
+        self.athletes[athlete_id] = {'activities': dict()}
+        self.codes[f'code-{athlete_id}'] = athlete_id
+        for i in range(activities):
+            self.add_activity(athlete_id, FIRST_START + timedelta(hours=13 * i))
+
+    def add_activity(self, athlete_id: int, start: datetime = None) -> dict:
+        activity_id = next(self._ids)
+        start = start or datetime.now(timezone.utc)
+        moving_time = int(self.rng.integers(900, 7200))
+        activity_type = ACTIVITY_TYPES[activity_id % len(ACTIVITY_TYPES)]
+        activity = {
+            'id': activity_id,
+            'athlete': {'id': athlete_id, 'resource_state': 1},
+            'name': f'{activity_type} {activity_id}',
+            'distance': round(moving_time * float(self.rng.uniform(2.2, 3.8)), 1),
+            'moving_time': moving_time,
+            'elapsed_time': moving_time + int(self.rng.integers(0, 600)),
+            'total_elevation_gain': round(float(self.rng.uniform(0, 300)), 1),
+            'type': activity_type,
+            'sport_type': activity_type,
+            'start_date': start.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'start_date_local': (start + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'manual': False,
+        }
+        self.athletes[athlete_id]['activities'][activity_id] = activity
+        return activity
+
+    def streams(self, activity: dict) -> dict:
+        rng = np.random.default_rng(activity['id'])
+        n = activity['moving_time']
+        time_ = np.arange(n)
+        velocity = np.clip(activity['distance'] / n + rng.normal(0, 0.3, n).cumsum() * 0.01, 0.5, 7)
+        distance = np.cumsum(velocity)
+        altitude = 30 + np.cumsum(rng.normal(0, 0.2, n))
+        heartrate = np.clip(120 + np.cumsum(rng.normal(0, 0.5, n)) * 0.2 + time_ / n * 30, 60, 200).astype(int)
+        cadence = np.clip(rng.normal(84, 3, n), 0, 120).astype(int)
+        lat = 53.55 + np.cumsum(rng.normal(0, 1e-5, n))
+        lng = 9.99 + np.cumsum(rng.normal(0, 1e-5, n))
+
+        def stream(data):
+            return {'data': data, 'series_type': 'distance', 'original_size': n, 'resolution': 'high'}
+        return {
+            'time': stream(time_.tolist()),
+            'distance': stream(np.round(distance, 1).tolist()),
+            'velocity_smooth': stream(np.round(velocity, 3).tolist()),
+            'altitude': stream(np.round(altitude, 1).tolist()),
+            'latlng': stream(np.round(np.stack([lat, lng], axis=1), 6).tolist()),
+            'heartrate': stream(heartrate.tolist()),
+            'cadence': stream(cadence.tolist()),
+            'grade_smooth': stream(np.round(np.gradient(altitude) * 10, 1).tolist()),
+        }
+
+    def issue_tokens(self, athlete_id: int) -> dict:
+        n = next(self._token_counter)
+        access_token, refresh_token = f'access-{athlete_id}-{n}', f'refresh-{athlete_id}-{n}'
+        self.tokens[access_token] = athlete_id
+        self.tokens[refresh_token] = athlete_id
+        return {
+            'token_type': 'Bearer',
+            'access_token': access_token,
+            'refresh_token': refresh_token,
+            'expires_at': int(time.time()) + self.token_lifetime,
+            'expires_in': self.token_lifetime,
+            'athlete': {'id': athlete_id, 'sex': 'F'},
+        }
+
+    # http api
+
+    def create_app(self) -> Flask:
+        app = Flask('fake_strava')
+
+        @app.before_request
+        def simulate():
+            if request.path.startswith('/fake/'):
+                return None
+            if self.latency:
+                time.sleep(self.latency)
+            with self._lock:
+                if time.time() - self.window_start > 900:
+                    self.window_start, self.usage[0] = time.time(), 0
+                self.usage[0] += 1
+                self.usage[1] += 1
+                exceeded = self.usage[0] > self.rate_limits[0] or self.usage[1] > self.rate_limits[1]
+            if exceeded:
+                return self.rate_limited(jsonify({'message': 'Rate Limit Exceeded'})), 429
+
+        @app.after_request
+        def rate_limit_headers(response):
+            return self.rate_limited(response)
+
+        @app.route('/oauth/token', methods=['POST'])
+        def token():
+            grant_type = request.form.get('grant_type')
+            if grant_type == 'authorization_code':
+                athlete_id = self.codes.get(request.form.get('code'))
+            elif grant_type == 'refresh_token':
+                athlete_id = self.tokens.get(request.form.get('refresh_token'))
+            else:
+                athlete_id = None
+            if athlete_id is None:
+                return jsonify({'message': 'Bad Request'}), 400
+            return jsonify(self.issue_tokens(athlete_id))
+
+        @app.route('/api/v3/athlete/activities')
+        def athlete_activities():
+            athlete_id = self.authorized()
+            if athlete_id is None:
+                return jsonify({'message': 'Authorization Error'}), 401
+            after = request.args.get('after', type=int)
+            before = request.args.get('before', type=int)
+            page = request.args.get('page', 1, type=int)
+            per_page = min(request.args.get('per_page', 30, type=int), 200)
+            activities = sorted(self.athletes[athlete_id]['activities'].values(), key=lambda a: a['start_date'])
+            selected = [a for a in activities
+                        if (after is None or _epoch(a['start_date']) > after)
+                        and (before is None or _epoch(a['start_date']) < before)]
+            return jsonify(selected[(page - 1) * per_page:page * per_page])
+
+        @app.route('/api/v3/activities/<int:activity_id>')
+        def activity(activity_id):
+            found = self.find_activity(activity_id)
+            if found is None:
+                return jsonify({'message': 'Record Not Found'}), 404
+            return jsonify(found)
+
+        @app.route('/api/v3/activities/<int:activity_id>/streams')
+        def streams(activity_id):
+            found = self.find_activity(activity_id)
+            if found is None:
+                return jsonify({'message': 'Record Not Found'}), 404
+            return jsonify(self.streams(found))
+
+        @app.route('/fake/webhooks', methods=['POST'])
+        def trigger_webhook():
+            # control endpoint of the fake, not part of the Strava API
+            data = request.get_json()
+            athlete_id = data['owner_id']
+            if athlete_id not in self.athletes:
+                return jsonify({'message': f'Athlete {athlete_id} not found'}), 404
+            return jsonify(self.trigger_webhook(data['callback_url'], athlete_id, data['aspect_type'],
+                                                data.get('object_id')))
+
+        return app
+
+    def authorized(self):
+        auth = request.headers.get('Authorization', '')
+        return self.tokens.get(auth[len('Bearer '):]) if auth.startswith('Bearer ') else None
+
+    def find_activity(self, activity_id: int):
+        athlete_id = self.authorized()
+        if athlete_id is None:
+            return None
+        return self.athletes[athlete_id]['activities'].get(activity_id)
+
+    def rate_limited(self, response):
+        response.headers['X-RateLimit-Limit'] = f'{self.rate_limits[0]},{self.rate_limits[1]}'
+        response.headers['X-RateLimit-Usage'] = f'{self.usage[0]},{self.usage[1]}'
+        return response
+
+    # webhooks
+
+    @staticmethod
+    def webhook_event(athlete_id: int, activity_id: int, aspect_type: str, updates: dict = None) -> dict:
+        return {
+            'aspect_type': aspect_type,
+            'event_time': int(time.time()),
+            'object_id': activity_id,
+            'object_type': 'activity',
+            'owner_id': athlete_id,
+            'subscription_id': 1,
+            'updates': updates or {},
+        }
+
+    def trigger_webhook(self, callback_url: str, athlete_id: int, aspect_type: str, activity_id: int = None) -> dict:
+        # Change an athlete's activities the way a Strava user would and deliver the matching event
+        # to callback_url. Returns the event, the status of the delivery and how long it took.
+        activities = self.athletes[athlete_id]['activities']
+        updates = {}
+        if aspect_type == 'create':
+            activity_id = self.add_activity(athlete_id)['id']
+        elif aspect_type == 'update':
+            updates = {'title': f'Renamed {activity_id}'}
+            activities[activity_id]['name'] = updates['title']
+        elif aspect_type == 'delete':
+            activities.pop(activity_id, None)
+        event = self.webhook_event(athlete_id, activity_id, aspect_type, updates)
+        start = time.perf_counter()
+        # Strava expects the callback to answer within two seconds
+        response = requests.post(callback_url, json=event, timeout=2)
+        return {'event': event, 'status_code': response.status_code, 'seconds': time.perf_counter() - start}
+
+    # server
+
+    def serve(self, host: str = '127.0.0.1', port: int = 0):
+        # Start the fake in a background thread. Returns the server, whose base url is
+        # f'http://{host}:{server.server_port}'. Stop it with server.shutdown().
+        server = make_server(host, port, self.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def _epoch(strava_date: str) -> int:
+    return int(datetime.strptime(strava_date, '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline Strava API stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5005)
+    parser.add_argument('--athletes', type=int, default=3)
+    parser.add_argument('--activities', type=int, default=1000, help='activities per athlete')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--rate-limit', type=int, default=600, help='requests per 15 minutes')
+    args = parser.parse_args()
+    fake = FakeStrava(athletes=args.athletes, activities=args.activities, latency=args.latency,
+                      rate_limit_15min=args.rate_limit)
+    print(f'Fake Strava on http://{args.host}:{args.port}, '
+          f'oauth codes: {", ".join(sorted(fake.codes))}')
+    fake.app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
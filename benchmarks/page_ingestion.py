@@ -0,0 +1,73 @@
+# Micro-benchmark of the page parsing in SubjectModel.get_activities on a synthetic activity history.
+# Run from the repository root: python -m benchmarks.page_ingestion [n_activities]
+import random
+import sys
+import time
+
+import pandas as pd
+
+from models.subject import parse_activity_page
+
+PER_PAGE = 200
+
+
+def synthetic_pages(n_activities: int, seed: int = 0) -> list:
+    rng = random.Random(seed)
+    activities = [{
+        'id': 6000000000 + i,
+        'athlete': {'id': 12345},
+        'distance': rng.uniform(2000, 25000),
+        'moving_time': rng.randint(600, 9000),
+        'total_elevation_gain': rng.uniform(0, 400),
+        'type': 'Run' if rng.random() < 0.8 else 'Ride',
+        'start_date': f'2022-01-01T{i % 24:02d}:00:00Z',
+        'start_date_local': f'2022-01-01T{i % 24:02d}:00:00Z',
+    } for i in range(n_activities)]
+    return [activities[i:i + PER_PAGE] for i in range(0, n_activities, PER_PAGE)]
+
+
+def legacy_parse(pages: list) -> pd.DataFrame:
+    # the former cell by cell implementation
+    activities = pd.DataFrame(columns=["id", "athlete_id", "distance", "moving_time", "total_elevation_gain",
+                                       "type", "start_date", "start_date_local"])
+    for page, r in enumerate(pages, start=1):
+        for x in range(len(r)):
+            if 'run' not in str(r[x]['type']).lower():
+                continue
+            activities.loc[x + (page - 1) * 200, 'id'] = r[x]['id']
+            activities.loc[x + (page - 1) * 200, 'athlete_id'] = r[x]['athlete']['id']
+            activities.loc[x + (page - 1) * 200, 'distance'] = r[x]['distance']
+            activities.loc[x + (page - 1) * 200, 'moving_time'] = r[x]['moving_time']
+            activities.loc[x + (page - 1) * 200, 'total_elevation_gain'] = r[x]['total_elevation_gain']
+            activities.loc[x + (page - 1) * 200, 'type'] = r[x]['type']
+            activities.loc[x + (page - 1) * 200, 'start_date'] = r[x]['start_date']
+            activities.loc[x + (page - 1) * 200, 'start_date_local'] = r[x]['start_date_local']
+    return activities
+
+
+def batched_parse(pages: list) -> list:
+    return [record for r in pages for record in parse_activity_page(r)]
+
+
+def timed(func, pages, repeat: int = 1) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(pages)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main(n_activities: int = 5000):
+    pages = synthetic_pages(n_activities)
+    legacy = timed(legacy_parse, pages)
+    batched = timed(batched_parse, pages, repeat=5)
+    assert len(legacy_parse(pages)) == len(batched_parse(pages))
+    print(f'{n_activities} activities in {len(pages)} pages')
+    print(f'legacy  (cell by cell .loc): {legacy * 1000:10.1f} ms')
+    print(f'batched (records per page):  {batched * 1000:10.1f} ms')
+    print(f'speedup: {legacy / batched:.0f}x')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
@@ -0,0 +1,66 @@
+# Startup cost of an app process (every uWSGI worker and the background worker pay it): time to import the app and
+# its RSS afterwards, each measured in a fresh interpreter. The "with pandas" run additionally imports pandas first,
+# which is what importing the app cost while the models used pandas DataFrames.
+#
+# Run from the repository root: python -m benchmarks.startup [--runs 5]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# executed in the child interpreter
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+if {preload_pandas}:
+    import pandas
+import app
+seconds = time.perf_counter() - start
+rss_kb = 0
+with open('/proc/self/status') as f:
+    for line in f:
+        if line.startswith('VmRSS:'):
+            rss_kb = int(line.split()[1])
+print(json.dumps({{'import_ms': seconds * 1000, 'rss_mb': rss_kb / 1024, 'pandas_loaded': 'pandas' in sys.modules}}))
+'''
+
+
+def measure(preload_pandas: bool, env: dict) -> dict:
+    output = subprocess.run([sys.executable, '-c', CHILD.format(preload_pandas=preload_pandas)],
+                            env=env, check=True, stdout=subprocess.PIPE).stdout
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='strava_startup_')
+    env = dict(os.environ, STREAM_DIR=workdir, DATABASE_URL=f'sqlite:///{os.path.join(workdir, "startup.db")}')
+    from constants import LOG_DIR
+    os.makedirs(LOG_DIR, exist_ok=True)
+
+    # the first import also compiles the bytecode, which is not part of a worker's startup
+    measure(False, env)
+    results = dict()
+    for name, preload_pandas in (('app', False), ('app with pandas', True)):
+        runs = [measure(preload_pandas, env) for _ in range(args.runs)]
+        results[name] = {
+            'import_ms': statistics.median(run['import_ms'] for run in runs),
+            'rss_mb': statistics.median(run['rss_mb'] for run in runs),
+            'pandas_loaded': runs[0]['pandas_loaded'],
+        }
+    for name, result in results.items():
+        print(f'{name:16s} import {result["import_ms"]:8.1f} ms   rss {result["rss_mb"]:6.1f} MB   '
+              f'pandas loaded: {result["pandas_loaded"]}')
+    saved_ms = results['app with pandas']['import_ms'] - results['app']['import_ms']
+    saved_mb = results['app with pandas']['rss_mb'] - results['app']['rss_mb']
+    print(f'per worker without pandas: {saved_ms:.0f} ms and {saved_mb:.1f} MB less')
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,45 @@
-BLOCKLIST = set()
\ No newline at end of file
+import threading
+import time
+
+from constants import BLOCKLIST_CACHE_TTL, BLOCKLIST_SWEEP_INTERVAL
+from models.revoked_token import RevokedTokenModel
+
+# Per-process read-through cache of the revoked_tokens table: jti -> (revoked, cached_until).
+# A revoked token stays revoked, so it is cached until it expires. A token that is not revoked is looked up
+# again after BLOCKLIST_CACHE_TTL seconds, which bounds how long a logout takes to reach the other processes.
+# Checking a token only reads; the rows of expired tokens are deleted by the worker (see worker.py) or
+# `flask strava purge-tokens`.
+_cache = dict()
+_lock = threading.Lock()
+_next_sweep = 0.0
+
+
+def revoke(jti: str, expires_at: int):
+    RevokedTokenModel.revoke(jti, expires_at)
+    with _lock:
+        _cache[jti] = (True, expires_at)
+    _sweep()
+
+
+def is_revoked(jti: str, expires_at: int) -> bool:
+    now = time.time()
+    entry = _cache.get(jti)
+    if entry is not None and entry[1] > now:
+        return entry[0]
+    revoked = RevokedTokenModel.find_by_jti(jti) is not None
+    with _lock:
+        _cache[jti] = (revoked, expires_at if revoked else min(expires_at, now + BLOCKLIST_CACHE_TTL))
+    _sweep()
+    return revoked
+
+
+def _sweep():
+    # evict cache entries of tokens that have expired anyway
+    global _next_sweep
+    now = time.time()
+    if now < _next_sweep:
+        return
+    _next_sweep = now + BLOCKLIST_SWEEP_INTERVAL
+    with _lock:
+        for jti in [jti for jti, (_, cached_until) in _cache.items() if cached_until <= now]:
+            del _cache[jti]
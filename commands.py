@@ -0,0 +1,272 @@
+import os
+
+import click
+import numpy as np
+from flask.cli import AppGroup
+
+from constants import STREAM_DOWNLOAD_POOL_SIZE, BACKFILL_CONCURRENCY, BACKFILL_STREAM_BATCH, BACKFILL_CHECKPOINT
+from db import db
+from export import StudyExport
+from logger import logger
+from migrations import upgrade
+from models.activity import ActivityModel
+from models.revoked_token import RevokedTokenModel
+from models.subject import SubjectModel
+from models.training_load import TrainingLoadModel
+from response_cache import invalidate
+import stream_codec
+from stream_downloader import StreamDownloader
+from stream_store import (NpyStreamStore, get_store, load_streams, write_streams, delete_streams, stream_hash,
+                          stream_samples, stored_size)
+from tasks import enqueue_sync
+
+# Maintenance commands, run with e.g. `FLASK_APP=run:backend flask strava migrate-streams`
+strava_cli = AppGroup('strava', help='Strava data maintenance commands.')
+
+
+@strava_cli.command('migrate-db')
+def migrate_db():
+    """Create missing tables and apply pending schema changes."""
+    applied = upgrade()
+    for description in applied:
+        click.echo(description)
+    click.echo(f'{len(applied)} migrations applied.')
+
+
+@strava_cli.command('enqueue-syncs')
+@click.option('--full-resync', is_flag=True, help='Sync the whole study period instead of only new activities.')
+def enqueue_syncs(full_resync):
+    """Queue an activity sync job for every subject, e.g. from a daily cron job."""
+    jobs = {enqueue_sync(subject, full_resync=full_resync).id for subject in SubjectModel.find_all()}
+    click.echo(f'{len(jobs)} sync jobs queued.')
+
+
+@strava_cli.command('backfill')
+@click.option('--subject', 'subject_ids', multiple=True, help='Only backfill this subject (repeatable).')
+@click.option('--incremental', is_flag=True, help='Only request activities after the sync cursors.')
+@click.option('--no-streams', is_flag=True, help='Only sync the activity lists.')
+@click.option('--concurrency', default=BACKFILL_CONCURRENCY, show_default=True,
+              help='Number of concurrent Strava requests of all subjects together.')
+@click.option('--checkpoint', 'checkpoint_path', default=BACKFILL_CHECKPOINT, show_default=True,
+              help='Progress file, an interrupted backfill is resumed from it.')
+@click.option('--restart', is_flag=True, help='Ignore the progress of an interrupted backfill.')
+def backfill(subject_ids, incremental, no_streams, concurrency, checkpoint_path, restart):
+    """Sync the activities and missing streams of all subjects concurrently."""
+    # imported here, the app (which imports the commands) does not need aiohttp
+    from backfill import Backfill, BackfillCheckpoint
+    checkpoint = BackfillCheckpoint(checkpoint_path, full_resync=not incremental)
+    if restart:
+        checkpoint.remove()
+    try:
+        if checkpoint.load():
+            click.echo(f'Resuming the backfill of {checkpoint_path}')
+    except ValueError as err:
+        raise click.ClickException(str(err))
+    subjects = SubjectModel.find_all()
+    if subject_ids:
+        subjects = [subject for subject in subjects if subject.subject_id in subject_ids]
+    click.echo(f'Backfilling {len(subjects)} subjects with {concurrency} concurrent requests')
+    counts = Backfill(checkpoint, concurrency=concurrency, stream_batch=BACKFILL_STREAM_BATCH,
+                      full_resync=not incremental, streams=not no_streams, echo=click.echo).run(subjects)
+    click.echo(', '.join(f'{value} {key}' for key, value in counts.items()))
+    if counts['subjects_failed']:
+        raise click.ClickException(f'{counts["subjects_failed"]} subjects failed, run the backfill again to resume')
+    checkpoint.remove()
+
+
+@strava_cli.command('migrate-streams')
+@click.option('--keep-old', '--keep-csv', 'keep_old', is_flag=True, help='Keep the old files after conversion.')
+@click.option('--dry-run', is_flag=True, help='Only list the files that would be converted.')
+def migrate_streams(keep_old, dry_run):
+    """Convert stream files (e.g. legacy csv files) to the configured stream store."""
+    store = get_store()
+    activities = [activity for activity in
+                  ActivityModel.query.filter(ActivityModel.stream_file_path.isnot(None),
+                                             ActivityModel.stream_file_path != '').order_by(ActivityModel.id)
+                  if os.path.exists(activity.stream_file_path) and not store.handles(activity.stream_file_path)]
+    click.echo(f'{len(activities)} stream files to convert to {store.name}')
+    converted = failed = 0
+    for activity in activities:
+        old_path = activity.stream_file_path
+        if dry_run:
+            click.echo(old_path)
+            continue
+        try:
+            columns = load_streams(old_path)
+        except (OSError, ValueError) as err:
+            logger.error(f'Could not read {old_path}: {err}')
+            failed += 1
+            continue
+        columns = {key: np.asarray(values) for key, values in columns.items()}
+        new_path = write_streams(activity.strava_activity_id, columns, store)
+        # the old file is only replaced by a new one that holds the same data
+        differing = stream_codec.mismatches(columns, load_streams(new_path))
+        if differing:
+            logger.error(f'Converted streams of {old_path} differ in {", ".join(differing)}, kept the old file')
+            if new_path != old_path:
+                delete_streams(new_path)
+            failed += 1
+            continue
+        activity.stream_file_path = new_path
+        activity.set_stream_checksum(columns)
+        invalidate(activity.subject_id)
+        db.session.commit()
+        if not keep_old and new_path != old_path:
+            delete_streams(old_path)
+        converted += 1
+    click.echo(f'Converted {converted} files, {failed} failed.')
+
+
+@strava_cli.command('download-streams')
+@click.option('--subject', 'subject_id', help='Only download streams of this subject.')
+@click.option('--pool-size', default=STREAM_DOWNLOAD_POOL_SIZE, show_default=True,
+              help='Number of concurrent Strava requests.')
+@click.option('--limit', type=int, help='Download at most this many streams.')
+def download_streams(subject_id, pool_size, limit):
+    """Download the stream data of all activities that do not have any yet."""
+    activities = ActivityModel.find_without_stream(subject_id=subject_id)
+    if limit is not None:
+        activities = activities[:limit]
+    click.echo(f'Downloading streams of {len(activities)} activities with {pool_size} concurrent requests')
+    counts = StreamDownloader(pool_size=pool_size).download(activities)
+    click.echo(f'{counts["streams_downloaded"]} downloaded, {counts["streams_failed"]} failed.')
+
+
+@strava_cli.command('build-stream-levels')
+@click.option('--rebuild', is_flag=True, help='Also rebuild existing levels.')
+def build_stream_levels(rebuild):
+    """Build the downsampled levels of npy stream data stored without them."""
+    store = NpyStreamStore()
+    activities = ActivityModel.query.filter(ActivityModel.stream_file_path.isnot(None),
+                                            ActivityModel.stream_file_path != '').order_by(ActivityModel.id).all()
+    built = 0
+    for activity in activities:
+        path = activity.stream_file_path
+        if not store.handles(path) or (store.levels(path) and not rebuild):
+            continue
+        store.write_levels(path, {key: np.asarray(values) for key, values in store.read(path).items()})
+        # downsampled responses change
+        invalidate(activity.subject_id)
+        db.session.commit()
+        built += 1
+    click.echo(f'Levels built for {built} activities.')
+
+
+@strava_cli.command('verify-streams')
+@click.option('--subject', 'subject_id', help='Only verify the streams of this subject.')
+@click.option('--repair', is_flag=True, help='Delete damaged stream files, so they are downloaded again.')
+def verify_streams(subject_id, repair):
+    """Check the stored stream files against the hash, size and samples recorded for them."""
+    query = ActivityModel.query.filter(ActivityModel.stream_file_path.isnot(None),
+                                       ActivityModel.stream_file_path != '')
+    if subject_id:
+        query = query.filter_by(subject_id=subject_id)
+    activities = query.order_by(ActivityModel.id).all()
+    click.echo(f'Verifying the streams of {len(activities)} activities')
+    verified = recorded = 0
+    damaged = []
+    for activity in activities:
+        path = activity.stream_file_path
+        if not os.path.exists(path):
+            damaged.append((activity, 'missing'))
+            continue
+        try:
+            columns = load_streams(path)
+        except (OSError, ValueError) as err:
+            damaged.append((activity, f'unreadable ({err})'))
+            continue
+        if activity.stream_sha256 is None:
+            # stored before hashes were recorded, taken as they are
+            activity.set_stream_checksum(columns)
+            recorded += 1
+            continue
+        differing = [name for name, stored, expected in
+                     (('hash', stream_hash(columns), activity.stream_sha256),
+                      ('size', stored_size(path), activity.stream_size),
+                      ('samples', stream_samples(columns), activity.stream_samples))
+                     if expected is not None and stored != expected]
+        if differing:
+            damaged.append((activity, f'{", ".join(differing)} differ'))
+        else:
+            verified += 1
+    for activity, problem in damaged:
+        click.echo(f'{activity.strava_activity_id}: {activity.stream_file_path} {problem}')
+        if repair:
+            # find_without_stream (download-streams, syncs, backfill) picks the activity up again
+            delete_streams(activity.stream_file_path)
+            activity.clear_stream_data()
+            invalidate(activity.subject_id)
+    db.session.commit()
+    click.echo(f'{verified} verified, {recorded} recorded, {len(damaged)} damaged'
+               f'{", cleared for download" if repair and damaged else ""}.')
+    if damaged and not repair:
+        raise click.ClickException('damaged stream files found, run with --repair to download them again')
+
+
+@strava_cli.command('summarize')
+@click.option('--subject', 'subject_id', help='Only summarize activities of this subject.')
+@click.option('--recompute', is_flag=True, help='Also recompute existing summaries.')
+def summarize(subject_id, recompute):
+    """Compute the stream summaries of activities that have streams but no summary yet."""
+    query = ActivityModel.query.filter(ActivityModel.stream_file_path.isnot(None),
+                                       ActivityModel.stream_file_path != '')
+    if subject_id:
+        query = query.filter_by(subject_id=subject_id)
+    if not recompute:
+        query = query.filter(~ActivityModel.summary.has())
+    activities = query.order_by(ActivityModel.id).all()
+    click.echo(f'Summarizing {len(activities)} activities')
+    summarized = failed = 0
+    for activity in activities:
+        try:
+            columns = load_streams(activity.stream_file_path)
+        except (OSError, ValueError) as err:
+            logger.error(f'Could not read {activity.stream_file_path}: {err}')
+            failed += 1
+            continue
+        activity.update_summary(columns)
+        summarized += 1
+        if summarized % 100 == 0:
+            db.session.commit()
+    db.session.commit()
+    click.echo(f'{summarized} summarized, {failed} failed.')
+
+
+@strava_cli.command('rebuild-training-load')
+@click.option('--subject', 'subject_id', help='Only rebuild the training load of this subject.')
+def rebuild_training_load(subject_id):
+    """Recompute the daily training load from the activities."""
+    days = TrainingLoadModel.rebuild(subject_id)
+    click.echo(f'{days} days of training load computed.')
+
+
+@strava_cli.command('purge-tokens')
+def purge_tokens():
+    """Delete the revoked JWTs that have expired (the worker also does this periodically)."""
+    click.echo(f'{RevokedTokenModel.purge_expired()} expired tokens deleted.')
+
+
+@strava_cli.command('export')
+@click.argument('output', type=click.Path(dir_okay=False))
+@click.option('--subject', 'subject_id', help='Only export this subject.')
+@click.option('--resume', is_flag=True, help='Continue an interrupted export into OUTPUT.')
+def export(output, subject_id, resume):
+    """Export activity metadata and stream files as one tar archive."""
+    if subject_id and not SubjectModel.find_by_subject_id(subject_id):
+        raise click.ClickException(f'Subject {subject_id} not found.')
+    archive = StudyExport(subject_id)
+    # the etag of a started export is kept next to it, resuming is only possible while the archive is the same
+    etag_path = f'{output}.etag'
+    start = 0
+    if resume and os.path.exists(output):
+        if not os.path.exists(etag_path) or open(etag_path).read() != archive.etag:
+            raise click.ClickException('The data has changed since the export was started, start it again.')
+        start = os.path.getsize(output)
+    with open(etag_path, 'w') as f:
+        f.write(archive.etag)
+    click.echo(f'Exporting {archive.size} bytes to {output}' + (f', resuming at {start}' if start else ''))
+    with open(output, 'ab' if start else 'wb') as f:
+        for chunk in archive.iter_bytes(start):
+            f.write(chunk)
+    os.remove(etag_path)
+    click.echo('Done.')
@@ -1,8 +1,79 @@
+from datetime import datetime
 from pathlib import Path
 import os
 
 ROOT_PATH = Path(__file__).parents[0]  # todo: remove ugly workaround
 LOG_DIR = os.path.join(ROOT_PATH, 'log')
+# logging (see logger.py)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json')  # json (one object per line) or text
+LOG_MAX_BYTES = int(os.environ.get('LOG_MAX_BYTES', 20 * 1024 * 1024))  # size at which the log file is rotated
+LOG_BACKUP_COUNT = int(os.environ.get('LOG_BACKUP_COUNT', 5))
+LOG_FIELD_MAX_LENGTH = int(os.environ.get('LOG_FIELD_MAX_LENGTH', 2000))  # longer messages and fields are truncated
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))  # records waiting to be written, more are dropped
 
 CLIENT_ID = 'YOUR_STRAVA_CLIENT_ID'
 CLIENT_SECRET = 'YOUR_STRAVA_CLIENT_SECRET'
+
+# Strava API client (see strava_client.py)
+STRAVA_API_URL = os.environ.get('STRAVA_API_URL', 'https://www.strava.com/api/v3')
+STRAVA_OAUTH_URL = os.environ.get('STRAVA_OAUTH_URL', 'https://www.strava.com/oauth/token')
+STRAVA_CONNECT_TIMEOUT = 3.05  # seconds
+STRAVA_READ_TIMEOUT = 10  # seconds
+STRAVA_MAX_RETRIES = 3
+# (connect, read) timeouts of a token refresh, which holds the subject's row lock and runs in requests (uwsgi
+# harakiri is 15 s), so it is tried only once
+STRAVA_TOKEN_REFRESH_TIMEOUT = (STRAVA_CONNECT_TIMEOUT, 5)  # seconds
+STRAVA_BACKOFF = 0.5  # seconds, maximum delay of the first retry, doubled on every further retry
+STRAVA_MAX_BACKOFF = 8  # seconds
+STRAVA_POOL_SIZE = 16  # kept-alive connections per process
+# access tokens are refreshed this many seconds before they expire (see token_provider.py)
+TOKEN_REFRESH_MARGIN = 300
+
+# Activities are synced within the study period (epoch seconds)
+STUDY_START = int(datetime(year=2021, month=10, day=22).timestamp())
+STUDY_END = int(datetime(year=2023, month=1, day=31).timestamp())
+# incremental syncs re-request this many seconds before the sync cursor to catch late uploads
+SYNC_CURSOR_OVERLAP = 3 * 24 * 3600
+
+# stream data storage (see stream_store.py)
+STREAM_DIR = os.environ.get('STREAM_DIR', '/home/sip/data/activities')
+STREAM_FORMAT = os.environ.get('STREAM_FORMAT', 'packed')
+# number of concurrent stream requests to Strava (see stream_downloader.py)
+STREAM_DOWNLOAD_POOL_SIZE = int(os.environ.get('STREAM_DOWNLOAD_POOL_SIZE', 4))
+
+# bulk export (see export.py): the archive layouts are kept here, so resumed downloads need not size them again
+EXPORT_MANIFEST_DIR = os.environ.get('EXPORT_MANIFEST_DIR', os.path.join(ROOT_PATH, 'export_manifests'))
+
+# response cache (see response_cache.py): bytes of stream responses cached per process, and the largest one cached
+RESPONSE_CACHE_BYTES = int(os.environ.get('RESPONSE_CACHE_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_MAX_ENTRY = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRY', 2 * 1024 * 1024))
+
+# study wide backfill (see backfill.py): concurrent Strava requests, streams committed at a time, checkpoint file
+BACKFILL_CONCURRENCY = int(os.environ.get('BACKFILL_CONCURRENCY', 8))
+BACKFILL_STREAM_BATCH = 20
+BACKFILL_CHECKPOINT = os.path.join(ROOT_PATH, 'backfill_checkpoint.json')
+
+# stream summaries (see models/activity_summary.py)
+HR_ZONE_BOUNDS = (120, 140, 160, 180)  # bpm, lower bounds of the heart rate zones 2 to 5
+MOVING_SPEED_THRESHOLD = 0.5  # m/s, slower samples count as paused
+ELEVATION_SMOOTHING = 5  # samples of the moving average applied to the altitude before summing the climbs
+
+# training load windows (see models/training_load.py), in days
+ACWR_ACUTE_DAYS = 7
+ACWR_CHRONIC_DAYS = 28
+
+# background worker (see worker.py)
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 2))  # seconds between polls of an empty queue
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETRY_BACKOFF = int(os.environ.get('JOB_RETRY_BACKOFF', 30))  # seconds, doubled on every further attempt
+JOB_STALE_AFTER = int(os.environ.get('JOB_STALE_AFTER', 600))  # running jobs without heartbeat are requeued
+# processed webhook events are kept this long (seconds) to drop late duplicate deliveries
+WEBHOOK_EVENT_RETENTION = 7 * 24 * 3600
+# attempts to apply a webhook event, retried with the backoff of jobs (JOB_RETRY_BACKOFF)
+WEBHOOK_MAX_ATTEMPTS = int(os.environ.get('WEBHOOK_MAX_ATTEMPTS', 5))
+
+# JWT revocation (see blocklist.py): seconds a token that is not revoked is cached per process,
+# and seconds between evictions of expired tokens (from the caches, and from the db by the worker)
+BLOCKLIST_CACHE_TTL = 5
+BLOCKLIST_SWEEP_INTERVAL = 300
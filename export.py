@@ -0,0 +1,298 @@
+import csv
+import hashlib
+import io
+import itertools
+import json
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+from collections import namedtuple
+
+import numpy as np
+from sqlalchemy import func
+
+from constants import EXPORT_MANIFEST_DIR
+from metrics import STREAM_BYTES
+from models.activity import ActivityModel
+from models.subject import SubjectModel
+from response_cache import etag_for
+
+# Bulk export of the activities of a subject or the whole study as one uncompressed tar archive:
+#   <root>/activities.csv                                  metadata of all activities
+#   <root>/streams/<subject_id>/<strava_activity_id>/...   stream files as stored (see stream_store.py)
+# The archive is generated on the fly and never held in memory. Its layout is deterministic (fixed member order,
+# sizes and headers), so its total size is known up front and any byte range of it can be generated again,
+# which is what lets interrupted downloads resume (HTTP Range requests, `flask strava export --resume`).
+# Sizing the archive scans all activities and stats every stream file, so the resulting layout (the manifest) is
+# kept in EXPORT_MANIFEST_DIR, shared by all processes, for as long as the data versions of the exported subjects
+# (see response_cache.invalidate) are the same. It is one directory per state of the data, <root>.<fingerprint>/:
+#   manifest.json   size, etag and the other totals
+#   members.jsonl   one [name, size, mtime, path] line per member, in archive order
+#   offsets.bin     little endian int64 archive offset of every member and of the end of archive marker
+#   lines.bin       little endian int64 position of every member's line in members.jsonl
+# The offsets are memory mapped and binary searched, and the members read from the line found on, so a resumed
+# download needs constant memory and time however many files the archive holds.
+
+BLOCK = tarfile.BLOCKSIZE
+CHUNK_SIZE = 1 << 16
+# activities loaded from the db at a time
+YIELD_PER = 500
+METADATA_COLUMNS = ['subject_id', 'strava_activity_id', 'strava_athlete_id', 'activity_type', 'start_date',
+                    'start_date_local', 'distance', 'moving_time', 'total_elevation_gain', 'streams']
+
+Member = namedtuple('Member', ['name', 'size', 'mtime', 'path'])
+OFFSET = struct.Struct('<q')
+
+
+class ExportError(Exception):
+    """Raised when the exported data changes while the archive is being generated."""
+
+
+def _header(member: Member) -> bytes:
+    info = tarfile.TarInfo(member.name)
+    info.size = member.size
+    info.mtime = member.mtime
+    info.mode = 0o644
+    return info.tobuf(format=tarfile.GNU_FORMAT)
+
+
+def _padding(size: int) -> int:
+    return -size % BLOCK
+
+
+def _stream_files(path: str) -> list:
+    # (name suffix, file path) of the stored streams of an activity: a directory of column files or a single file.
+    # Subdirectories (the downsampled levels) are derived data and left out.
+    if not path:
+        return []
+    if os.path.isdir(path):
+        return [(f'/{name}', os.path.join(path, name)) for name in sorted(os.listdir(path))
+                if os.path.isfile(os.path.join(path, name))]
+    if os.path.isfile(path):
+        return [(os.path.splitext(path)[1], path)]
+    return []
+
+
+class StudyExport:
+    def __init__(self, subject_id: str = None):
+        self.subject_id = subject_id
+        self.root = f'strava_export_{subject_id}' if subject_id else 'strava_export'
+        self.manifest_dir = os.path.join(EXPORT_MANIFEST_DIR, f'{self.root}.{self._fingerprint()}')
+        if not self._load_manifest():
+            self._build_manifest()
+            if not self._load_manifest():
+                # replaced by the manifest of a newer state right away
+                raise ExportError('Activities changed during the export')
+
+    def _fingerprint(self) -> str:
+        # changes with any change of the exported activities or streams
+        query = SubjectModel.query.with_entities(SubjectModel.subject_id, SubjectModel.data_version)
+        if self.subject_id is not None:
+            query = query.filter_by(subject_id=self.subject_id)
+        return etag_for(self.root, *query.order_by(SubjectModel.subject_id).all())
+
+    def _load_manifest(self) -> bool:
+        try:
+            with open(os.path.join(self.manifest_dir, 'manifest.json')) as f:
+                manifest = json.load(f)
+            self.offsets = np.memmap(os.path.join(self.manifest_dir, 'offsets.bin'), dtype='<i8', mode='r')
+            self.lines = np.memmap(os.path.join(self.manifest_dir, 'lines.bin'), dtype='<i8', mode='r')
+        except (OSError, ValueError):
+            return False
+        # activities added while the archive is generated are left out
+        self.max_id = manifest['max_id']
+        self.metadata_size = manifest['metadata_size']
+        self.size = manifest['size']
+        self.etag = manifest['etag']
+        return True
+
+    def _build_manifest(self):
+        # written to a temporary directory and renamed into place, other processes never read a partial manifest
+        os.makedirs(EXPORT_MANIFEST_DIR, exist_ok=True)
+        temporary = tempfile.mkdtemp(prefix=f'.{self.root}.', dir=EXPORT_MANIFEST_DIR)
+        try:
+            self._write_manifest(temporary)
+        except BaseException:
+            shutil.rmtree(temporary, ignore_errors=True)
+            raise
+        try:
+            os.rename(temporary, self.manifest_dir)
+        except OSError:
+            # built by another process at the same time
+            shutil.rmtree(temporary, ignore_errors=True)
+            if not os.path.isdir(self.manifest_dir):
+                raise
+        self._remove_stale_manifests()
+
+    def _write_manifest(self, directory: str):
+        # sizing pass: the members, the total size and an etag that changes whenever any member does
+        query = ActivityModel.query
+        if self.subject_id is not None:
+            query = query.filter_by(subject_id=self.subject_id)
+        self.max_id, latest_start = query.with_entities(func.max(ActivityModel.id),
+                                                        func.max(ActivityModel.start_date)).one()
+        self.max_id = self.max_id or 0
+        digest = hashlib.sha1()
+        self.metadata_size = 0
+        for chunk in self._metadata_chunks():
+            self.metadata_size += len(chunk)
+            digest.update(chunk)
+        metadata = Member(f'{self.root}/activities.csv', self.metadata_size,
+                          int(latest_start.timestamp()) if latest_start else 0, None)
+        offset = 0
+        with open(os.path.join(directory, 'members.jsonl'), 'wb') as members, \
+                open(os.path.join(directory, 'offsets.bin'), 'wb') as offsets, \
+                open(os.path.join(directory, 'lines.bin'), 'wb') as lines:
+            for member in itertools.chain([metadata], self._stream_members()):
+                offsets.write(OFFSET.pack(offset))
+                lines.write(OFFSET.pack(members.tell()))
+                members.write(json.dumps(list(member)).encode() + b'\n')
+                offset += len(_header(member)) + member.size + _padding(member.size)
+                digest.update(f'{member.name}\0{member.size}\0{member.mtime}\n'.encode())
+            offsets.write(OFFSET.pack(offset))
+        with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+            json.dump({'max_id': self.max_id, 'metadata_size': self.metadata_size, 'size': offset + 2 * BLOCK,
+                       'etag': digest.hexdigest()}, f)
+
+    def _remove_stale_manifests(self):
+        # manifests of earlier states of the data; downloads still reading one of them fail with an ExportError
+        for name in os.listdir(EXPORT_MANIFEST_DIR):
+            path = os.path.join(EXPORT_MANIFEST_DIR, name)
+            if name.rsplit('.', 1)[0] == self.root and path != self.manifest_dir:
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+
+    @property
+    def filename(self) -> str:
+        return f'{self.root}.tar'
+
+    def _activities(self):
+        query = ActivityModel.query.filter(ActivityModel.id <= self.max_id)
+        if self.subject_id is not None:
+            query = query.filter_by(subject_id=self.subject_id)
+        return query.order_by(ActivityModel.subject_id, ActivityModel.start_date, ActivityModel.id) \
+            .yield_per(YIELD_PER)
+
+    def _stream_prefix(self, activity) -> str:
+        return f'{self.root}/streams/{activity.subject_id}/{activity.strava_activity_id}'
+
+    def _streams_entry(self, activity) -> str:
+        # location of the activity's streams in the archive, relative to the root directory
+        files = _stream_files(activity.stream_file_path)
+        if not files:
+            return ''
+        location = self._stream_prefix(activity)[len(self.root) + 1:]
+        return location if os.path.isdir(activity.stream_file_path) else location + files[0][0]
+
+    def _metadata_chunks(self):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        writer.writerow(METADATA_COLUMNS)
+        for activity in self._activities():
+            writer.writerow([
+                activity.subject_id,
+                activity.strava_activity_id,
+                activity.strava_athlete_id,
+                activity.activity_type,
+                activity.start_date.isoformat() if activity.start_date else '',
+                activity.start_date_local.isoformat() if activity.start_date_local else '',
+                activity.distance,
+                activity.moving_time,
+                activity.total_elevation_gain,
+                self._streams_entry(activity),
+            ])
+            if buffer.tell() >= CHUNK_SIZE:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def _stream_members(self):
+        for activity in self._activities():
+            for suffix, path in _stream_files(activity.stream_file_path):
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                yield Member(self._stream_prefix(activity) + suffix, stat.st_size, int(stat.st_mtime), path)
+
+    def _member_chunks(self, member: Member, header: bytes, skip: int):
+        # bytes of a member (header, data, padding) starting skip bytes into it
+        if skip < len(header):
+            yield header[skip:]
+        skip = max(0, skip - len(header))
+        if skip < member.size:
+            data = self._metadata_data(skip) if member.path is None else self._file_data(member, skip)
+            for chunk in data:
+                yield chunk
+        skip = max(0, skip - member.size)
+        if skip < _padding(member.size):
+            yield bytes(_padding(member.size) - skip)
+
+    def _metadata_data(self, skip: int):
+        produced = 0
+        for chunk in self._metadata_chunks():
+            produced += len(chunk)
+            if produced > self.metadata_size:
+                raise ExportError('Activities changed during the export')
+            if skip >= len(chunk):
+                skip -= len(chunk)
+                continue
+            yield chunk[skip:]
+            skip = 0
+        if produced != self.metadata_size:
+            raise ExportError('Activities changed during the export')
+
+    def _file_data(self, member: Member, skip: int):
+        with open(member.path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != member.size:
+                raise ExportError(f'{member.path} changed during the export')
+            f.seek(skip)
+            remaining = member.size - skip
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ExportError(f'{member.path} changed during the export')
+                remaining -= len(chunk)
+                STREAM_BYTES.labels('read').inc(len(chunk))
+                yield chunk
+
+    def _parts(self, index: int):
+        # (offset, member) of the parts from index on, member None for the end of archive marker after the last one
+        count = len(self.lines)
+        if index < count:
+            try:
+                members = open(os.path.join(self.manifest_dir, 'members.jsonl'), 'rb')
+            except FileNotFoundError:
+                raise ExportError('Activities changed during the export')
+            with members:
+                members.seek(int(self.lines[index]))
+                for index in range(index, count):
+                    yield int(self.offsets[index]), Member(*json.loads(members.readline()))
+        yield int(self.offsets[count]), None
+
+    def _part_chunks(self, member, skip: int):
+        # bytes of a part from skip bytes into it
+        if member is None:
+            return iter([bytes(2 * BLOCK - skip)])
+        return self._member_chunks(member, _header(member), skip)
+
+    def iter_bytes(self, start: int = 0, stop: int = None):
+        # The archive bytes [start, stop). Generating starts at the part holding byte start (found in the manifest),
+        # the data of the parts before it is not read.
+        stop = self.size if stop is None else min(stop, self.size)
+        if start >= stop:
+            return
+        position = start
+        index = int(np.searchsorted(self.offsets, start, side='right')) - 1
+        for offset, member in self._parts(index):
+            for chunk in self._part_chunks(member, position - offset):
+                chunk = chunk[:stop - position]
+                position += len(chunk)
+                yield chunk
+                if position >= stop:
+                    return
@@ -1,11 +1,158 @@
-import os
+import atexit
+import copy
+import json
 import logging
-from constants import LOG_DIR
+import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+try:
+    import fcntl
+except ImportError:  # not on Linux, rotation is not coordinated between processes then
+    fcntl = None
+
+from constants import (LOG_DIR, LOG_LEVEL, LOG_FORMAT, LOG_MAX_BYTES, LOG_BACKUP_COUNT, LOG_FIELD_MAX_LENGTH,
+                       LOG_QUEUE_SIZE)
+from metrics import LOG_RECORDS_DROPPED
 
+# Request threads only put log records on a bounded in-memory queue, a listener thread of each process writes them
+# to the log file. So a slow disk never stalls a request, and a full queue drops records instead of blocking.
+# uwsgi forks its workers after the app is imported, and threads do not survive a fork, so the listener is started
+# by the first record each process logs.
 log_path = os.path.join(LOG_DIR, 'dev.log')
+
+# attributes every LogRecord has, everything else was passed with extra={...}
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+_traceback_formatter = logging.Formatter()
+
+
+def truncate(value, limit: int = LOG_FIELD_MAX_LENGTH) -> str:
+    value = value if isinstance(value, str) else repr(value)
+    if len(value) <= limit:
+        return value
+    return f'{value[:limit]}... ({len(value) - limit} more characters)'
+
+
+class JsonFormatter(logging.Formatter):
+    # one json object per line
+    def format(self, record) -> str:
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': record.filename,
+            'line': record.lineno,
+            'process': record.process,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value if isinstance(value, (int, float, bool, type(None))) else truncate(value)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+
+class SharedRotatingFileHandler(RotatingFileHandler):
+    # A RotatingFileHandler for a file written by several processes: a rollover is done by one process at a time
+    # (under an flock), and the other processes reopen the file once it has been rotated under them.
+    def __init__(self, filename, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.lock_path = self.baseFilename + '.lock'
+
+    def shouldRollover(self, record) -> bool:
+        if self.stream is not None and self._rotated():
+            self.stream.close()
+            self.stream = self._open()
+        return super().shouldRollover(record)
+
+    def _rotated(self) -> bool:
+        try:
+            return os.stat(self.baseFilename).st_ino != os.fstat(self.stream.fileno()).st_ino
+        except FileNotFoundError:
+            return True
+
+    def doRollover(self):
+        if fcntl is None:
+            return super().doRollover()
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have rotated the file while this one waited for the lock
+                if self.stream is not None and self._rotated():
+                    self.stream.close()
+                    self.stream = self._open()
+                elif os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) >= self.maxBytes:
+                    super().doRollover()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    # Merges the message arguments in the calling thread (truncating the message), keeps a traceback as text,
+    # and starts the listener of this process if needed
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = truncate(record.getMessage())
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _traceback_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        _ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.inc()
+
+
+def _file_handler() -> logging.Handler:
+    handler = SharedRotatingFileHandler(log_path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                        encoding='utf-8', delay=True)
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(
+            '%(asctime)s - %(levelname)s - %(name)s in %(filename)s(Line: %(lineno)s): %(message)s'))
+    return handler
+
+
+_listener = None
+_listener_pid = None
+_listener_lock = threading.Lock()
+
+
+def _ensure_listener():
+    global _listener, _listener_pid
+    if _listener_pid == os.getpid():
+        return
+    with _listener_lock:
+        if _listener_pid == os.getpid():
+            return
+        # a queue and listener inherited from the parent process are unusable, start over
+        log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        queue_handler.queue = log_queue
+        _listener = QueueListener(log_queue, _file_handler(), respect_handler_level=True)
+        _listener.start()
+        _listener_pid = os.getpid()
+
+
+def _stop_listener():
+    # writes the records still queued when the process exits
+    global _listener_pid
+    with _listener_lock:
+        if _listener is not None and _listener_pid == os.getpid():
+            _listener.stop()
+            _listener_pid = None
+
+
+atexit.register(_stop_listener)
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(name)s in %(filename)s(Line: %(lineno)s): %(message)s')
-file_handler = logging.FileHandler(log_path)
-file_handler.setFormatter(formatter)
-logger.addHandler(file_handler)
+logger.setLevel(LOG_LEVEL)
+queue_handler = NonBlockingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+logger.addHandler(queue_handler)
@@ -0,0 +1,110 @@
+import atexit
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+from flask import g, has_request_context, request
+from prometheus_client import (CollectorRegistry, Counter, Gauge, Histogram, REGISTRY, generate_latest,
+                               multiprocess)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Prometheus metrics, exposed at /api/metrics (resources/metrics.py).
+# uWSGI runs several processes (and the worker another one), so with PROMETHEUS_MULTIPROC_DIR set every process
+# writes its values to files in that directory and the endpoint aggregates all of them. The variable has to be
+# set before prometheus_client is imported, i.e. in the environment of the services.
+MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                            'Request latency until the response is returned (streamed bodies excluded)',
+                            ['method', 'endpoint', 'status'])
+REQUEST_DB_QUERIES = Histogram('http_request_db_queries',
+                               'Database queries per request',
+                               ['endpoint'],
+                               buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+DB_QUERIES = Counter('db_queries_total', 'Database queries of all processes, requests and jobs')
+
+STRAVA_REQUESTS = Counter('strava_requests_total',
+                          'Requests to the Strava API (every retry counts), status "error" for connection errors',
+                          ['endpoint', 'status'])
+STRAVA_LATENCY = Histogram('strava_request_duration_seconds',
+                           'Latency of requests to the Strava API',
+                           ['endpoint'],
+                           buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+# one series per live process (pid label), so take min by (window) in queries; the series of a process that
+# exits are removed by mark_process_dead below
+STRAVA_RATE_LIMIT_REMAINING = Gauge('strava_rate_limit_remaining',
+                                    'Requests left in the Strava rate limit windows, as of the last response',
+                                    ['window'],
+                                    multiprocess_mode='liveall')
+
+STREAM_BYTES = Counter('stream_bytes_total', 'Stream data read from and written to the stream store', ['direction'])
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+RESPONSE_CACHE = Counter('response_cache_total',
+                         'Conditional and cached responses: not_modified (304), hit or miss of the stream cache',
+                         ['result'])
+
+# Strava rate limit headers hold "<15 minute value>,<daily value>"
+RATE_LIMIT_WINDOWS = ('15min', 'daily')
+_ID = re.compile(r'/\d+(?=/|$)')
+
+
+def strava_endpoint(url: str) -> str:
+    # url path with ids replaced, e.g. /api/v3/activities/{id}/streams, so that the label values stay few
+    return _ID.sub('/{id}', urlsplit(url).path)
+
+
+def observe_strava_request(url: str, status, seconds: float, headers=None):
+    endpoint = strava_endpoint(url)
+    STRAVA_REQUESTS.labels(endpoint, str(status)).inc()
+    STRAVA_LATENCY.labels(endpoint).observe(seconds)
+    if headers and 'X-RateLimit-Limit' in headers and 'X-RateLimit-Usage' in headers:
+        try:
+            limits = [int(value) for value in headers['X-RateLimit-Limit'].split(',')]
+            usages = [int(value) for value in headers['X-RateLimit-Usage'].split(',')]
+        except ValueError:
+            return
+        for window, limit, usage in zip(RATE_LIMIT_WINDOWS, limits, usages):
+            STRAVA_RATE_LIMIT_REMAINING.labels(window).set(limit - usage)
+
+
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERIES.inc()
+    if has_request_context() and 'db_queries' in g:
+        g.db_queries += 1
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.db_queries = 0
+
+
+def _end_request(response):
+    if 'request_started' in g:
+        endpoint = request.endpoint or 'unmatched'
+        REQUEST_LATENCY.labels(request.method, endpoint, response.status_code) \
+            .observe(time.perf_counter() - g.request_started)
+        REQUEST_DB_QUERIES.labels(endpoint).observe(g.db_queries)
+    return response
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_end_request)
+    if not event.contains(Engine, 'before_cursor_execute', _count_query):
+        event.listen(Engine, 'before_cursor_execute', _count_query)
+
+
+def exposition() -> bytes:
+    # current values in the Prometheus text format, aggregated over all processes in multiprocess mode
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+if MULTIPROC_DIR:
+    # removes the files of this process' live gauges, so a stopped process no longer has a strava_rate_limit_remaining series
+    atexit.register(lambda: multiprocess.mark_process_dead(os.getpid()))
@@ -0,0 +1,116 @@
+from sqlalchemy import DateTime, inspect, text
+
+from db import db
+from logger import logger
+from models.activity import ActivityModel
+from models.job import JobModel, PENDING_CONDITION
+from models.training_load import TrainingLoadModel
+
+# Schema changes of tables that already exist in deployed databases. db.create_all() only creates
+# missing tables, so new columns (and other changes) of existing tables are listed here.
+# Every step checks whether it is needed, so `flask strava migrate-db` can be run any number of times.
+
+
+def add_column(table: str, column: str, ddl_type: str):
+    def step():
+        if column in [c['name'] for c in inspect(db.engine).get_columns(table)]:
+            return False
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl_type}'))
+        return True
+    step.description = f'add column {table}.{column}'
+    return step
+
+
+def create_index(name: str, table: str, columns: list):
+    def step():
+        if name in [index['name'] for index in inspect(db.engine).get_indexes(table)]:
+            return False
+        db.session.execute(text(f'CREATE INDEX {name} ON {table} ({", ".join(columns)})'))
+        return True
+    step.description = f'create index {name}'
+    return step
+
+
+def unique_pending_jobs():
+    # At most one pending job per type and subject (see JobModel.enqueue_or_merge). Duplicates queued before
+    # cannot be merged without knowing their task, all but the first one are failed so the index can be created.
+    name = 'ix_jobs_pending_unique'
+    if name in [index['name'] for index in inspect(db.engine).get_indexes('jobs')]:
+        return False
+    seen = set()
+    for job in JobModel.query.filter(text(PENDING_CONDITION)).order_by(JobModel.id):
+        if (job.job_type, job.subject_id) in seen and job.subject_id is not None:
+            job.mark_failed('Duplicate of a job queued before', retry=False)
+        seen.add((job.job_type, job.subject_id))
+    db.session.execute(text(f'CREATE UNIQUE INDEX {name} ON jobs (job_type, subject_id) WHERE {PENDING_CONDITION}'))
+    return True
+
+
+unique_pending_jobs.description = 'create unique index ix_jobs_pending_unique'
+
+
+def activity_start_dates_to_timestamps():
+    # start_date/start_date_local used to be strings as returned by Strava ("2022-03-01T07:12:54Z")
+    if db.engine.dialect.name == 'postgresql':
+        types = {c['name']: c['type'] for c in inspect(db.engine).get_columns('activities')}
+        if isinstance(types['start_date'], DateTime):
+            return False
+        db.session.execute(text(
+            "ALTER TABLE activities "
+            "ALTER COLUMN start_date TYPE TIMESTAMP WITHOUT TIME ZONE "
+            "USING (start_date::timestamptz AT TIME ZONE 'UTC'), "
+            "ALTER COLUMN start_date_local TYPE TIMESTAMP WITHOUT TIME ZONE "
+            "USING (replace(start_date_local, 'Z', '')::timestamp)"))
+        return True
+    # SQLite has no column types to change, but the values have to be in the format SQLAlchemy reads back
+    updated = 0
+    for column in ('start_date', 'start_date_local'):
+        updated += db.session.execute(text(
+            f"UPDATE activities SET {column} = replace(replace({column}, 'T', ' '), 'Z', '.000000') "
+            f"WHERE {column} LIKE '%T%'")).rowcount
+    return updated > 0
+
+
+activity_start_dates_to_timestamps.description = 'convert activity start dates to timestamps'
+
+
+def build_training_load():
+    # the daily training load table is new (created by db.create_all()), fill it from the existing activities.
+    # Only selects the id, columns added to the model by later steps do not exist yet.
+    if TrainingLoadModel.query.first() is not None or db.session.query(ActivityModel.id).first() is None:
+        return False
+    TrainingLoadModel.rebuild()
+    return True
+
+
+build_training_load.description = 'build the daily training load from the activities'
+
+
+MIGRATIONS = [
+    add_column('subject', 'sync_cursor', 'INTEGER'),
+    add_column('subject', 'last_synced_at', 'INTEGER'),
+    activity_start_dates_to_timestamps,
+    create_index('ix_activities_subject_id_start_date', 'activities', ['subject_id', 'start_date']),
+    create_index('ix_subject_strava_id', 'subject', ['strava_id']),
+    create_index('ix_users_username', 'users', ['username']),
+    build_training_load,
+    add_column('subject', 'data_version', 'INTEGER NOT NULL DEFAULT 0'),
+    add_column('activities', 'stream_sha256', 'VARCHAR(64)'),
+    add_column('activities', 'stream_size', 'BIGINT'),
+    add_column('activities', 'stream_samples', 'INTEGER'),
+    unique_pending_jobs,
+    add_column('webhook_events', 'attempts', 'INTEGER NOT NULL DEFAULT 0'),
+    add_column('webhook_events', 'run_after', 'TIMESTAMP'),
+    add_column('webhook_events', 'message', 'VARCHAR(255)'),
+]
+
+
+def upgrade() -> list:
+    db.create_all()
+    applied = []
+    for step in MIGRATIONS:
+        if step():
+            db.session.commit()
+            logger.info(f'Migration applied: {step.description}')
+            applied.append(step.description)
+    return applied
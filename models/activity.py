@@ -1,16 +1,50 @@
 import os
+from datetime import datetime, timezone
 
-import pandas as pd
-import requests
+from sqlalchemy import or_
 
 from db import db
-from models.subject import SubjectModel
+from models.activity_summary import ActivitySummaryModel
+from models.subject import ActivityRecord, SubjectModel
+from models.training_load import TrainingLoadModel, load_delta, merge_deltas
+from response_cache import invalidate
+from strava_client import get_client
+from stream_downloader import StreamDownloader
+from token_provider import get_access_token
+from stream_store import (write_streams, columns_from_strava, delete_streams, stream_hash, stream_samples,
+                          stored_size)
 
 from logger import logger
 
+# SQLite before 3.32 allows at most 999 bound parameters per statement
+SQLITE_MAX_VARIABLES = 999
+# possible streams: https://developers.strava.com/docs/reference/#api-models-StreamSet
+STREAM_REQUEST_PARAMS = {'key_by_type': 'true',
+                         'keys': 'time,distance,velocity_smooth,altitude,latlng,temp,cadence,grade_smooth,heartrate'}
+
+
+def parse_strava_date(value, local: bool = False) -> datetime:
+    # Strava dates like "2022-03-01T07:12:54Z" as naive datetime: UTC for start_date,
+    # the athlete's wall clock time for start_date_local (which Strava also marks with a "Z")
+    if isinstance(value, datetime):
+        date = value
+    else:
+        date = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    if date.tzinfo is not None:
+        if not local:
+            date = date.astimezone(timezone.utc)
+        date = date.replace(tzinfo=None)
+    return date
+
+
+def format_strava_date(value: datetime):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ') if value else None
+
 
 class ActivityModel(db.Model):
     __tablename__ = 'activities'
+    # the activities of a subject are always looked up by subject and, optionally, a date range
+    __table_args__ = (db.Index('ix_activities_subject_id_start_date', 'subject_id', 'start_date'),)
 
     id = db.Column(db.Integer, primary_key=True)
     subject_id = db.Column(db.String, db.ForeignKey('subject.subject_id'))
@@ -22,28 +56,40 @@ class ActivityModel(db.Model):
     moving_time = db.Column(db.BigInteger)
     total_elevation_gain = db.Column(db.Float(precision=1))
     activity_type = db.Column(db.String(40))
-    start_date = db.Column(db.String(40))
-    start_date_local = db.Column(db.String(40))
+    start_date = db.Column(db.DateTime)
+    start_date_local = db.Column(db.DateTime)
 
     stream_file_path = db.Column(db.String(120))
+    # content hash (stream_store.stream_hash), bytes on disk and samples of the stored streams,
+    # checked by `flask strava verify-streams`
+    stream_sha256 = db.Column(db.String(64))
+    stream_size = db.Column(db.BigInteger)
+    stream_samples = db.Column(db.Integer)
 
     subject = db.relationship('SubjectModel')
+    summary = db.relationship('ActivitySummaryModel', uselist=False, cascade='all, delete-orphan',
+                              backref='activity')
 
-    def __init__(self, subject_id: str, activity_data: pd.DataFrame):
-        self.strava_activity_id = int(activity_data['id'])
-        self.strava_athlete_id = int(activity_data['athlete_id'])
-
-        self.distance = float(activity_data['distance'])
-        self.moving_time = int(activity_data['moving_time'])
-        self.total_elevation_gain = float(activity_data['total_elevation_gain'])
-        self.activity_type = str(activity_data['type'])
-        self.start_date = str(activity_data['start_date'])
-        self.start_date_local = str(activity_data['start_date_local'])
+    def __init__(self, subject_id: str, activity_data: ActivityRecord):
+        self.strava_activity_id = int(activity_data.id)
+        self.strava_athlete_id = int(activity_data.athlete_id)
+        self.set_activity_data(activity_data)
 
         self.stream_file_path = ""
 
         self.subject_id = str(subject_id)
 
+    def set_activity_data(self, activity_data: ActivityRecord):
+        # fields that can change on Strava after the activity has been created
+        self.distance = float(activity_data.distance)
+        self.moving_time = int(activity_data.moving_time)
+        self.total_elevation_gain = float(activity_data.total_elevation_gain)
+        self.activity_type = str(activity_data.type)
+        self.start_date = parse_strava_date(activity_data.start_date)
+        self.start_date_local = parse_strava_date(activity_data.start_date_local, local=True)
+        if self.summary is not None:
+            self.summary.start_date = self.start_date
+
     def json(self):
         return {
             'id': self.id,
@@ -54,59 +100,141 @@ class ActivityModel(db.Model):
             'moving_time': self.moving_time,
             'total_elevation_gain': self.total_elevation_gain,
             'activity_type': self.activity_type,
-            'start_date': self.start_date,
-            'start_date_local': self.start_date_local,
+            'start_date': format_strava_date(self.start_date),
+            'start_date_local': format_strava_date(self.start_date_local),
             'stream_file_path': self.stream_file_path,
+            'stream_sha256': self.stream_sha256,
+            'stream_size': self.stream_size,
+            'stream_samples': self.stream_samples,
         }
 
     def save_to_db(self):
         db.session.add(self)
+        invalidate(self.subject_id)
         db.session.commit()
 
     def delete_from_db(self):
+        TrainingLoadModel.apply_deltas(self.training_load(sign=-1))
         db.session.delete(self)
+        invalidate(self.subject_id)
         db.session.commit()
 
+    def training_load(self, sign: int = 1) -> dict:
+        # contribution of this activity to the daily training load (see TrainingLoadModel)
+        return load_delta(self.subject_id, self.start_date_local, self.distance, self.moving_time,
+                          self.total_elevation_gain, sign=sign)
+
     @classmethod
     def find_by_strava_id(cls, strava_activity_id):
         return cls.query.filter_by(strava_activity_id=strava_activity_id).first()
 
     @classmethod
-    def find_by_subject_id(cls, subject_id):
-        return cls.query.filter_by(subject_id=subject_id).all()
+    def query_by_subject_id(cls, subject_id, after: datetime = None, before: datetime = None,
+                            activity_type: str = None):
+        # range scan on the (subject_id, start_date) index
+        query = cls.query.filter_by(subject_id=subject_id)
+        if after is not None:
+            query = query.filter(cls.start_date >= after)
+        if before is not None:
+            query = query.filter(cls.start_date < before)
+        if activity_type is not None:
+            query = query.filter_by(activity_type=activity_type)
+        return query
+
+    @classmethod
+    def find_by_subject_id(cls, subject_id, after: datetime = None, before: datetime = None,
+                           activity_type: str = None):
+        return cls.query_by_subject_id(subject_id, after, before, activity_type).order_by(cls.start_date, cls.id).all()
 
     @classmethod
     def find_all(cls):
         return cls.query.all()
 
     def get_stream_data(self, access_token):
-        logger.info(f'Requesting stream data for activity {self.strava_activity_id}')
-        # possible streams: https://developers.strava.com/docs/reference/#api-models-StreamSet
-        url = f'https://www.strava.com/api/v3/activities/{self.strava_activity_id}/streams'
-        params = {'key_by_type': 'true',
-                  'keys': 'time,distance,velocity_smooth,altitude,latlng,temp,cadence,grade_smooth,heartrate', }
-        r = requests.get(url,
-                         params=params,
-                         headers={'Authorization': f'Bearer {access_token}'})
+        stream_set = self.fetch_stream_data(self.strava_activity_id, access_token)
+        if stream_set is None:
+            # todo: add bool parameter "manual" to model like in the original strava data structure
+            return False
+        self.store_stream_data(stream_set)
+        return True
+
+    @staticmethod
+    def fetch_stream_data(strava_activity_id: int, access_token: str):
+        # Network part of get_stream_data. Does not touch the db session, so it is safe to call from other threads.
+        logger.info(f'Requesting stream data for activity {strava_activity_id}')
+        r = get_client().get(f'/activities/{strava_activity_id}/streams', access_token=access_token,
+                             params=STREAM_REQUEST_PARAMS)
 
         if r.status_code != 200:
             # stream data does not exist (manually added activity)
-            logger.error(f'Requesting stream data for activity {self.strava_activity_id} failed')
-            # todo: add bool parameter "manual" to model like in the original strava data structure
+            logger.error(f'Requesting stream data for activity {strava_activity_id} failed')
+            return None
+        return r.json()
+
+    def store_stream_data(self, stream_set: dict, commit: bool = True) -> bool:
+        # commit=False leaves the commit (and the invalidate() that goes with it) to the caller, e.g. per batch.
+        # Streams equal to the stored ones (same content hash) are neither written nor summarized again,
+        # returns whether they were written.
+        written = self.write_stream_files(self.strava_activity_id, stream_set,
+                                          self.stream_file_path, self.stream_sha256)
+        return self.store_written_streams(*written, commit=commit)
+
+    @staticmethod
+    def write_stream_files(strava_activity_id: int, stream_set: dict, stored_path: str = None,
+                           stored_hash: str = None) -> tuple:
+        # Disk part of store_stream_data: encoding, hashing, downsampled levels and the file write. Does not touch
+        # the db session, so it is safe to call from other threads. Returns (columns, content hash, path written),
+        # the path is None if the streams equal the stored ones.
+        columns = columns_from_strava(stream_set)
+        content_hash = stream_hash(columns)
+        if stored_path and stored_hash == content_hash and os.path.exists(stored_path):
+            logger.info(f'Streams of activity {strava_activity_id} unchanged')
+            return columns, content_hash, None
+        path = write_streams(strava_activity_id, columns)
+        if stored_path and stored_path != path:
+            # e.g. a legacy csv file replaced by a re-download
+            delete_streams(stored_path)
+        return columns, content_hash, path
+
+    def store_written_streams(self, columns: dict, content_hash: str, path: str, commit: bool = True) -> bool:
+        # records the result of write_stream_files, see store_stream_data
+        if path is None:
             return False
-        r = r.json()
-        out = dict()
-        for key, value in r.items():
-            out[key] = value['data']
-        df = pd.DataFrame(out)
-        self.stream_file_path = f'/home/sip/data/activities/{self.strava_activity_id}.csv'
-        df.to_csv(self.stream_file_path)
-        self.save_to_db()
+        self.stream_file_path = path
+        self.set_stream_checksum(columns, content_hash)
+        self.update_summary(columns)
+        if commit:
+            self.save_to_db()
+        else:
+            db.session.add(self)
         return True
 
+    def set_stream_checksum(self, columns: dict, content_hash: str = None):
+        # records hash, size and samples of the streams stored at stream_file_path
+        self.stream_sha256 = content_hash or stream_hash(columns)
+        self.stream_size = stored_size(self.stream_file_path)
+        self.stream_samples = stream_samples(columns)
+
+    def clear_stream_data(self):
+        # forgets the stored streams, so they are downloaded again (see find_without_stream)
+        self.stream_file_path = ""
+        self.stream_sha256 = None
+        self.stream_size = None
+        self.stream_samples = None
+
+    def update_summary(self, columns: dict):
+        # (re)computes the summary of the streams, committed together with the activity
+        if self.summary is None:
+            self.summary = ActivitySummaryModel()
+        try:
+            self.summary.set_values(self, columns)
+        except Exception as err:
+            # the streams are stored anyway, `flask strava summarize` can be run again later
+            logger.exception(err)
+            self.summary = None
+
     def delete_stream_data(self):
-        if os.path.exists(self.stream_file_path):
-            os.remove(self.stream_file_path)
+        delete_streams(self.stream_file_path)
         return
 
     @classmethod
@@ -123,20 +251,38 @@ class ActivityModel(db.Model):
             logger.warning(f'subject with strava athlete id {event_data["owner_id"]} not found')
             return
 
-        if event_data['aspect_type'] == 'create':
-            # Get the activity from strava
-            new_activity = subject.get_activity(event_data['object_id'])
-            if new_activity is None:
+        if event_data['aspect_type'] in ('create', 'update'):
+            # Get the current state of the activity from strava
+            activity_data = subject.get_activity(event_data['object_id'])
+            if activity_data is None:
                 logger.warning(f'Could not retrieve activity. Object ID: {event_data["object_id"]}')
                 return
-            activity = cls(subject_id=subject.subject_id,
-                           activity_data=new_activity.loc[0])
-            if 'run' not in str(activity.activity_type).lower():
+            activity = cls.find_by_strava_id(event_data['object_id'])
+            if 'run' not in str(activity_data.type).lower():
+                if activity:
+                    # the activity type has been changed from running to something else
+                    logger.info(f'activity_type changed to {activity_data.type}, deleting from db {activity.json()}')
+                    activity.delete_stream_data()
+                    activity.delete_from_db()
+                    return
                 logger.warning(f'activity_type != running')
                 return
-            logger.info(f'saving to db {activity.json()}')
-            activity.save_to_db()
-            activity.get_stream_data(access_token=subject.access_token)
+            if activity:
+                # an update, or a create for an activity that a sync has added already
+                old_load = activity.training_load(sign=-1)
+                activity.set_activity_data(activity_data)
+                TrainingLoadModel.apply_deltas(merge_deltas([old_load, activity.training_load()]))
+                logger.info(f'updating in db {activity.json()}')
+                activity.save_to_db()
+                if activity.stream_file_path:
+                    return
+            else:
+                activity = cls(subject_id=subject.subject_id,
+                               activity_data=activity_data)
+                TrainingLoadModel.apply_deltas(activity.training_load())
+                logger.info(f'saving to db {activity.json()}')
+                activity.save_to_db()
+            activity.get_stream_data(access_token=get_access_token(subject))
 
         elif event_data['aspect_type'] == 'delete':
             delete_activity = cls.find_by_strava_id(event_data["object_id"])
@@ -147,24 +293,93 @@ class ActivityModel(db.Model):
             logger.info(f'deleting from db {delete_activity.json()}')
             delete_activity.delete_stream_data()
             delete_activity.delete_from_db()
-        # todo: implement update!
 
     @classmethod
-    def get_all(cls, df_activities: pd.DataFrame, subject: SubjectModel):
-        for row, df_activity in df_activities.iterrows():
-            new_activity = ActivityModel.find_by_strava_id(strava_activity_id=df_activity['id'])
-            if new_activity:
-                # db entry already exists. check if the stream data is also present
-                if new_activity.stream_file_path:
-                    # if so. do nothing
-                    logger.info(f'Activity {new_activity.strava_activity_id} already exists. Not adding.')
-                    continue
-                logger.info(f'Getting data stream for activity {new_activity.strava_activity_id}')
-                new_activity.get_stream_data(subject.access_token)
-                continue
-            activity = ActivityModel(subject_id=str(subject.subject_id),
-                                     activity_data=df_activity)
-            logger.info(f'Adding activity {activity.strava_activity_id} to db')
-            activity.save_to_db()
-            # activity.get_stream_data(subject.access_token)
+    def find_without_stream(cls, strava_activity_ids: list = None, subject_id: str = None):
+        query = cls.query.filter(or_(cls.stream_file_path.is_(None), cls.stream_file_path == ''))
+        if strava_activity_ids is not None:
+            query = query.filter(cls.strava_activity_id.in_(strava_activity_ids))
+        if subject_id is not None:
+            query = query.filter_by(subject_id=subject_id)
+        return query.all()
+
+    @staticmethod
+    def row_values(subject_id: str, activity_data: ActivityRecord) -> dict:
+        # column values of a new activity row, see __init__
+        return {
+            'subject_id': str(subject_id),
+            'strava_activity_id': int(activity_data.id),
+            'strava_athlete_id': int(activity_data.athlete_id),
+            'distance': float(activity_data.distance),
+            'moving_time': int(activity_data.moving_time),
+            'total_elevation_gain': float(activity_data.total_elevation_gain),
+            'activity_type': str(activity_data.type),
+            'start_date': parse_strava_date(activity_data.start_date),
+            'start_date_local': parse_strava_date(activity_data.start_date_local, local=True),
+            'stream_file_path': "",
+        }
+
+    @classmethod
+    def bulk_ingest(cls, activities: list, subject: SubjectModel, progress=None) -> dict:
+        # Insert all activities that are not in the db yet: one IN (...) lookup, one multi-row
+        # INSERT ... ON CONFLICT DO NOTHING and one commit per batch of INGEST_BATCH_SIZE activities.
+        counts = {'inserted': 0, 'skipped': 0, 'pending_stream': 0}
+        for start in range(0, len(activities), INGEST_BATCH_SIZE):
+            batch = {record.id: record for record in activities[start:start + INGEST_BATCH_SIZE]}
+            existing = dict(db.session.query(cls.strava_activity_id, cls.stream_file_path)
+                            .filter(cls.strava_activity_id.in_(list(batch.keys()))))
+            rows = [cls.row_values(subject.subject_id, record)
+                    for strava_activity_id, record in batch.items() if strava_activity_id not in existing]
+            inserted = 0
+            if rows:
+                inserted = db.session.execute(_insert_ignore_conflicts(cls.__table__, rows)).rowcount
+                if inserted == len(rows):
+                    TrainingLoadModel.apply_deltas(merge_deltas(
+                        load_delta(row['subject_id'], row['start_date_local'], row['distance'], row['moving_time'],
+                                   row['total_elevation_gain']) for row in rows))
+                else:
+                    # some activities were inserted concurrently (and counted) by someone else, which ones
+                    # is unknown, so the affected days are recomputed instead
+                    TrainingLoadModel.recompute_days(subject.subject_id,
+                                                     [row['start_date_local'].date() for row in rows])
+                if inserted:
+                    invalidate(subject.subject_id)
+            db.session.commit()
+
+            counts['inserted'] += inserted
+            counts['skipped'] += len(batch) - inserted
+            counts['pending_stream'] += inserted + sum(1 for path in existing.values() if not path)
+            if progress:
+                progress(start + len(batch))
+        logger.info(f'Subject {subject.subject_id}: {counts["inserted"]} activities added, '
+                    f'{counts["skipped"]} already existing, {counts["pending_stream"]} without stream data')
+        return counts
+
+    @classmethod
+    def get_all(cls, activities: list, subject: SubjectModel, progress=None, stream_progress=None) -> dict:
+        # activities: ActivityRecords as returned by SubjectModel.get_activities
+        # progress(activities added), stream_progress(streams downloaded, streams to download)
+        counts = cls.bulk_ingest(activities, subject, progress=progress)
+        strava_activity_ids = [record.id for record in activities]
+        pending = []
+        for start in range(0, len(strava_activity_ids), INGEST_BATCH_SIZE):
+            pending += cls.find_without_stream(strava_activity_ids[start:start + INGEST_BATCH_SIZE])
+        counts.update(StreamDownloader().download(pending, progress=stream_progress))
+        return counts
+
+
+# Activities per INSERT/commit. The multi-row INSERT of bulk_ingest binds one parameter per row and row_values
+# column, and those are columns of the table, so batches of this size stay within SQLITE_MAX_VARIABLES.
+INGEST_BATCH_SIZE = SQLITE_MAX_VARIABLES // len(ActivityModel.__table__.columns)
+
 
+def _insert_ignore_conflicts(table, rows: list):
+    # Activities inserted concurrently (e.g. by a webhook event) between the lookup and the insert are skipped
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return table.insert().values(rows)
+    return insert(table).values(rows).on_conflict_do_nothing(index_elements=['strava_activity_id'])
@@ -0,0 +1,172 @@
+from datetime import datetime
+
+import numpy as np
+
+from constants import HR_ZONE_BOUNDS, MOVING_SPEED_THRESHOLD, ELEVATION_SMOOTHING
+from db import db
+
+PERCENTILES = (10, 50, 90)
+
+
+def _percentiles(values) -> list:
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if not len(values):
+        return [None] * len(PERCENTILES)
+    return [float(p) for p in np.percentile(values, PERCENTILES)]
+
+
+def _weighted_mean(values, weights):
+    # mean of the valid values, each weighted with its seconds; None without any
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    if not weights[valid].sum():
+        return None
+    return float(np.average(values[valid], weights=weights[valid]))
+
+
+def _last_finite(values):
+    values = np.asarray(values, dtype=np.float64)
+    finite = values[np.isfinite(values)]
+    return float(finite[-1]) if len(finite) else None
+
+
+def summarize_streams(columns: dict) -> dict:
+    # Summary values of the stream columns of one activity (see stream_store.columns_from_strava).
+    # Time based values weight every sample with the seconds until the next one, pauses excluded.
+    time = np.asarray(columns['time'], dtype=np.float64) if 'time' in columns else None
+    if time is None or not len(time):
+        return {'samples': 0}
+    dt = np.diff(time, append=time[-1])
+    if 'velocity_smooth' in columns:
+        velocity = np.asarray(columns['velocity_smooth'], dtype=np.float64)
+        moving = velocity > MOVING_SPEED_THRESHOLD
+    elif 'moving' in columns:
+        velocity = None
+        moving = np.asarray(columns['moving'], dtype=bool)
+    else:
+        velocity = None
+        moving = np.ones(len(time), dtype=bool)
+    moving_dt = np.where(moving, dt, 0)
+
+    summary = {
+        'samples': len(time),
+        'elapsed_time': int(time[-1] - time[0]),
+        'moving_time': int(moving_dt.sum()),
+        # the last samples may have no distance (NaN)
+        'distance': _last_finite(columns['distance']) if 'distance' in columns else None,
+    }
+
+    if 'heartrate' in columns:
+        heartrate = np.asarray(columns['heartrate'], dtype=np.float64)
+        summary['hr_mean'] = _weighted_mean(heartrate, moving_dt)
+        summary['hr_max'] = float(np.nanmax(heartrate)) if not np.isnan(heartrate).all() else None
+        summary['hr_p10'], summary['hr_p50'], summary['hr_p90'] = _percentiles(heartrate[moving])
+        # seconds per zone: below the first bound, between the bounds, from the last bound on
+        valid = ~np.isnan(heartrate)
+        zone_times = np.bincount(np.digitize(heartrate[valid], HR_ZONE_BOUNDS), weights=moving_dt[valid],
+                                 minlength=len(HR_ZONE_BOUNDS) + 1)
+        for zone, seconds in enumerate(zone_times, start=1):
+            summary[f'hr_zone_{zone}_time'] = int(seconds)
+
+    if 'cadence' in columns:
+        cadence = np.asarray(columns['cadence'], dtype=np.float64)
+        summary['cadence_mean'] = _weighted_mean(cadence, moving_dt)
+        summary['cadence_p10'], summary['cadence_p50'], summary['cadence_p90'] = _percentiles(cadence[moving])
+
+    if velocity is not None and moving.any():
+        # pace in seconds per kilometre, p10 is the fastest
+        pace = 1000 / velocity[moving]
+        summary['pace_p10'], summary['pace_p50'], summary['pace_p90'] = _percentiles(pace)
+        if summary['distance'] and summary['moving_time']:
+            summary['pace_mean'] = summary['moving_time'] / summary['distance'] * 1000
+
+    if 'altitude' in columns and len(columns['altitude']) > 1:
+        altitude = np.asarray(columns['altitude'], dtype=np.float64)
+        altitude = altitude[~np.isnan(altitude)]
+        if len(altitude) > ELEVATION_SMOOTHING:
+            # moving average against the altitude noise, which otherwise adds up to a lot of climbing
+            kernel = np.ones(ELEVATION_SMOOTHING) / ELEVATION_SMOOTHING
+            altitude = np.convolve(altitude, kernel, mode='valid')
+        climbs = np.diff(altitude)
+        summary['elevation_gain'] = float(climbs[climbs > 0].sum())
+    return summary
+
+
+class ActivitySummaryModel(db.Model):
+    # Summary of an activity's streams, computed when the streams are stored (ActivityModel.store_stream_data).
+    # strava_activity_id, subject_id and start_date are copies from the activity,
+    # so that the summaries of a subject are one index range scan without a join.
+    __tablename__ = 'activity_summaries'
+    __table_args__ = (db.Index('ix_activity_summaries_subject_id_start_date', 'subject_id', 'start_date'),)
+
+    activity_id = db.Column(db.Integer, db.ForeignKey('activities.id', ondelete='CASCADE'), primary_key=True)
+    strava_activity_id = db.Column(db.BigInteger)
+    subject_id = db.Column(db.String)
+    start_date = db.Column(db.DateTime)
+
+    samples = db.Column(db.Integer)
+    elapsed_time = db.Column(db.Integer)
+    moving_time = db.Column(db.Integer)
+    distance = db.Column(db.Float)
+    elevation_gain = db.Column(db.Float)
+
+    hr_mean = db.Column(db.Float)
+    hr_max = db.Column(db.Float)
+    hr_p10 = db.Column(db.Float)
+    hr_p50 = db.Column(db.Float)
+    hr_p90 = db.Column(db.Float)
+    hr_zone_1_time = db.Column(db.Integer)
+    hr_zone_2_time = db.Column(db.Integer)
+    hr_zone_3_time = db.Column(db.Integer)
+    hr_zone_4_time = db.Column(db.Integer)
+    hr_zone_5_time = db.Column(db.Integer)
+
+    cadence_mean = db.Column(db.Float)
+    cadence_p10 = db.Column(db.Float)
+    cadence_p50 = db.Column(db.Float)
+    cadence_p90 = db.Column(db.Float)
+
+    pace_mean = db.Column(db.Float)
+    pace_p10 = db.Column(db.Float)
+    pace_p50 = db.Column(db.Float)
+    pace_p90 = db.Column(db.Float)
+
+    computed_at = db.Column(db.DateTime)
+
+    VALUES = ['samples', 'elapsed_time', 'moving_time', 'distance', 'elevation_gain',
+              'hr_mean', 'hr_max', 'hr_p10', 'hr_p50', 'hr_p90',
+              'hr_zone_1_time', 'hr_zone_2_time', 'hr_zone_3_time', 'hr_zone_4_time', 'hr_zone_5_time',
+              'cadence_mean', 'cadence_p10', 'cadence_p50', 'cadence_p90',
+              'pace_mean', 'pace_p10', 'pace_p50', 'pace_p90']
+
+    def set_values(self, activity, columns: dict):
+        summary = summarize_streams(columns)
+        # values a stream does not have (e.g. no heartrate) are reset, the streams may have been replaced
+        for name in self.VALUES:
+            setattr(self, name, summary.get(name))
+        self.strava_activity_id = activity.strava_activity_id
+        self.subject_id = activity.subject_id
+        self.start_date = activity.start_date
+        self.computed_at = datetime.utcnow()
+
+    def json(self):
+        summary = {name: getattr(self, name) for name in self.VALUES}
+        summary['activity_id'] = self.activity_id
+        summary['strava_activity_id'] = self.strava_activity_id
+        summary['start_date'] = self.start_date.strftime('%Y-%m-%dT%H:%M:%SZ') if self.start_date else None
+        summary['computed_at'] = self.computed_at.isoformat() if self.computed_at else None
+        return summary
+
+    @classmethod
+    def find_by_activity_id(cls, activity_id):
+        return cls.query.filter_by(activity_id=activity_id).first()
+
+    @classmethod
+    def query_by_subject_id(cls, subject_id, after: datetime = None, before: datetime = None):
+        query = cls.query.filter_by(subject_id=subject_id)
+        if after is not None:
+            query = query.filter(cls.start_date >= after)
+        if before is not None:
+            query = query.filter(cls.start_date < before)
+        return query
@@ -0,0 +1,230 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+
+from db import db
+from constants import JOB_MAX_ATTEMPTS, JOB_RETRY_BACKOFF, JOB_STALE_AFTER
+
+from logger import logger
+
+
+# jobs that are queued and have not been started yet; at most one per type and subject (see enqueue_or_merge)
+PENDING_CONDITION = "status = 'queued' AND attempts = 0"
+
+
+class JobModel(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_pending_unique', 'job_type', 'subject_id', unique=True,
+                               postgresql_where=text(PENDING_CONDITION), sqlite_where=text(PENDING_CONDITION)),)
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(40), nullable=False)
+    subject_id = db.Column(db.String(4), index=True)
+    payload = db.Column(db.Text)
+
+    status = db.Column(db.String(20), nullable=False, index=True)
+    attempts = db.Column(db.Integer, nullable=False)
+    max_attempts = db.Column(db.Integer, nullable=False)
+    run_after = db.Column(db.DateTime, nullable=False)
+    locked_by = db.Column(db.String(80))
+
+    progress = db.Column(db.Integer)
+    total = db.Column(db.Integer)
+    message = db.Column(db.String(255))
+    result = db.Column(db.Text)
+
+    created_at = db.Column(db.DateTime, nullable=False)
+    started_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    # minimum number of seconds between two progress commits of a running job
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self, job_type: str, subject_id: str = None, payload: dict = None,
+                 max_attempts: int = JOB_MAX_ATTEMPTS):
+        now = datetime.utcnow()
+        self.job_type = job_type
+        self.subject_id = subject_id
+        self.payload = json.dumps(payload or {})
+        self.status = self.QUEUED
+        self.attempts = 0
+        self.max_attempts = max_attempts
+        self.run_after = now
+        self.progress = 0
+        self.created_at = now
+        self.updated_at = now
+
+    def json(self):
+        return {
+            'id': self.id,
+            'job_type': self.job_type,
+            'subject_id': self.subject_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'max_attempts': self.max_attempts,
+            'progress': self.progress,
+            'total': self.total,
+            'message': self.message,
+            'result': json.loads(self.result) if self.result else None,
+            'created_at': _isoformat(self.created_at),
+            'started_at': _isoformat(self.started_at),
+            'updated_at': _isoformat(self.updated_at),
+            'finished_at': _isoformat(self.finished_at),
+        }
+
+    def get_payload(self) -> dict:
+        return json.loads(self.payload) if self.payload else {}
+
+    def save_to_db(self):
+        db.session.add(self)
+        db.session.commit()
+
+    def delete_from_db(self):
+        db.session.delete(self)
+        db.session.commit()
+
+    def update_progress(self, progress: int, total: int = None, message: str = None, force: bool = False):
+        # Progress doubles as the heartbeat of a running job. Commits are throttled so that
+        # reporting per activity does not turn into one commit per activity.
+        self.progress = progress
+        if total is not None:
+            self.total = total
+        if message is not None:
+            self.message = message[:255]
+        now = datetime.utcnow()
+        if force or not self.updated_at or (now - self.updated_at).total_seconds() >= self.PROGRESS_INTERVAL:
+            self.updated_at = now
+            self.save_to_db()
+
+    def mark_succeeded(self, result: dict = None):
+        now = datetime.utcnow()
+        self.status = self.SUCCEEDED
+        self.result = json.dumps(result) if result is not None else None
+        self.locked_by = None
+        self.updated_at = now
+        self.finished_at = now
+        self.save_to_db()
+        logger.info(f'Job {self.id} ({self.job_type}) succeeded: {result}')
+
+    def mark_failed(self, error: str, retry: bool = True):
+        now = datetime.utcnow()
+        self.message = str(error)[:255]
+        self.locked_by = None
+        self.updated_at = now
+        if retry and self.attempts < self.max_attempts:
+            # exponential backoff: JOB_RETRY_BACKOFF, 2 * JOB_RETRY_BACKOFF, ...
+            delay = JOB_RETRY_BACKOFF * 2 ** (self.attempts - 1)
+            self.status = self.QUEUED
+            self.run_after = now + timedelta(seconds=delay)
+            logger.warning(f'Job {self.id} ({self.job_type}) failed on attempt {self.attempts}, '
+                           f'retrying in {delay}s: {error}')
+        else:
+            self.status = self.FAILED
+            self.finished_at = now
+            logger.error(f'Job {self.id} ({self.job_type}) failed after {self.attempts} attempts: {error}')
+        self.save_to_db()
+
+    @classmethod
+    def enqueue(cls, job_type: str, subject_id: str = None, payload: dict = None):
+        job = cls(job_type=job_type, subject_id=subject_id, payload=payload)
+        job.save_to_db()
+        logger.info(f'Job {job.id} ({job_type}) queued for subject {subject_id}')
+        return job
+
+    @classmethod
+    def enqueue_or_merge(cls, job_type: str, subject_id: str, payload: dict, merge):
+        # Queues a job unless an active one of the type and subject does the requested work already.
+        # merge(payload, requested) returns a payload doing the work of both, e.g. the union of two sync windows.
+        # A job already covering the request (merging changes nothing) is returned, otherwise a job that has not
+        # been started yet is widened to the merged payload, or a new job is queued.
+        # Both writes are conditional: the widening UPDATE only matches while the job is still pending with the
+        # payload it was read with (a worker claiming it in between makes it miss), and the unique index on pending
+        # jobs lets only one of two concurrent inserts succeed. Either way the lookup is repeated.
+        while True:
+            active = cls.query.filter(cls.job_type == job_type,
+                                      cls.subject_id == subject_id,
+                                      cls.status.in_([cls.QUEUED, cls.RUNNING])).order_by(cls.id).all()
+            for job in active:
+                current = job.get_payload()
+                if merge(current, payload) == merge(current, current):
+                    return job
+            pending = next((job for job in active if job.status == cls.QUEUED and job.attempts == 0), None)
+            if pending is not None:
+                merged = json.dumps(merge(pending.get_payload(), payload))
+                updated = cls.query.filter_by(id=pending.id, status=cls.QUEUED, attempts=0, payload=pending.payload) \
+                    .update({'payload': merged}, synchronize_session=False)
+                db.session.commit()
+                if updated:
+                    db.session.refresh(pending)
+                    logger.info(f'Job {pending.id} ({job_type}) of subject {subject_id} extended to {merged}')
+                    return pending
+                continue
+            job = cls(job_type=job_type, subject_id=subject_id, payload=payload)
+            db.session.add(job)
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # another request queued one in the meantime
+                db.session.rollback()
+                continue
+            logger.info(f'Job {job.id} ({job_type}) queued for subject {subject_id}')
+            return job
+
+    @classmethod
+    def claim_next(cls, worker_id: str):
+        # Claiming is a conditional UPDATE on the status column, so two workers polling the
+        # same queue can never both start the same job (works on PostgreSQL and SQLite).
+        cls.requeue_stale()
+        now = datetime.utcnow()
+        candidates = cls.query.with_entities(cls.id) \
+            .filter(cls.status == cls.QUEUED, cls.run_after <= now) \
+            .order_by(cls.run_after, cls.id) \
+            .limit(10) \
+            .all()
+        for (job_id,) in candidates:
+            claimed = cls.query.filter_by(id=job_id, status=cls.QUEUED).update({
+                'status': cls.RUNNING,
+                'attempts': cls.attempts + 1,
+                'locked_by': worker_id,
+                'started_at': now,
+                'updated_at': now,
+            }, synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return cls.find_by_id(job_id)
+        return None
+
+    @classmethod
+    def requeue_stale(cls):
+        # a worker that died mid-job leaves the job in RUNNING without further heartbeats
+        now = datetime.utcnow()
+        deadline = now - timedelta(seconds=JOB_STALE_AFTER)
+        stale = cls.query.filter(cls.status == cls.RUNNING, cls.updated_at < deadline)
+        failed = stale.filter(cls.attempts >= cls.max_attempts) \
+            .update({'status': cls.FAILED, 'locked_by': None, 'finished_at': now,
+                     'message': 'Worker stopped responding'}, synchronize_session=False)
+        requeued = stale.filter(cls.attempts < cls.max_attempts) \
+            .update({'status': cls.QUEUED, 'locked_by': None}, synchronize_session=False)
+        db.session.commit()
+        if failed or requeued:
+            logger.warning(f'Stale jobs: {requeued} requeued, {failed} failed')
+
+    @classmethod
+    def find_by_id(cls, _id):
+        return cls.query.filter_by(id=_id).first()
+
+    @classmethod
+    def find_by_subject_id(cls, subject_id):
+        return cls.query.filter_by(subject_id=subject_id).order_by(cls.id.desc()).all()
+
+
+def _isoformat(value: datetime):
+    return value.isoformat() + 'Z' if value else None
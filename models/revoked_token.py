@@ -0,0 +1,40 @@
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from db import db
+
+
+class RevokedTokenModel(db.Model):
+    # JWTs revoked by a logout, shared by all worker processes. Rows are only needed until the token expires.
+    __tablename__ = 'revoked_tokens'
+
+    jti = db.Column(db.String(36), primary_key=True)
+    expires_at = db.Column(db.Integer, nullable=False, index=True)
+
+    def __init__(self, jti: str, expires_at: int):
+        self.jti = jti
+        self.expires_at = expires_at
+
+    def save_to_db(self):
+        db.session.add(self)
+        db.session.commit()
+
+    @classmethod
+    def revoke(cls, jti: str, expires_at: int):
+        try:
+            cls(jti, expires_at).save_to_db()
+        except IntegrityError:
+            # revoked before
+            db.session.rollback()
+
+    @classmethod
+    def find_by_jti(cls, jti: str):
+        return cls.query.get(jti)
+
+    @classmethod
+    def purge_expired(cls) -> int:
+        # deletes the rows of tokens that have expired anyway, returns their number
+        purged = cls.query.filter(cls.expires_at < int(time.time())).delete(synchronize_session=False)
+        db.session.commit()
+        return purged
@@ -1,10 +1,41 @@
 from db import db
-import requests
 from constants import *
-from datetime import datetime
-import pandas as pd
+import time
+from typing import NamedTuple
 
 from logger import logger
+from strava_client import get_client
+from token_provider import get_access_token, forget as forget_tokens
+
+
+class ActivityRecord(NamedTuple):
+    # The fields of a Strava activity that are stored (see ActivityModel), as returned by
+    # SubjectModel.get_activities and SubjectModel.get_activity
+    id: int
+    athlete_id: int
+    distance: float
+    moving_time: int
+    total_elevation_gain: float
+    type: str
+    start_date: str
+    start_date_local: str
+
+    @classmethod
+    def from_strava(cls, activity: dict, strava_activity_id: int = None):
+        # from a SummaryActivity/DetailedActivity of the Strava API
+        return cls(int(activity['id'] if strava_activity_id is None else strava_activity_id),
+                   int(activity['athlete']['id']),
+                   float(activity['distance']),
+                   int(activity['moving_time']),
+                   float(activity['total_elevation_gain']),
+                   str(activity['type']),
+                   activity['start_date'],
+                   activity['start_date_local'])
+
+
+def parse_activity_page(page: list) -> list:
+    # The running activities of one page of /athlete/activities results
+    return [ActivityRecord.from_strava(a) for a in page if 'run' in str(a['type']).lower()]
 
 
 class SubjectModel(db.Model):
@@ -12,12 +43,18 @@ class SubjectModel(db.Model):
 
     id = db.Column(db.Integer, primary_key=True)
     subject_id = db.Column(db.String(4), unique=True, nullable=False)
-    strava_id = db.Column(db.Integer)
+    strava_id = db.Column(db.Integer, index=True)
     sex = db.Column(db.String(2))
     access_token = db.Column(db.String(80))
     refresh_token = db.Column(db.String(80))
     expires_at = db.Column(db.Integer)
 
+    # incremental sync: epoch of the latest start_date ingested and of the last successful sync
+    sync_cursor = db.Column(db.Integer)
+    last_synced_at = db.Column(db.Integer)
+    # incremented with every change of the subject's activities, see response_cache.py
+    data_version = db.Column(db.Integer, nullable=False, default=0)
+
     def __init__(self, subject_id, data):
         self.strava_id = data['athlete']['id']
         self.sex = data['athlete']['sex']
@@ -35,6 +72,9 @@ class SubjectModel(db.Model):
             'access_token': self.access_token,
             'refresh_token': self.refresh_token,
             'expires_at': self.expires_at,
+            'sync_cursor': self.sync_cursor,
+            'last_synced_at': self.last_synced_at,
+            'data_version': self.data_version,
         }
 
     def save_to_db(self):
@@ -44,69 +84,48 @@ class SubjectModel(db.Model):
     def delete_from_db(self):
         db.session.delete(self)
         db.session.commit()
+        forget_tokens(self.subject_id)
         logger.info(f'Subject {self.subject_id} deleted.')
 
-    def get_new_tokens(self):
+    def get_new_tokens(self, retries: int = None, timeout: tuple = None):
         # Make Strava auth API call with client_id, client_secret and code
-        response = requests.post(
-            url='https://www.strava.com/oauth/token',
+        response = get_client().post_token(
             data={
                 'client_id': CLIENT_ID,
                 'client_secret': CLIENT_SECRET,
                 'refresh_token': self.refresh_token,
                 'grant_type': 'refresh_token'
-            }
+            },
+            retries=retries,
+            timeout=timeout
         )
         data = response.json()
         return data['access_token'], data['refresh_token'], data['expires_at']
 
-    def refresh_tokens(self):
-        # Make Strava auth API call with client_id, client_secret and code
-        response = requests.post(
-            url='https://www.strava.com/oauth/token',
-            data={
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_SECRET,
-                'refresh_token': self.refresh_token,
-                'grant_type': 'refresh_token'
-            }
-        )
-        data = response.json()
-        self.access_token = data['access_token']
-        self.refresh_token = data['refresh_token']
-        self.expires_at = data['expires_at']
-        self.save_to_db()
-        return data['access_token']
+    def sync_window_start(self, full_resync: bool = False) -> int:
+        # Start of the activity window of a default sync: everything after the sync cursor, minus a small
+        # overlap for activities uploaded late (the bulk upsert skips the ones that already exist).
+        if full_resync or not self.sync_cursor:
+            return STUDY_START
+        return max(STUDY_START, self.sync_cursor - SYNC_CURSOR_OVERLAP)
+
+    def advance_sync_cursor(self, latest_start: int = None):
+        # Called once a sync has finished. Both values are written in one transaction on the locked row,
+        # and the cursor never moves backwards.
+        locked = SubjectModel.query.filter_by(id=self.id).with_for_update().populate_existing().one()
+        if latest_start is not None and (locked.sync_cursor or 0) < latest_start:
+            locked.sync_cursor = latest_start
+        locked.last_synced_at = int(time.time())
+        db.session.commit()
 
-    def get_activities(self, before: int = None, after: int = None):
-        if self.expires_at < datetime.now().timestamp():
-            self.refresh_tokens()
+    def get_activities(self, before: int = None, after: int = None, progress=None):
         if not after:
-            after = int(datetime(year=2021,
-                                 month=10,
-                                 day=22,
-                                 ).timestamp())
+            after = STUDY_START
         if not before:
-            before = int(datetime(year=2023,
-                                  month=1,
-                                  day=31,
-                                  ).timestamp())
-
-        # Create the dataframe ready for the API call to store your activity data
-        activities = pd.DataFrame(
-            columns=[
-                "id",
-                "athlete_id",
-                "distance",
-                "moving_time",
-                "total_elevation_gain",
-                "type",
-                "start_date",
-                "start_date_local"
-            ]
-        )
+            before = STUDY_END
+
+        activities = []
 
-        url = "https://www.strava.com/api/v3/athlete/activities"
         # Loop through all activities
         page = 1
 
@@ -119,10 +138,7 @@ class SubjectModel(db.Model):
                       'per_page': 200,
                       'page': str(page),
                       }
-            headers = {
-                'Authorization': f'Bearer {self.access_token}'
-            }
-            r = requests.get(url, params=params, headers=headers)
+            r = get_client().get('/athlete/activities', access_token=get_access_token(self), params=params)
             if r.status_code != 200:
                 logger.warning(f'Activites request returned {r.status_code}: {r.json}')
                 return None
@@ -131,44 +147,20 @@ class SubjectModel(db.Model):
             # if no results then exit loop
             if not r:
                 break
-            # otherwise add new data to dataframe
-            for x in range(len(r)):
-                if 'run' not in str(r[x]['type']).lower():
-                    continue
-                activities.loc[x + (page - 1) * 200, 'id'] = r[x]['id']
-                activities.loc[x + (page - 1) * 200, 'athlete_id'] = r[x]['athlete']['id']
-                activities.loc[x + (page - 1) * 200, 'distance'] = r[x]['distance']
-                activities.loc[x + (page - 1) * 200, 'moving_time'] = r[x]['moving_time']
-                activities.loc[x + (page - 1) * 200, 'total_elevation_gain'] = r[x]['total_elevation_gain']
-                activities.loc[x + (page - 1) * 200, 'type'] = r[x]['type']
-                activities.loc[x + (page - 1) * 200, 'start_date'] = r[x]['start_date']
-                activities.loc[x + (page - 1) * 200, 'start_date_local'] = r[x]['start_date_local']
+            # otherwise collect the running activities of this page
+            activities += parse_activity_page(r)
+            if progress:
+                progress(page, len(activities))
             # increment page
             page += 1
         return activities
 
     def get_activity(self, strava_activity_id):
-        if self.expires_at < datetime.now().timestamp():
-            self.refresh_tokens()
-        url = f'https://www.strava.com/api/v3/activities/{strava_activity_id}'
-        params = {'access_token': self.access_token,
-                  'include_all_efforts': 'false',
-                  }
-        r = requests.get(url, params=params)
+        params = {'include_all_efforts': 'false'}
+        r = get_client().get(f'/activities/{strava_activity_id}', access_token=get_access_token(self), params=params)
         if r.status_code != 200:
             return None
-        r = r.json()
-        activity = {
-            "id": strava_activity_id,
-            "athlete_id": r['athlete']['id'],
-            "distance": r['distance'],
-            "moving_time": r['moving_time'],
-            "total_elevation_gain": r['total_elevation_gain'],
-            "type": r['type'],
-            "start_date": r['start_date'],
-            "start_date_local": r['start_date_local']
-        }
-        return pd.DataFrame(activity, index=[0])
+        return ActivityRecord.from_strava(r.json(), strava_activity_id=strava_activity_id)
 
     @classmethod
     def find_by_id(cls, _id):
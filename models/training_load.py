@@ -0,0 +1,171 @@
+from collections import defaultdict
+from datetime import date, timedelta
+
+from sqlalchemy import case, func
+
+from constants import ACWR_ACUTE_DAYS, ACWR_CHRONIC_DAYS
+from db import db
+
+LOAD_COLUMNS = ['activities', 'distance', 'moving_time', 'elevation_gain']
+
+
+def load_delta(subject_id: str, start_date_local, distance, moving_time, elevation_gain, sign: int = 1) -> dict:
+    # {(subject_id, day): values} of one activity, sign=-1 to remove it again
+    if start_date_local is None:
+        return {}
+    return {(str(subject_id), start_date_local.date()): [sign, sign * float(distance or 0),
+                                                         sign * int(moving_time or 0),
+                                                         sign * float(elevation_gain or 0)]}
+
+
+def merge_deltas(deltas) -> dict:
+    merged = defaultdict(lambda: [0, 0.0, 0, 0.0])
+    for delta in deltas:
+        for key, values in delta.items():
+            merged[key] = [a + b for a, b in zip(merged[key], values)]
+    return {key: values for key, values in merged.items() if any(values)}
+
+
+class TrainingLoadModel(db.Model):
+    # Daily training load per subject (by the athlete's local date), materialized from the activities and kept
+    # up to date with deltas whenever activities are added, changed or deleted (see ActivityModel).
+    # Rolling windows (weeks, acute:chronic workload ratio) are sums over a few of these rows.
+    __tablename__ = 'training_load_daily'
+
+    subject_id = db.Column(db.String, primary_key=True)
+    day = db.Column(db.Date, primary_key=True, index=True)
+    activities = db.Column(db.Integer, nullable=False, default=0)
+    distance = db.Column(db.Float, nullable=False, default=0)
+    moving_time = db.Column(db.BigInteger, nullable=False, default=0)
+    elevation_gain = db.Column(db.Float, nullable=False, default=0)
+
+    def json(self):
+        return {
+            'subject_id': self.subject_id,
+            'day': self.day.isoformat(),
+            'activities': self.activities,
+            'distance': self.distance,
+            'moving_time': self.moving_time,
+            'elevation_gain': self.elevation_gain,
+        }
+
+    @classmethod
+    def apply_deltas(cls, deltas: dict):
+        # Adds the deltas to the daily rows in one upsert (col = col + delta), so concurrent updates of the same
+        # day add up. Executed in the current transaction, the caller commits together with the activities.
+        if not deltas:
+            return
+        rows = [dict(subject_id=subject_id, day=day, **dict(zip(LOAD_COLUMNS, values)))
+                for (subject_id, day), values in deltas.items()]
+        dialect = db.engine.dialect.name
+        if dialect in ('postgresql', 'sqlite'):
+            if dialect == 'postgresql':
+                from sqlalchemy.dialects.postgresql import insert
+            else:
+                from sqlalchemy.dialects.sqlite import insert
+            statement = insert(cls.__table__).values(rows)
+            statement = statement.on_conflict_do_update(
+                index_elements=['subject_id', 'day'],
+                set_={column: cls.__table__.c[column] + statement.excluded[column] for column in LOAD_COLUMNS})
+            db.session.execute(statement)
+        else:
+            for row in rows:
+                load = cls.query.get((row['subject_id'], row['day']))
+                if load is None:
+                    load = cls(subject_id=row['subject_id'], day=row['day'], activities=0, distance=0,
+                               moving_time=0, elevation_gain=0)
+                    db.session.add(load)
+                for column in LOAD_COLUMNS:
+                    setattr(load, column, getattr(load, column) + row[column])
+            db.session.flush()
+        # days without activities left
+        for subject_id, days in _days_by_subject(deltas).items():
+            cls.query.filter(cls.subject_id == subject_id, cls.day.in_(days), cls.activities <= 0) \
+                .delete(synchronize_session=False)
+
+    @classmethod
+    def recompute_days(cls, subject_id: str, days: list):
+        # exact values of some days of a subject, computed from the activities
+        from models.activity import ActivityModel
+        days = sorted(set(days))
+        cls.query.filter(cls.subject_id == subject_id, cls.day.in_(days)).delete(synchronize_session=False)
+        activities = db.session.query(ActivityModel.subject_id, ActivityModel.start_date_local,
+                                      ActivityModel.distance, ActivityModel.moving_time,
+                                      ActivityModel.total_elevation_gain) \
+            .filter(ActivityModel.subject_id == subject_id,
+                    ActivityModel.start_date_local >= days[0],
+                    ActivityModel.start_date_local < days[-1] + timedelta(days=1))
+        deltas = merge_deltas(load_delta(*activity) for activity in activities)
+        cls._insert({key: values for key, values in deltas.items() if key[1] in days})
+
+    @classmethod
+    def rebuild(cls, subject_id: str = None):
+        # recomputes the whole table (or a subject's rows) from the activities, e.g. after a restore
+        from models.activity import ActivityModel
+        query = cls.query
+        activities = db.session.query(ActivityModel.subject_id, ActivityModel.start_date_local,
+                                      ActivityModel.distance, ActivityModel.moving_time,
+                                      ActivityModel.total_elevation_gain)
+        if subject_id is not None:
+            query = query.filter_by(subject_id=subject_id)
+            activities = activities.filter(ActivityModel.subject_id == subject_id)
+        query.delete(synchronize_session=False)
+        deltas = merge_deltas(load_delta(*activity) for activity in activities.yield_per(1000))
+        cls._insert(deltas)
+        db.session.commit()
+        return len(deltas)
+
+    @classmethod
+    def _insert(cls, deltas: dict):
+        if deltas:
+            db.session.execute(cls.__table__.insert(), [
+                dict(subject_id=subject_id, day=day, **dict(zip(LOAD_COLUMNS, values)))
+                for (subject_id, day), values in deltas.items()])
+
+    @classmethod
+    def find_by_subject_id(cls, subject_id: str, after: date = None, before: date = None):
+        query = cls.query.filter_by(subject_id=subject_id)
+        if after is not None:
+            query = query.filter(cls.day >= after)
+        if before is not None:
+            query = query.filter(cls.day < before)
+        return query.order_by(cls.day).all()
+
+    @classmethod
+    def rolling_windows(cls, day: date) -> list:
+        # Acute (last ACWR_ACUTE_DAYS days) and chronic (last ACWR_CHRONIC_DAYS days) load of all subjects up to
+        # and including day, in one aggregate query over the daily rows of the chronic window.
+        acute_start = day - timedelta(days=ACWR_ACUTE_DAYS - 1)
+        chronic_start = day - timedelta(days=ACWR_CHRONIC_DAYS - 1)
+        acute = {column: func.sum(case((cls.day >= acute_start, getattr(cls, column)), else_=0))
+                 for column in LOAD_COLUMNS}
+        chronic = {column: func.sum(getattr(cls, column)) for column in LOAD_COLUMNS}
+        rows = db.session.query(cls.subject_id, *acute.values(), *chronic.values()) \
+            .filter(cls.day >= chronic_start, cls.day <= day) \
+            .group_by(cls.subject_id) \
+            .order_by(cls.subject_id) \
+            .all()
+        # the chronic load is the average load of an acute window within the chronic window
+        windows_per_chronic = ACWR_CHRONIC_DAYS / ACWR_ACUTE_DAYS
+        result = []
+        for row in rows:
+            acute_values = dict(zip(LOAD_COLUMNS, row[1:1 + len(LOAD_COLUMNS)]))
+            chronic_values = {column: value / windows_per_chronic
+                              for column, value in zip(LOAD_COLUMNS, row[1 + len(LOAD_COLUMNS):])}
+            result.append({
+                'subject_id': row[0],
+                'acute': acute_values,
+                'chronic': chronic_values,
+                'acwr_distance': acute_values['distance'] / chronic_values['distance']
+                if chronic_values['distance'] else None,
+                'acwr_moving_time': acute_values['moving_time'] / chronic_values['moving_time']
+                if chronic_values['moving_time'] else None,
+            })
+        return result
+
+
+def _days_by_subject(deltas: dict) -> dict:
+    days = defaultdict(list)
+    for subject_id, day in deltas.keys():
+        days[subject_id].append(day)
+    return days
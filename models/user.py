@@ -5,7 +5,7 @@ class UserModel(db.Model):
     __tablename__ = 'users'
 
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80))
+    username = db.Column(db.String(80), index=True)
     password = db.Column(db.String(80))
 
     def __init__(self, username, password):
@@ -0,0 +1,142 @@
+import json
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from db import db
+from constants import WEBHOOK_EVENT_RETENTION, WEBHOOK_MAX_ATTEMPTS, JOB_RETRY_BACKOFF, JOB_STALE_AFTER
+from logger import logger
+
+
+class WebhookEventModel(db.Model):
+    # Strava webhook events as received, processed later by webhook_processor.py.
+    # Strava retries deliveries it considers failed, the unique constraint drops the duplicates.
+    __tablename__ = 'webhook_events'
+    __table_args__ = (db.UniqueConstraint('object_id', 'aspect_type', 'event_time', name='uq_webhook_event'),)
+
+    PENDING = 'pending'
+    PROCESSING = 'processing'
+    PROCESSED = 'processed'
+
+    id = db.Column(db.Integer, primary_key=True)
+    object_type = db.Column(db.String(20), nullable=False)
+    object_id = db.Column(db.BigInteger, nullable=False)
+    aspect_type = db.Column(db.String(20), nullable=False)
+    owner_id = db.Column(db.BigInteger)
+    subscription_id = db.Column(db.Integer)
+    event_time = db.Column(db.Integer, nullable=False)
+    updates = db.Column(db.Text)
+
+    status = db.Column(db.String(20), nullable=False, index=True)
+    locked_by = db.Column(db.String(80))
+    received_at = db.Column(db.DateTime, nullable=False)
+    claimed_at = db.Column(db.DateTime)
+    processed_at = db.Column(db.DateTime, index=True)
+    # failed attempts to apply the event, the next one is not made before run_after
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_after = db.Column(db.DateTime)
+    message = db.Column(db.String(255))
+
+    def __init__(self, event_data: dict):
+        self.object_type = event_data['object_type']
+        self.object_id = event_data['object_id']
+        self.aspect_type = event_data['aspect_type']
+        self.owner_id = event_data['owner_id']
+        self.subscription_id = event_data['subscription_id']
+        self.event_time = event_data['event_time']
+        self.updates = json.dumps(event_data.get('updates') or {})
+        self.status = self.PENDING
+        self.attempts = 0
+        self.received_at = datetime.utcnow()
+
+    def json(self):
+        return {
+            'id': self.id,
+            'object_type': self.object_type,
+            'object_id': self.object_id,
+            'aspect_type': self.aspect_type,
+            'owner_id': self.owner_id,
+            'subscription_id': self.subscription_id,
+            'event_time': self.event_time,
+            'updates': json.loads(self.updates) if self.updates else {},
+        }
+
+    def save_to_db(self):
+        db.session.add(self)
+        db.session.commit()
+
+    @classmethod
+    def record(cls, event_data: dict) -> bool:
+        # Store a received event. Returns False if the same event has been received before.
+        try:
+            cls(event_data).save_to_db()
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        return True
+
+    @classmethod
+    def find_pending(cls, limit: int):
+        # Events of objects with an event waiting for its retry are left out, so that the events of an object
+        # are still applied together and in order once the retry is due.
+        waiting = aliased(cls)
+        retry_not_due = db.session.query(waiting.id).filter(waiting.object_type == cls.object_type,
+                                                            waiting.object_id == cls.object_id,
+                                                            waiting.status == cls.PENDING,
+                                                            waiting.run_after > datetime.utcnow())
+        return cls.query.filter(cls.status == cls.PENDING, ~retry_not_due.exists()) \
+            .order_by(cls.event_time, cls.id).limit(limit).all()
+
+    @classmethod
+    def claim(cls, ids: list, worker_id: str) -> bool:
+        # conditional update, so that events are never processed by two workers
+        claimed = cls.query.filter(cls.id.in_(ids), cls.status == cls.PENDING) \
+            .update({'status': cls.PROCESSING, 'locked_by': worker_id, 'claimed_at': datetime.utcnow()},
+                    synchronize_session=False)
+        if claimed != len(ids):
+            db.session.rollback()
+            return False
+        db.session.commit()
+        return True
+
+    @classmethod
+    def mark_processed(cls, ids: list):
+        cls.query.filter(cls.id.in_(ids)) \
+            .update({'status': cls.PROCESSED, 'locked_by': None, 'processed_at': datetime.utcnow()},
+                    synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def mark_failed(cls, ids: list, error):
+        # Back to pending, retried with exponential backoff: JOB_RETRY_BACKOFF, 2 * JOB_RETRY_BACKOFF, ...
+        # Events that have failed WEBHOOK_MAX_ATTEMPTS times are given up on and marked processed.
+        now = datetime.utcnow()
+        for event in cls.query.filter(cls.id.in_(ids)):
+            event.attempts = (event.attempts or 0) + 1
+            event.message = str(error)[:255]
+            event.locked_by = None
+            if event.attempts < WEBHOOK_MAX_ATTEMPTS:
+                event.status = cls.PENDING
+                event.run_after = now + timedelta(seconds=JOB_RETRY_BACKOFF * 2 ** (event.attempts - 1))
+            else:
+                event.status = cls.PROCESSED
+                event.processed_at = now
+                logger.error(f'Webhook event {event.id} ({event.aspect_type} of {event.object_type} '
+                             f'{event.object_id}) failed after {event.attempts} attempts: {error}')
+        db.session.commit()
+
+    @classmethod
+    def requeue_stale(cls):
+        deadline = datetime.utcnow() - timedelta(seconds=JOB_STALE_AFTER)
+        cls.query.filter(cls.status == cls.PROCESSING, cls.claimed_at < deadline) \
+            .update({'status': cls.PENDING, 'locked_by': None}, synchronize_session=False)
+        db.session.commit()
+
+    @classmethod
+    def purge_processed(cls):
+        # processed events are only kept for deduplicating late retries by Strava
+        deadline = datetime.utcnow() - timedelta(seconds=WEBHOOK_EVENT_RETENTION)
+        cls.query.filter(cls.status == cls.PROCESSED, cls.processed_at < deadline) \
+            .delete(synchronize_session=False)
+        db.session.commit()
@@ -0,0 +1,67 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from sqlalchemy import DateTime, and_, false, or_
+
+DEFAULT_PAGE_SIZE = 200
+MAX_PAGE_SIZE = 1000
+# rows fetched from the db cursor at a time
+YIELD_PER = 100
+
+
+def encode_cursor(values: list) -> str:
+    values = [value.isoformat() if isinstance(value, datetime) else value for value in values]
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+
+def decode_cursor(token: str, columns: list) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (binascii.Error, ValueError):
+        raise ValueError('Invalid page token.')
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('Invalid page token.')
+    return [datetime.fromisoformat(value) if isinstance(column.type, DateTime) and value is not None else value
+            for column, value in zip(columns, values)]
+
+
+def _order(column):
+    # NULLs (e.g. activities without a start date) sort after all values, as PostgreSQL does by default
+    return column.asc().nulls_last() if column.nullable else column
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _greater(column, value):
+    # rows ordered after value in the column, see _order
+    if value is None:
+        return false()
+    return or_(column > value, column.is_(None)) if column.nullable else column > value
+
+
+def _after(columns: list, values: list):
+    # lexicographic (c1, c2, ...) > (v1, v2, ...), spelled out because not every database has row values
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        equal = [_equal(c, v) for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*equal, _greater(column, value)))
+    return or_(*clauses)
+
+
+def paginate(query, columns: list, limit: int = DEFAULT_PAGE_SIZE, token: str = None):
+    # Keyset pagination: rows are ordered by columns (whose last one has to be unique, e.g. the primary key)
+    # and the next page starts after the last row of this one, so no page costs more than limit rows.
+    # Returns the rows of the page and the token of the next page (None on the last page).
+    limit = max(1, min(limit or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE))
+    if token:
+        query = query.filter(_after(columns, decode_cursor(token, columns)))
+    rows = list(query.order_by(*(_order(column) for column in columns)).limit(limit + 1).yield_per(YIELD_PER))
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    last = rows[-1]
+    return rows, encode_cursor([getattr(last, column.key) for column in columns])
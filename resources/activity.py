@@ -1,14 +1,24 @@
 from logger import logger
 
-from flask import jsonify, make_response
-from flask_restful import Resource, reqparse
+from flask import Response
+from flask_restful import Resource, reqparse, inputs
 from flask_jwt_extended import jwt_required
 
 from models.activity import ActivityModel
 from models.subject import SubjectModel
+from pagination import paginate, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from response_cache import etag_for, request_args, not_modified, cache_headers, data_version, cached_body, caching
+from stream_store import read_streams, window_rows, downsample, iter_json, iter_ndjson, iter_binary
+from tasks import enqueue_sync
+from token_provider import get_access_token
 
 from datetime import datetime
-import pandas as pd
+
+STREAM_FORMATS = {
+    'json': (iter_json, 'application/json'),
+    'ndjson': (iter_ndjson, 'application/x-ndjson'),
+    'binary': (iter_binary, 'application/octet-stream'),
+}
 
 
 class ActivitiesById(Resource):
@@ -23,13 +33,19 @@ class ActivitiesById(Resource):
                         required=False,
                         help="An epoch timestamp to use for filtering activities that have taken place "
                              "before a certain time.")
+    parser.add_argument('full_resync',
+                        type=inputs.boolean,
+                        required=False,
+                        default=False,
+                        help="Sync the whole study period instead of only the activities after the last sync.")
 
     @jwt_required()
     def get(self, strava_activity_id):
         activity = ActivityModel.find_by_strava_id(strava_activity_id)
-        if activity:
-            return activity.json()
-        return {"message": "Activity not found."}, 404
+        if not activity:
+            return {"message": "Activity not found."}, 404
+        etag = etag_for('activity', activity.id, data_version(activity.subject_id))
+        return not_modified(etag) or (activity.json(), 200, cache_headers(etag))
 
     @jwt_required()
     def put(self, strava_activity_id):
@@ -37,9 +53,7 @@ class ActivitiesById(Resource):
         if not activity:
             return {"message": "Activity not found."}, 404
         subject = SubjectModel.find_by_subject_id(activity.subject_id)
-        if subject.expires_at < datetime.now().timestamp():
-            subject.refresh_tokens()
-        if not activity.get_stream_data(access_token=subject.access_token):
+        if not activity.get_stream_data(access_token=get_access_token(subject)):
             return {"message": "Could not download activity stream data."}, 404
         return activity.json()
 
@@ -54,38 +68,139 @@ class ActivitiesById(Resource):
 
 
 class SubjectActivities(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('after',
+                        type=int,
+                        location='args',
+                        help="An epoch timestamp, only activities starting at or after this time are returned.")
+    parser.add_argument('before',
+                        type=int,
+                        location='args',
+                        help="An epoch timestamp, only activities starting before this time are returned.")
+    parser.add_argument('type',
+                        type=str,
+                        location='args',
+                        help="Only return activities of this type, e.g. Run or TrailRun.")
+    parser.add_argument('limit',
+                        type=int,
+                        location='args',
+                        default=DEFAULT_PAGE_SIZE,
+                        help=f"Number of activities per page (at most {MAX_PAGE_SIZE}).")
+    parser.add_argument('next',
+                        type=str,
+                        location='args',
+                        help="Token of the next page, as returned in the previous response.")
+
     @jwt_required()
     def get(self, subject_id):
         subject = SubjectModel.find_by_subject_id(subject_id)
         if not subject:
             return {'message': f'Subject with subject_id {subject_id} not found.'}, 400
-        return {'activities': [activity.json() for activity in ActivityModel.find_by_subject_id(subject_id)]}
+        args = SubjectActivities.parser.parse_args()
+        etag = etag_for('activities', subject_id, subject.data_version, request_args())
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        query = ActivityModel.query_by_subject_id(
+            subject_id,
+            after=datetime.utcfromtimestamp(args['after']) if args['after'] is not None else None,
+            before=datetime.utcfromtimestamp(args['before']) if args['before'] is not None else None,
+            activity_type=args['type'])
+        try:
+            activities, next_token = paginate(query,
+                                              [ActivityModel.start_date, ActivityModel.id],
+                                              limit=args['limit'],
+                                              token=args['next'])
+        except ValueError as err:
+            return {'message': str(err)}, 400
+        return {'activities': [activity.json() for activity in activities], 'next': next_token}, 200, \
+            cache_headers(etag)
 
     @jwt_required()
     def put(self, subject_id: str):
         args = ActivitiesById.parser.parse_args()
         before = args['before']
         after = args['after']
+        full_resync = args['full_resync']
 
         subject = SubjectModel.find_by_subject_id(subject_id)
         if not subject:
             return {"message": "Subject not found."}, 400
-        df_activities = subject.get_activities(before=before, after=after)
-        if df_activities is None:
-            return {'message': 'No activities found'}, 404
-        logger.info(f'Found {len(df_activities)} activities')
-        ActivityModel.get_all(df_activities=df_activities, subject=subject)
-        return {'activities': [activity.json() for activity in ActivityModel.find_by_subject_id(subject_id)]}, 200
+        # the sync itself runs in the background worker (worker.py), see tasks.sync_activities
+        job = enqueue_sync(subject, after=after, before=before, full_resync=full_resync)
+        return {'job': job.json()}, 202, {'Location': f'/api/jobs/{job.id}'}
 
 
 class ActivityStreamData(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('keys',
+                        type=str,
+                        location='args',
+                        help="Comma separated list of streams to return, e.g. heartrate,time. Default: all.")
+    parser.add_argument('time_from', type=float, location='args')
+    parser.add_argument('time_to', type=float, location='args')
+    parser.add_argument('distance_from', type=float, location='args')
+    parser.add_argument('distance_to', type=float, location='args')
+    parser.add_argument('format',
+                        type=str,
+                        location='args',
+                        default='json',
+                        choices=list(STREAM_FORMATS.keys()),
+                        help="One of json (columnar arrays), ndjson (one object per sample) or binary.")
+    parser.add_argument('max_points',
+                        type=int,
+                        location='args',
+                        help="Return at most this many samples, downsampled to preserve the shape of the streams.")
+
     @jwt_required()
     def get(self, strava_activity_id):
         logger.info(f'Stream data requested for activity with id: {strava_activity_id}')
         activity = ActivityModel.find_by_strava_id(strava_activity_id)
-        if activity:
-            if not activity.stream_file_path:
-                return {"message": "No stream file for activity."}, 404
-            df = pd.read_csv(activity.stream_file_path)
-            return make_response(jsonify(df.to_dict()), 200)
-        return {"message": "Activity not found."}, 404
+        if not activity:
+            return {"message": "Activity not found."}, 404
+        if not activity.stream_file_path:
+            return {"message": "No stream file for activity."}, 404
+        args = ActivityStreamData.parser.parse_args()
+        # the same request returns the same bytes until the subject's data changes
+        etag = etag_for('stream', activity.id, data_version(activity.subject_id), activity.stream_file_path,
+                        request_args())
+        response = not_modified(etag)
+        if response is not None:
+            return response
+        serialise, mimetype = STREAM_FORMATS[args['format']]
+        body = cached_body(etag)
+        if body is not None:
+            return Response(body, mimetype=mimetype, headers=cache_headers(etag))
+
+        keys = None
+        if args['keys']:
+            keys = set(key.strip() for key in args['keys'].split(',') if key.strip())
+            if 'latlng' in keys:
+                keys |= {'lat', 'lng'}
+        # the window columns are needed even when they are not requested
+        window_keys = {'time'} if args['time_from'] is not None or args['time_to'] is not None else set()
+        if args['distance_from'] is not None or args['distance_to'] is not None:
+            window_keys.add('distance')
+        columns = read_streams(activity.stream_file_path, keys=None if keys is None else keys | window_keys)
+        if keys is not None:
+            missing = keys - set(columns.keys()) - {'latlng'}
+            if missing:
+                return {"message": f"Streams not available for activity: {', '.join(sorted(missing))}"}, 400
+
+        # intersection of the requested time and distance windows
+        windows = dict()
+        for key in sorted(window_keys):
+            if key not in columns:
+                return {"message": f"No {key} stream to select a window on."}, 400
+            windows[key] = (args[f'{key}_from'], args[f'{key}_to'])
+        rows = window_rows(columns, windows)
+        if args['max_points'] is not None:
+            if args['max_points'] < 1:
+                return {"message": "max_points has to be positive."}, 400
+            columns, rows = downsample(activity.stream_file_path, columns, rows, args['max_points'], windows)
+        if keys is not None:
+            columns = {key: values for key, values in columns.items() if key in keys}
+
+        return Response(caching(serialise(columns, rows), etag, activity.subject_id),
+                        mimetype=mimetype,
+                        headers=cache_headers(etag))
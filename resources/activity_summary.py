@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from flask_restful import Resource, reqparse
+from flask_jwt_extended import jwt_required
+
+from models.activity import ActivityModel
+from models.activity_summary import ActivitySummaryModel
+from models.subject import SubjectModel
+from pagination import paginate, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+
+
+class ActivitySummary(Resource):
+    @jwt_required()
+    def get(self, strava_activity_id):
+        activity = ActivityModel.find_by_strava_id(strava_activity_id)
+        if not activity:
+            return {"message": "Activity not found."}, 404
+        if not activity.summary:
+            return {"message": "No summary for activity, its streams have not been downloaded yet."}, 404
+        return activity.summary.json()
+
+
+class SubjectActivitySummaries(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('after',
+                        type=int,
+                        location='args',
+                        help="An epoch timestamp, only activities starting at or after this time are returned.")
+    parser.add_argument('before',
+                        type=int,
+                        location='args',
+                        help="An epoch timestamp, only activities starting before this time are returned.")
+    parser.add_argument('limit',
+                        type=int,
+                        location='args',
+                        default=DEFAULT_PAGE_SIZE,
+                        help=f"Number of summaries per page (at most {MAX_PAGE_SIZE}).")
+    parser.add_argument('next',
+                        type=str,
+                        location='args',
+                        help="Token of the next page, as returned in the previous response.")
+
+    @jwt_required()
+    def get(self, subject_id):
+        if not SubjectModel.find_by_subject_id(subject_id):
+            return {'message': f'Subject with subject_id {subject_id} not found.'}, 400
+        args = SubjectActivitySummaries.parser.parse_args()
+        query = ActivitySummaryModel.query_by_subject_id(
+            subject_id,
+            after=datetime.utcfromtimestamp(args['after']) if args['after'] is not None else None,
+            before=datetime.utcfromtimestamp(args['before']) if args['before'] is not None else None)
+        try:
+            summaries, next_token = paginate(query,
+                                             [ActivitySummaryModel.start_date, ActivitySummaryModel.activity_id],
+                                             limit=args['limit'],
+                                             token=args['next'])
+        except ValueError as err:
+            return {'message': str(err)}, 400
+        return {'summaries': [summary.json() for summary in summaries], 'next': next_token}
@@ -0,0 +1,47 @@
+from flask import Response, request, stream_with_context
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required
+
+from export import StudyExport
+from logger import logger
+from models.subject import SubjectModel
+
+
+def export_response(export: StudyExport) -> Response:
+    # The archive as a streamed download. A single byte range is served as 206 Partial Content, so clients can
+    # resume (e.g. curl -C -); with If-Range the range is only honoured if the archive is still the same.
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{export.etag}"',
+        'Content-Disposition': f'attachment; filename={export.filename}',
+    }
+    start, stop, status = 0, export.size, 200
+    if_range = request.if_range
+    if request.range is not None and len(request.range.ranges) == 1 \
+            and if_range.date is None and if_range.etag in (None, export.etag):
+        byte_range = request.range.range_for_length(export.size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{export.size}'})
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{export.size}'
+    headers['Content-Length'] = str(stop - start)
+    logger.info(f'Export {export.filename}: bytes {start}-{stop - 1} of {export.size}')
+    return Response(stream_with_context(export.iter_bytes(start, stop)),
+                    status=status,
+                    headers=headers,
+                    mimetype='application/x-tar')
+
+
+class StudyExportArchive(Resource):
+    @jwt_required()
+    def get(self):
+        return export_response(StudyExport())
+
+
+class SubjectExportArchive(Resource):
+    @jwt_required()
+    def get(self, subject_id: str):
+        if not SubjectModel.find_by_subject_id(subject_id):
+            return {"message": f"Subject with subject_id {subject_id} not found."}, 404
+        return export_response(StudyExport(subject_id))
@@ -0,0 +1,22 @@
+from flask_restful import Resource
+from flask_jwt_extended import jwt_required
+
+from models.job import JobModel
+from models.subject import SubjectModel
+
+
+class Job(Resource):
+    @jwt_required()
+    def get(self, job_id: int):
+        job = JobModel.find_by_id(job_id)
+        if job:
+            return job.json()
+        return {"message": "Job not found."}, 404
+
+
+class SubjectJobs(Resource):
+    @jwt_required()
+    def get(self, subject_id: str):
+        if not SubjectModel.find_by_subject_id(subject_id):
+            return {'message': f'Subject with subject_id {subject_id} not found.'}, 400
+        return {'jobs': [job.json() for job in JobModel.find_by_subject_id(subject_id)]}
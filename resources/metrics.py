@@ -0,0 +1,12 @@
+from flask import Response
+from flask_restful import Resource
+from prometheus_client import CONTENT_TYPE_LATEST
+
+from metrics import exposition
+
+
+class Metrics(Resource):
+    # Prometheus scrape endpoint. Not behind jwt_required since scrapers cannot log in,
+    # restrict access to it in the nginx config instead.
+    def get(self):
+        return Response(exposition(), content_type=CONTENT_TYPE_LATEST)
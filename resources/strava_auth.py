@@ -1,8 +1,8 @@
 from flask_restful import Resource, reqparse
 from flask import make_response, render_template, redirect, url_for
-import requests
 from constants import *
 from logger import logger
+from strava_client import get_client
 
 from models.subject import SubjectModel
 
@@ -19,7 +19,7 @@ class StravaAuth(Resource):
         logger.info(f'Subject {subject_id} gave authorization.')
 
         parser_data = StravaAuth.parser.parse_args()
-        logger.debug(parser_data)
+        logger.debug(f'Authorization scope: {parser_data["scope"]}')
         subject = SubjectModel.find_by_subject_id(subject_id)
         if subject:
             logger.warning(f'Subject {subject_id} already in database. Try adding manually.')
@@ -27,7 +27,7 @@ class StravaAuth(Resource):
 
         if parser_data['code']:
             athlete_data = self.get_tokens(code=parser_data['code'])
-            logger.debug(f'athlete_data: {athlete_data}.')
+            logger.debug(f'Tokens received for subject {subject_id}.')
             # todo: check what happens if code is invalid!
             new_subject = SubjectModel(subject_id, athlete_data)
             new_subject.save_to_db()
@@ -36,14 +36,15 @@ class StravaAuth(Resource):
 
     def get_tokens(self, code):
         # Make Strava auth API call with client_id, client_secret and code
-        response = requests.post(
-            url='https://www.strava.com/oauth/token',
+        response = get_client().post_token(
             data={
                 'client_id': CLIENT_ID,
                 'client_secret': CLIENT_SECRET,
                 'code': code,
                 'grant_type': 'authorization_code'
-            }
+            },
+            # this runs inside the request, keep it well below the uwsgi harakiri timeout
+            retries=1
         )
         if response.status_code == 200:
             return response.json()
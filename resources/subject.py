@@ -3,6 +3,8 @@ from flask_jwt_extended import jwt_required
 
 from logger import logger
 from models.subject import SubjectModel
+from pagination import paginate, DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE
+from token_provider import refresh_access_token
 
 
 class Subject(Resource):
@@ -32,7 +34,7 @@ class Subject(Resource):
     def get(self, subject_id: str):
         subject = SubjectModel.find_by_subject_id(subject_id)
         if subject:
-            logger.info(f'Subject requested: {subject.json()}')
+            logger.info(f'Subject {subject_id} requested')
             return subject.json()
         return {"message": "Item not found."}, 404
 
@@ -66,14 +68,10 @@ class Subject(Resource):
         if not subject:
             return {'message': f'Subject with subject_id {subject_id} not found.'}, 400
 
-        access_token, refresh_token, expires_at = subject.get_new_tokens()
-        subject.access_token = access_token
-        subject.refresh_token = refresh_token
-        subject.expires_at = expires_at
-
         try:
-            subject.save_to_db()
+            refresh_access_token(subject, force=True)
         except Exception as err:
+            logger.exception(err)
             return {"message": "An error occurred inserting the subject."}, 500
 
         return subject.json(), 201
@@ -88,6 +86,24 @@ class Subject(Resource):
 
 
 class SubjectList(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('limit',
+                        type=int,
+                        location='args',
+                        default=DEFAULT_PAGE_SIZE,
+                        help=f"Number of subjects per page (at most {MAX_PAGE_SIZE}).")
+    parser.add_argument('next',
+                        type=str,
+                        location='args',
+                        help="Token of the next page, as returned in the previous response.")
+
     @jwt_required()
     def get(self):
-        return {'subjects': [x.json() for x in SubjectModel.find_all()]}
\ No newline at end of file
+        args = SubjectList.parser.parse_args()
+        try:
+            subjects, next_token = paginate(SubjectModel.query, [SubjectModel.id],
+                                            limit=args['limit'],
+                                            token=args['next'])
+        except ValueError as err:
+            return {'message': str(err)}, 400
+        return {'subjects': [x.json() for x in subjects], 'next': next_token}
\ No newline at end of file
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+from flask_restful import Resource, reqparse, inputs
+from flask_jwt_extended import jwt_required
+
+from constants import ACWR_ACUTE_DAYS, ACWR_CHRONIC_DAYS
+from models.subject import SubjectModel
+from models.training_load import TrainingLoadModel, LOAD_COLUMNS
+
+
+class TrainingLoad(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('date',
+                        type=inputs.date,
+                        location='args',
+                        help="Last day of the windows as YYYY-MM-DD (athletes' local dates). Default: today.")
+
+    @jwt_required()
+    def get(self):
+        # acute and chronic load and the acute:chronic workload ratio of all subjects
+        args = TrainingLoad.parser.parse_args()
+        day = (args['date'] or datetime.utcnow()).date()
+        return {
+            'date': day.isoformat(),
+            'acute_days': ACWR_ACUTE_DAYS,
+            'chronic_days': ACWR_CHRONIC_DAYS,
+            'subjects': TrainingLoadModel.rolling_windows(day),
+        }
+
+
+class SubjectTrainingLoad(Resource):
+    parser = reqparse.RequestParser()
+    parser.add_argument('after',
+                        type=inputs.date,
+                        location='args',
+                        help="First day as YYYY-MM-DD.")
+    parser.add_argument('before',
+                        type=inputs.date,
+                        location='args',
+                        help="Only days before this one (YYYY-MM-DD) are returned.")
+    parser.add_argument('period',
+                        type=str,
+                        location='args',
+                        default='day',
+                        choices=['day', 'week'],
+                        help="day or week (weeks start on Monday).")
+
+    @jwt_required()
+    def get(self, subject_id: str):
+        if not SubjectModel.find_by_subject_id(subject_id):
+            return {'message': f'Subject with subject_id {subject_id} not found.'}, 400
+        args = SubjectTrainingLoad.parser.parse_args()
+        days = TrainingLoadModel.find_by_subject_id(
+            subject_id,
+            after=args['after'].date() if args['after'] else None,
+            before=args['before'].date() if args['before'] else None)
+        if args['period'] == 'day':
+            return {'period': 'day', 'training_load': [day.json() for day in days]}
+
+        weeks = dict()
+        for day in days:
+            week = day.day - timedelta(days=day.day.weekday())
+            totals = weeks.setdefault(week, dict.fromkeys(LOAD_COLUMNS, 0))
+            for column in LOAD_COLUMNS:
+                totals[column] += getattr(day, column)
+        return {'period': 'week',
+                'training_load': [dict(subject_id=subject_id, week=week.isoformat(), **totals)
+                                  for week, totals in weeks.items()]}
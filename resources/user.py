@@ -10,7 +10,7 @@ from flask_jwt_extended import (
 )
 from flask_restful import Resource, reqparse
 
-from blocklist import BLOCKLIST
+from blocklist import revoke
 from models.user import UserModel
 
 _user_parser = reqparse.RequestParser()
@@ -77,8 +77,8 @@ class UserLogin(Resource):
 class UserLogout(Resource):
     @jwt_required()
     def post(self):
-        jti = get_jwt()['jti']
-        BLOCKLIST.add(jti)
+        jwt = get_jwt()
+        revoke(jwt['jti'], jwt['exp'])
         logger.info(f'User logged out.')
         return {'message': 'Successfully logged out.'}, 200
 
@@ -1,8 +1,7 @@
-import threading
 from flask_restful import Resource, reqparse
 
 from logger import logger
-from models.activity import ActivityModel
+from models.webhook_event import WebhookEventModel
 
 
 class Webhook(Resource):
@@ -24,10 +23,7 @@ class Webhook(Resource):
                             location='args',
                             help="TBA")
         data = parser.parse_args()
-        logger.info("# # # # # # # # # # # # # # # # # # # # #")
-        logger.info("Received webhook subscription validation request")
-        logger.info(data)
-        logger.info("# # # # # # # # # # # # # # # # # # # # #")
+        logger.info(f'Webhook subscription validation request, mode {data["hub.mode"]}')
 
         return {"hub.challenge": f'{data["hub.challenge"]}'}, 200
 
@@ -64,12 +60,15 @@ class Webhook(Resource):
 
         data = parser.parse_args()
 
-        logger.info("# # # # # # # # # # # # # # # # # # # # #")
-        logger.info("Received webhook event")
-        logger.info(data)
-        logger.info("# # # # # # # # # # # # # # # # # # # # #")
+        logger.info(f'Webhook event: {data["aspect_type"]} {data["object_type"]} {data["object_id"]} '
+                    f'of athlete {data["owner_id"]}', extra={'updates': data['updates']})
+        # Strava expects an answer within two seconds, the event is processed later by the worker
+        # (see webhook_processor.py). Retried deliveries of the same event are dropped here. If the event
+        # cannot be stored, the error response makes Strava deliver it again.
         try:
-            ActivityModel.from_webhook_event(data)
+            if not WebhookEventModel.record(data):
+                logger.info('Duplicate webhook event ignored')
         except Exception as err:
             logger.exception(err)
+            return {"message": "An error occurred storing the webhook event."}, 500
         return 200
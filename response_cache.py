@@ -0,0 +1,103 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from flask import Response, request
+from sqlalchemy import func
+
+from constants import RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_ENTRY
+from metrics import RESPONSE_CACHE
+from models.subject import SubjectModel
+
+# Conditional GET support for the activity endpoints, and a per-process LRU of stream response bodies.
+# Every subject has a data version, incremented by invalidate() in the same transaction as every change of its
+# activities or streams (ActivityModel.save_to_db/delete_from_db, bulk_ingest, migrate-streams). ETags are built
+# from that version and the request, so a response is only recomputed once the subject's data has changed, and
+# the version being in the db makes this work across the uwsgi processes and the background worker.
+CACHE_CONTROL = 'private, no-cache'
+
+_bodies = OrderedDict()  # etag -> (subject_id, body)
+_size = 0
+_lock = threading.Lock()
+
+
+def etag_for(*parts) -> str:
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def request_args() -> tuple:
+    # the query arguments, in a stable order
+    return tuple(sorted(request.args.items(multi=True)))
+
+
+def not_modified(etag: str):
+    # a 304 response if the client has the current version, otherwise None
+    if request.if_none_match.contains(etag):
+        RESPONSE_CACHE.labels('not_modified').inc()
+        return Response(status=304, headers=cache_headers(etag))
+    return None
+
+
+def cache_headers(etag: str) -> dict:
+    return {'ETag': f'"{etag}"', 'Cache-Control': CACHE_CONTROL}
+
+
+def invalidate(subject_id: str):
+    # Increments the subject's data version. Executed in the current transaction, the caller commits.
+    SubjectModel.query.filter_by(subject_id=subject_id) \
+        .update({SubjectModel.data_version: func.coalesce(SubjectModel.data_version, 0) + 1},
+                synchronize_session=False)
+    # entries of other versions are never served again anyway, dropping them frees the space right away
+    with _lock:
+        for etag in [etag for etag, (owner, _) in _bodies.items() if owner == subject_id]:
+            _remove(etag)
+
+
+def data_version(subject_id: str) -> int:
+    return SubjectModel.query.with_entities(SubjectModel.data_version).filter_by(subject_id=subject_id).scalar() or 0
+
+
+def cached_body(etag: str):
+    with _lock:
+        entry = _bodies.get(etag)
+        if entry is None:
+            RESPONSE_CACHE.labels('miss').inc()
+            return None
+        _bodies.move_to_end(etag)
+    RESPONSE_CACHE.labels('hit').inc()
+    return entry[1]
+
+
+def caching(chunks, etag: str, subject_id: str):
+    # Passes the chunks of a streamed body through and keeps the complete body in the cache, unless it gets
+    # larger than RESPONSE_CACHE_MAX_ENTRY. Bodies of aborted responses are not kept.
+    parts, size = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        if parts is not None:
+            size += len(chunk)
+            if size > RESPONSE_CACHE_MAX_ENTRY:
+                parts = None
+            else:
+                parts.append(chunk)
+        yield chunk
+    if parts is not None:
+        _store(etag, subject_id, b''.join(parts))
+
+
+def _store(etag: str, subject_id: str, body: bytes):
+    global _size
+    with _lock:
+        if etag in _bodies:
+            _remove(etag)
+        _bodies[etag] = (subject_id, body)
+        _size += len(body)
+        while _size > RESPONSE_CACHE_BYTES:
+            _remove(next(iter(_bodies)))
+
+
+def _remove(etag: str):
+    # the caller holds the lock
+    global _size
+    _size -= len(_bodies.pop(etag)[1])
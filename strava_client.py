@@ -0,0 +1,94 @@
+import os
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from constants import (STRAVA_API_URL, STRAVA_OAUTH_URL, STRAVA_CONNECT_TIMEOUT, STRAVA_READ_TIMEOUT,
+                       STRAVA_MAX_RETRIES, STRAVA_BACKOFF, STRAVA_MAX_BACKOFF, STRAVA_POOL_SIZE)
+from logger import logger
+from metrics import observe_strava_request
+
+# rate limited or temporary server errors
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class StravaClient:
+    # All requests to Strava go through one pooled keep-alive session per process (see get_client).
+    # Every request has connect/read timeouts and is retried with jittered exponential backoff on
+    # connection errors, timeouts, 429 and 5xx responses.
+    def __init__(self,
+                 api_url: str = STRAVA_API_URL,
+                 oauth_url: str = STRAVA_OAUTH_URL,
+                 timeout: tuple = (STRAVA_CONNECT_TIMEOUT, STRAVA_READ_TIMEOUT),
+                 max_retries: int = STRAVA_MAX_RETRIES,
+                 pool_size: int = STRAVA_POOL_SIZE):
+        self.api_url = api_url.rstrip('/')
+        self.oauth_url = oauth_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, path: str, access_token: str, params: dict = None, retries: int = None) -> requests.Response:
+        return self.request('GET', f'{self.api_url}{path}',
+                            params=params,
+                            headers={'Authorization': f'Bearer {access_token}'},
+                            retries=retries)
+
+    def post_token(self, data: dict, retries: int = None, timeout: tuple = None) -> requests.Response:
+        # OAuth token exchange/refresh, see https://developers.strava.com/docs/authentication/
+        return self.request('POST', self.oauth_url, data=data, retries=retries, timeout=timeout)
+
+    def request(self, method: str, url: str, retries: int = None, timeout: tuple = None,
+                **kwargs) -> requests.Response:
+        retries = self.max_retries if retries is None else retries
+        timeout = timeout or self.timeout
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                observe_strava_request(url, 'error', time.perf_counter() - start)
+                if attempt >= retries:
+                    raise
+                reason = type(err).__name__
+                delay = self.backoff(attempt)
+            else:
+                observe_strava_request(url, response.status_code, time.perf_counter() - start, response.headers)
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= retries:
+                    return response
+                reason = f'status {response.status_code}'
+                delay = self.backoff(attempt, response.headers.get('Retry-After'))
+            logger.warning(f'Strava {method} {url} failed ({reason}), retry {attempt + 1}/{retries} in {delay:.1f}s')
+            time.sleep(delay)
+            attempt += 1
+
+    @staticmethod
+    def backoff(attempt: int, retry_after: str = None) -> float:
+        if retry_after and retry_after.isdigit():
+            return min(float(retry_after), STRAVA_MAX_BACKOFF)
+        # "full jitter": uniformly distributed up to the exponentially growing maximum
+        return random.uniform(0, min(STRAVA_BACKOFF * 2 ** attempt, STRAVA_MAX_BACKOFF))
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client() -> StravaClient:
+    # One client per process. uWSGI forks workers after importing the app, and a connection
+    # pool must never be shared across a fork, hence the pid check.
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        with _client_lock:
+            if _client is None or _client_pid != os.getpid():
+                _client = StravaClient()
+                _client_pid = os.getpid()
+    return _client
@@ -0,0 +1,384 @@
+import json
+import zlib
+
+import numpy as np
+
+# Compact encoding of stream columns (see stream_store.STREAM_DTYPES), used by the packed stream store.
+# Only depends on numpy, so exported .strm files can be decoded with a copy of this module.
+#
+# A column is encoded with the codec of its stream type:
+#   delta_varint  monotone integers (time): differences, zigzag encoded, as LEB128 varints
+#   fixed_delta   decimals (distance, lat/lng, ...): integers of `decimals` fixed decimal places, then delta_varint.
+#                 lat/lng use 7 decimal places (int32 fixed-point, about 1 cm)
+#   small_int     small integers (heartrate, cadence, temp): minus their minimum (base), 1 or 2 bytes each
+#   bits          booleans (moving): 8 per byte
+#   raw           anything else: little endian bytes of the values
+# NaN gaps are kept in a separate bit mask, the codec only encodes the other values. The encoded bytes are zlib
+# compressed when that makes them smaller (e.g. the time deltas, which are mostly 1).
+# Columns longer than BLOCK_SAMPLES are encoded in blocks of that many samples, each decodable on its own, so that
+# reading a window of a long stream (BlockColumn) only decodes the blocks holding it.
+#
+# File layout: magic, a json header line, the column data:
+#   STRM2\n{"length": n, "columns": [{"name", "dtype", "codec", ...}], "levels": {points: {"length", "columns"}}}\n...
+# every column entry holds the offset and size of its data relative to the end of the header line. The entry of a
+# column in blocks has "block" (samples per block) and "blocks", one entry with codec, offset and size per block.
+# STRM1 files (written before blocks) have no columns in blocks and are read the same way.
+
+MAGIC = b'STRM2\n'
+MAGICS = (b'STRM1\n', MAGIC)
+BLOCK_SAMPLES = 2048
+# fixed decimal places per stream, the precision Strava reports (lat/lng: int32 fixed point)
+DECIMALS = {
+    'distance': 2,
+    'velocity_smooth': 3,
+    'altitude': 2,
+    'grade_smooth': 2,
+    'watts': 1,
+    'lat': 7,
+    'lng': 7,
+}
+CODECS = {
+    'time': 'delta_varint',
+    'heartrate': 'small_int',
+    'cadence': 'small_int',
+    'temp': 'small_int',
+    'moving': 'bits',
+    **{key: 'fixed_delta' for key in DECIMALS},
+}
+
+
+class CodecError(ValueError):
+    """Raised for data that is not a valid encoded stream file."""
+
+
+def _varint_encode(values: np.ndarray) -> bytes:
+    # LEB128 of unsigned 64 bit values: 7 bits per byte, high bit set on all but the last byte of a value
+    values = np.asarray(values, dtype=np.uint64)
+    if not len(values):
+        return b''
+    bits = np.zeros(len(values), dtype=np.int64)
+    remaining = values.copy()
+    while remaining.any():
+        bits += remaining > 0
+        remaining >>= np.uint64(7)
+    sizes = np.maximum(bits, 1)
+    offsets = np.cumsum(sizes) - sizes
+    out = np.zeros(int(sizes.sum()), dtype=np.uint8)
+    for k in range(int(sizes.max())):
+        selected = sizes > k
+        byte = (values[selected] >> np.uint64(7 * k)) & np.uint64(0x7f)
+        more = (sizes[selected] > k + 1).astype(np.uint64) << np.uint64(7)
+        out[offsets[selected] + k] = (byte | more).astype(np.uint8)
+    return out.tobytes()
+
+
+def _varint_decode(data: bytes, count: int) -> np.ndarray:
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = (data & 0x80) == 0
+    if int(ends.sum()) != count or (len(data) and not ends[-1]):
+        raise CodecError(f'Expected {count} varints, got {int(ends.sum())}')
+    index = np.cumsum(ends) - ends
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    position = np.arange(len(data)) - starts[index]
+    values = np.zeros(count, dtype=np.uint64)
+    for k in range(int(position.max()) + 1 if len(data) else 0):
+        selected = position == k
+        values[index[selected]] |= (data[selected] & 0x7f).astype(np.uint64) << np.uint64(7 * k)
+    return values
+
+
+def _zigzag(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.int64)
+    return ((values << 1) ^ (values >> 63)).astype(np.uint64)
+
+
+def _unzigzag(values: np.ndarray) -> np.ndarray:
+    return (values >> np.uint64(1)).astype(np.int64) ^ -(values & np.uint64(1)).astype(np.int64)
+
+
+def _delta_encode(values: np.ndarray) -> bytes:
+    return _varint_encode(_zigzag(np.diff(values.astype(np.int64), prepend=0)))
+
+
+def _delta_decode(data: bytes, count: int) -> np.ndarray:
+    return np.cumsum(_unzigzag(_varint_decode(data, count)))
+
+
+def _codec(key: str, values: np.ndarray) -> str:
+    # the codec of the stream type, unless the values do not fit it (e.g. legacy files with odd values)
+    codec = CODECS.get(key, 'raw')
+    if values.dtype.kind not in 'iufb' or (values.dtype.kind == 'f' and not np.isfinite(values).all()):
+        return 'raw'
+    if codec in ('delta_varint', 'small_int') and values.dtype.kind == 'f' and (values != np.round(values)).any():
+        return 'raw'
+    if codec == 'bits' and not np.isin(values, (0, 1)).all():
+        return 'raw'
+    return codec
+
+
+def encode_column(key: str, values) -> tuple:
+    # (header entry, encoded bytes) of one column
+    values = np.asarray(values)
+    entry = {'name': key, 'dtype': values.dtype.newbyteorder('<').str, 'length': len(values)}
+    mask = b''
+    if values.dtype.kind == 'f' and np.isnan(values).any():
+        nan = np.isnan(values)
+        mask = np.packbits(nan).tobytes()
+        values = values[~nan]
+    codec = _codec(key, values)
+
+    if codec == 'delta_varint':
+        data = _delta_encode(values)
+    elif codec == 'fixed_delta':
+        entry['decimals'] = DECIMALS[key]
+        data = _delta_encode(np.round(values.astype(np.float64) * 10 ** DECIMALS[key]))
+    elif codec == 'small_int':
+        base = int(values.min()) if len(values) else 0
+        shifted = values.astype(np.int64) - base
+        width = 1 if not len(shifted) or shifted.max() < 1 << 8 else 2 if shifted.max() < 1 << 16 else 4
+        entry['base'], entry['width'] = base, width
+        data = shifted.astype(f'<u{width}').tobytes()
+    elif codec == 'bits':
+        data = np.packbits(values.astype(bool)).tobytes()
+    else:
+        data = np.ascontiguousarray(values, dtype=entry['dtype']).tobytes()
+    entry['codec'] = codec
+
+    compressed = zlib.compress(data, 6)
+    if len(compressed) < len(data):
+        entry['zlib'] = True
+        data = compressed
+    entry['mask_size'] = len(mask)
+    return entry, mask + data
+
+
+def decode_column(entry: dict, data: bytes) -> np.ndarray:
+    length = entry['length']
+    mask, data = data[:entry['mask_size']], data[entry['mask_size']:]
+    if mask and len(mask) != (length + 7) // 8:
+        raise CodecError(f'{entry["name"]}: NaN mask of {len(mask)} bytes for {length} values')
+    nan = np.unpackbits(np.frombuffer(mask, dtype=np.uint8), count=length).astype(bool) if mask else None
+    count = length - int(nan.sum()) if nan is not None else length
+    if entry.get('zlib'):
+        try:
+            data = zlib.decompress(data)
+        except zlib.error as err:
+            raise CodecError(f'{entry["name"]}: {err}')
+
+    codec = entry['codec']
+    if codec == 'delta_varint':
+        values = _delta_decode(data, count)
+    elif codec == 'fixed_delta':
+        values = _delta_decode(data, count) / 10 ** entry['decimals']
+    elif codec == 'small_int':
+        values = _frombuffer(entry, data, f'<u{entry["width"]}').astype(np.int64) + entry['base']
+    elif codec == 'bits':
+        if len(data) != (count + 7) // 8:
+            raise CodecError(f'{entry["name"]}: {len(data)} bytes for {count} bits')
+        values = np.unpackbits(np.frombuffer(data, dtype=np.uint8), count=count).astype(bool)
+    elif codec == 'raw':
+        values = _frombuffer(entry, data, entry['dtype'])
+    else:
+        raise CodecError(f'Unknown codec {codec}')
+    if len(values) != count:
+        raise CodecError(f'{entry["name"]}: expected {count} values, got {len(values)}')
+
+    dtype = np.dtype(entry['dtype'])
+    if nan is not None:
+        column = np.full(length, np.nan, dtype=dtype)
+        column[~nan] = values
+        return column
+    return values.astype(dtype)
+
+
+def _frombuffer(entry: dict, data: bytes, dtype) -> np.ndarray:
+    if len(data) % np.dtype(dtype).itemsize:
+        raise CodecError(f'{entry["name"]}: {len(data)} bytes are no whole number of {dtype} values')
+    return np.frombuffer(data, dtype=dtype)
+
+
+def _encode_section(columns: dict, payload: list, offset: int) -> tuple:
+    section = {'length': len(next(iter(columns.values()))) if columns else 0, 'columns': []}
+    for key, values in columns.items():
+        values = np.asarray(values)
+        if len(values) <= BLOCK_SAMPLES:
+            entry, data = encode_column(key, values)
+            entry['offset'], entry['size'] = offset, len(data)
+            payload.append(data)
+            offset += len(data)
+        else:
+            entry = {'name': key, 'dtype': values.dtype.newbyteorder('<').str, 'length': len(values),
+                     'block': BLOCK_SAMPLES, 'blocks': [], 'offset': offset}
+            for start in range(0, len(values), BLOCK_SAMPLES):
+                block, data = encode_column(key, values[start:start + BLOCK_SAMPLES])
+                # name, dtype and length are the column's
+                del block['name'], block['dtype'], block['length']
+                block['offset'], block['size'] = offset, len(data)
+                entry['blocks'].append(block)
+                payload.append(data)
+                offset += len(data)
+            entry['size'] = offset - entry['offset']
+        section['columns'].append(entry)
+    return section, offset
+
+
+def encode(columns: dict, levels: dict = None) -> bytes:
+    # file contents of the columns of an activity and optionally their downsampled levels {points: columns}
+    payload = []
+    header, offset = _encode_section(columns, payload, 0)
+    header['levels'] = dict()
+    for points, level in (levels or {}).items():
+        header['levels'][str(points)], offset = _encode_section(level, payload, offset)
+    return MAGIC + json.dumps(header).encode() + b'\n' + b''.join(payload)
+
+
+def read_header(f) -> tuple:
+    # (header, offset of the column data) of an open file
+    if f.read(len(MAGIC)) not in MAGICS:
+        raise CodecError('Not an encoded stream file')
+    line = f.readline()
+    try:
+        header = json.loads(line)
+    except ValueError as err:
+        raise CodecError(f'Invalid header: {err}')
+    return header, len(MAGIC) + len(line)
+
+
+def _blocks(entry: dict) -> list:
+    # the separately decodable parts of a column, each a complete entry of its samples
+    if 'blocks' not in entry:
+        return [entry]
+    size, length = entry['block'], entry['length']
+    if size < 1 or len(entry['blocks']) != -(-length // size):
+        raise CodecError(f'{entry["name"]}: {len(entry["blocks"])} blocks of {size} for {length} values')
+    return [dict(entry, **block, length=min(size, length - i * size)) for i, block in enumerate(entry['blocks'])]
+
+
+def read_section(f, section: dict, data_offset: int, keys=None) -> dict:
+    # decodes the (requested) columns of a section, only reading their data
+    columns = dict()
+    for entry in section['columns']:
+        if keys is not None and entry['name'] not in keys:
+            continue
+        parts = []
+        for block in _blocks(entry):
+            f.seek(data_offset + block['offset'])
+            data = f.read(block['size'])
+            if len(data) != block['size']:
+                raise CodecError(f'{entry["name"]}: data truncated')
+            parts.append(decode_column(block, data))
+        columns[entry['name']] = parts[0] if len(parts) == 1 else np.concatenate(parts)
+    return columns
+
+
+def open_section(buffer, section: dict, data_offset: int, keys=None) -> dict:
+    # {name: BlockColumn} of the (requested) columns of a section of the file contents in buffer (bytes or an mmap)
+    return {entry['name']: BlockColumn(entry, buffer, data_offset) for entry in section['columns']
+            if keys is None or entry['name'] in keys}
+
+
+class BlockColumn:
+    # A column that is decoded lazily: slices and searchsorted decode only the blocks they need (each once),
+    # np.asarray() the whole column. Used like the read-only arrays of the other stream formats.
+    ndim = 1
+
+    def __init__(self, entry: dict, buffer, data_offset: int):
+        self.name = entry['name']
+        self.dtype = np.dtype(entry['dtype'])
+        self.length = entry['length']
+        self.block_size = entry.get('block') or max(self.length, 1)
+        self.blocks = _blocks(entry)
+        for block in self.blocks:
+            if data_offset + block['offset'] + block['size'] > len(buffer):
+                raise CodecError(f'{self.name}: data truncated')
+        self._buffer = buffer
+        self._data_offset = data_offset
+        self._decoded = dict()
+
+    def __len__(self) -> int:
+        return self.length
+
+    @property
+    def shape(self) -> tuple:
+        return self.length,
+
+    @property
+    def nbytes(self) -> int:
+        return self.length * self.dtype.itemsize
+
+    def _block(self, index: int) -> np.ndarray:
+        if index not in self._decoded:
+            block = self.blocks[index]
+            start = self._data_offset + block['offset']
+            self._decoded[index] = decode_column(block, bytes(self._buffer[start:start + block['size']]))
+        return self._decoded[index]
+
+    def _range(self, lo: int, hi: int) -> np.ndarray:
+        # values [lo, hi)
+        if lo >= hi:
+            return np.empty(0, dtype=self.dtype)
+        first, last = lo // self.block_size, (hi - 1) // self.block_size
+        if first == last:
+            values = self._block(first)
+        else:
+            values = np.concatenate([self._block(index) for index in range(first, last + 1)])
+        start = first * self.block_size
+        return values[lo - start:hi - start]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            lo, hi, step = key.indices(self.length)
+            if step > 0:
+                return self._range(lo, max(lo, hi))[::step]
+        elif isinstance(key, (int, np.integer)):
+            index = key + self.length if key < 0 else key
+            if not 0 <= index < self.length:
+                raise IndexError(f'index {key} is out of bounds for {self.name} of length {self.length}')
+            return self._range(index, index + 1)[0]
+        return np.asarray(self)[key]
+
+    def __array__(self, dtype=None, copy=None):
+        values = self._range(0, self.length)
+        return values if dtype is None else values.astype(dtype)
+
+    def searchsorted(self, value, side: str = 'left') -> int:
+        # np.searchsorted of a sorted column: a binary search over the first values of the blocks, then within
+        # the one block that holds the position. Like in numpy, NaN sorts after all numbers.
+        if not self.length:
+            return 0
+        lo, hi = 0, len(self.blocks)
+        while lo < hi:
+            middle = (lo + hi) // 2
+            first = self._block(middle)[0]
+            if first < value if side == 'left' else first <= value:
+                lo = middle + 1
+            else:
+                hi = middle
+        if lo == 0:
+            return 0
+        return (lo - 1) * self.block_size + int(np.searchsorted(self._block(lo - 1), value, side=side))
+
+
+def decode(path: str, keys=None) -> dict:
+    with open(path, 'rb') as f:
+        header, data_offset = read_header(f)
+        return read_section(f, header, data_offset, keys=keys)
+
+
+def mismatches(columns: dict, decoded: dict) -> list:
+    # keys whose decoded values differ from the original ones by more than the codec precision
+    keys = []
+    for key, values in columns.items():
+        values = np.asarray(values)
+        other = decoded.get(key)
+        if other is None or len(other) != len(values):
+            keys.append(key)
+        elif values.dtype.kind == 'f':
+            # rounding to the fixed decimal places, plus the precision of the column's float type
+            tolerance = 0.5 * 10 ** -DECIMALS[key] if key in DECIMALS else 0
+            if not np.allclose(values, other, rtol=4 * np.finfo(values.dtype).eps, atol=tolerance + 1e-9,
+                               equal_nan=True):
+                keys.append(key)
+        elif not np.array_equal(values, other):
+            keys.append(key)
+    return keys
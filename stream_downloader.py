@@ -0,0 +1,62 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from constants import STREAM_DOWNLOAD_POOL_SIZE
+from db import db
+from logger import logger
+from models.subject import SubjectModel
+from token_provider import get_access_token
+
+
+class StreamDownloader:
+    # Downloads the stream data of many activities concurrently.
+    # Only the Strava requests run in the thread pool. Files are written and rows updated in the calling
+    # thread as the responses arrive, because the db session must not be shared between threads.
+    def __init__(self, pool_size: int = STREAM_DOWNLOAD_POOL_SIZE):
+        self.pool_size = pool_size
+
+    def download(self, activities: list, progress=None) -> dict:
+        counts = {'streams_downloaded': 0, 'streams_failed': 0}
+        if not activities:
+            return counts
+        access_tokens = self._access_tokens(activities)
+
+        with ThreadPoolExecutor(max_workers=self.pool_size) as executor:
+            futures = dict()
+            for activity in activities:
+                access_token = access_tokens.get(activity.subject_id)
+                if access_token is None:
+                    counts['streams_failed'] += 1
+                    continue
+                future = executor.submit(activity.fetch_stream_data, activity.strava_activity_id, access_token)
+                futures[future] = activity
+
+            for done, future in enumerate(as_completed(futures), start=1):
+                activity = futures[future]
+                try:
+                    stream_set = future.result()
+                    if stream_set is None:
+                        counts['streams_failed'] += 1
+                    else:
+                        activity.store_stream_data(stream_set)
+                        counts['streams_downloaded'] += 1
+                except Exception as err:
+                    # one failed activity must not abort the batch, it is retried by the next sync
+                    logger.error(f'Stream download for activity {activity.strava_activity_id} failed: {err}')
+                    db.session.rollback()
+                    counts['streams_failed'] += 1
+                if progress:
+                    progress(done, len(futures))
+
+        logger.info(f'Stream download finished: {counts}')
+        return counts
+
+    @staticmethod
+    def _access_tokens(activities: list) -> dict:
+        access_tokens = dict()
+        for subject_id in set(activity.subject_id for activity in activities):
+            subject = SubjectModel.find_by_subject_id(subject_id)
+            if not subject:
+                logger.warning(f'Subject {subject_id} not found, skipping its stream downloads')
+                continue
+            access_tokens[subject_id] = get_access_token(subject)
+        return access_tokens
@@ -0,0 +1,523 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import threading
+
+import numpy as np
+
+import stream_codec
+from constants import STREAM_DIR, STREAM_FORMAT
+from metrics import STREAM_BYTES
+
+# Typed columns for the Strava stream types,
+# see https://developers.strava.com/docs/reference/#api-models-StreamSet
+# latlng is split into separate lat and lng columns.
+STREAM_DTYPES = {
+    'time': np.int32,
+    'distance': np.float32,
+    'velocity_smooth': np.float32,
+    'altitude': np.float32,
+    'lat': np.float64,
+    'lng': np.float64,
+    'temp': np.int16,
+    'cadence': np.int16,
+    'grade_smooth': np.float32,
+    'heartrate': np.int16,
+    'moving': np.bool_,
+    'watts': np.float32,
+}
+
+
+def columns_from_strava(stream_set: dict) -> dict:
+    # Convert a key_by_type stream set as returned by the Strava API into typed columns
+    columns = dict()
+    for key, value in stream_set.items():
+        data = value['data'] if isinstance(value, dict) else value
+        if key == 'latlng':
+            latlng = np.asarray(data, dtype=np.float64).reshape(-1, 2)
+            columns['lat'] = latlng[:, 0].copy()
+            columns['lng'] = latlng[:, 1].copy()
+            continue
+        columns[key] = _typed(key, data)
+    return columns
+
+
+def _typed(key, data):
+    array = np.asarray(data)
+    dtype = STREAM_DTYPES.get(key)
+    if dtype is None:
+        return array
+    if np.issubdtype(dtype, np.integer) and array.dtype.kind == 'f' and np.isnan(array).any():
+        # gaps in an integer stream (only happens for converted legacy files) are kept as NaN
+        return array.astype(np.float32)
+    return array.astype(dtype)
+
+
+class StreamStore:
+    # Base class of the stream storage formats. The returned paths end up in ActivityModel.stream_file_path
+    name = None
+
+    def __init__(self, root: str = STREAM_DIR):
+        self.root = root
+
+    def path_for(self, strava_activity_id: int) -> str:
+        raise NotImplementedError
+
+    def write(self, strava_activity_id: int, columns: dict) -> str:
+        raise NotImplementedError
+
+    def read(self, path: str, keys=None) -> dict:
+        raise NotImplementedError
+
+    def keys(self, path: str) -> list:
+        return list(self.read(path).keys())
+
+    def levels(self, path: str) -> list:
+        # point counts of the stored downsampled levels (see build_levels), formats without levels have none
+        return []
+
+    def read_level(self, path: str, points: int, keys=None) -> dict:
+        raise NotImplementedError
+
+    def delete(self, path: str):
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+    def handles(self, path: str) -> bool:
+        raise NotImplementedError
+
+
+class NpyStreamStore(StreamStore):
+    # One directory per activity holding one .npy file per column.
+    # Reads are memory mapped, so only the columns (and pages) that are accessed get loaded.
+    name = 'npy'
+
+    def path_for(self, strava_activity_id: int) -> str:
+        return os.path.join(self.root, str(strava_activity_id))
+
+    def write(self, strava_activity_id: int, columns: dict) -> str:
+        # written to a temporary directory, which then replaces the activity's directory
+        path = self.path_for(strava_activity_id)
+        with _temporary_dir(path) as temporary:
+            for key, values in columns.items():
+                _save_npy(os.path.join(temporary, f'{key}.npy'), values)
+            self.write_levels(temporary, columns)
+        return path
+
+    def write_levels(self, path: str, columns: dict):
+        # downsampled copies of all columns in <path>/levels/<points>/
+        with _temporary_dir(os.path.join(path, LEVELS_DIR)) as temporary:
+            for points, level in build_levels(columns).items():
+                os.makedirs(os.path.join(temporary, str(points)))
+                for key, values in level.items():
+                    _save_npy(os.path.join(temporary, str(points), f'{key}.npy'), values)
+
+    def levels(self, path: str) -> list:
+        levels_path = os.path.join(path, LEVELS_DIR)
+        if not os.path.isdir(levels_path):
+            return []
+        return sorted(int(name) for name in os.listdir(levels_path) if name.isdigit())
+
+    def read_level(self, path: str, points: int, keys=None) -> dict:
+        return self.read(os.path.join(path, LEVELS_DIR, str(points)), keys=keys)
+
+    def keys(self, path: str) -> list:
+        return sorted(name[:-len('.npy')] for name in os.listdir(path) if name.endswith('.npy'))
+
+    def read(self, path: str, keys=None) -> dict:
+        available = self.keys(path)
+        if keys is not None:
+            available = [key for key in available if key in keys]
+        return {key: np.load(os.path.join(path, f'{key}.npy'), mmap_mode='r', allow_pickle=False)
+                for key in available}
+
+    def handles(self, path: str) -> bool:
+        return os.path.isdir(path)
+
+
+class PackedStreamStore(StreamStore):
+    # One file per activity holding all columns and their downsampled levels, compactly encoded
+    # (see stream_codec.py). Reads are memory mapped and return stream_codec.BlockColumns, which decode only the
+    # blocks of the requested columns that a window or search accesses.
+    name = 'packed'
+    extension = '.strm'
+
+    def path_for(self, strava_activity_id: int) -> str:
+        return os.path.join(self.root, f'{strava_activity_id}{self.extension}')
+
+    def write(self, strava_activity_id: int, columns: dict) -> str:
+        path = self.path_for(strava_activity_id)
+        with _temporary_file(path) as f:
+            f.write(stream_codec.encode(columns, build_levels(columns)))
+        return path
+
+    def _header(self, path: str) -> dict:
+        with open(path, 'rb') as f:
+            return stream_codec.read_header(f)[0]
+
+    def keys(self, path: str) -> list:
+        return [entry['name'] for entry in self._header(path)['columns']]
+
+    def _open(self, path: str) -> tuple:
+        # (header, offset of the column data, memory map of the file)
+        with open(path, 'rb') as f:
+            header, data_offset = stream_codec.read_header(f)
+            return header, data_offset, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read(self, path: str, keys=None) -> dict:
+        header, data_offset, buffer = self._open(path)
+        return stream_codec.open_section(buffer, header, data_offset, keys=keys)
+
+    def levels(self, path: str) -> list:
+        return sorted(int(points) for points in self._header(path).get('levels', {}))
+
+    def read_level(self, path: str, points: int, keys=None) -> dict:
+        header, data_offset, buffer = self._open(path)
+        return stream_codec.open_section(buffer, header['levels'][str(points)], data_offset, keys=keys)
+
+    def handles(self, path: str) -> bool:
+        return path.endswith(self.extension) and os.path.isfile(path)
+
+
+class CsvStreamStore(StreamStore):
+    # Legacy format: one pandas csv file per activity, latlng as text "[lat, lng]"
+    name = 'csv'
+
+    def path_for(self, strava_activity_id: int) -> str:
+        return os.path.join(self.root, f'{strava_activity_id}.csv')
+
+    def write(self, strava_activity_id: int, columns: dict) -> str:
+        import pandas as pd
+        path = self.path_for(strava_activity_id)
+        with _temporary_file(path, mode='w') as f:
+            pd.DataFrame(dict(columns)).to_csv(f)
+        return path
+
+    def read(self, path: str, keys=None) -> dict:
+        import pandas as pd
+        df = pd.read_csv(path, index_col=0)
+        stream_set = dict()
+        for key in df.columns:
+            if key == 'latlng':
+                stream_set[key] = [_parse_latlng(value) for value in df[key]]
+            else:
+                stream_set[key] = df[key].to_numpy()
+        columns = columns_from_strava(stream_set)
+        if keys is not None:
+            columns = {key: value for key, value in columns.items() if key in keys}
+        return columns
+
+    def handles(self, path: str) -> bool:
+        return path.endswith('.csv')
+
+
+# Stream files are written to a temporary path next to the final one and renamed into place once complete,
+# so a crash while writing never leaves a truncated file at a path an activity refers to.
+def _temporary_path(path: str, suffix: str = 'tmp') -> str:
+    return f'{path}.{suffix}-{os.getpid()}-{threading.get_ident()}'
+
+
+class _temporary_file:
+    # with _temporary_file(path) as f: ... writes path atomically
+    def __init__(self, path: str, mode: str = 'wb'):
+        self.path = path
+        self.temporary = _temporary_path(path)
+        self.mode = mode
+
+    def __enter__(self):
+        self.file = open(self.temporary, self.mode)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.file.flush()
+                os.fsync(self.file.fileno())
+        finally:
+            self.file.close()
+        if exc_type is None:
+            os.replace(self.temporary, self.path)
+        else:
+            os.remove(self.temporary)
+
+
+class _temporary_dir:
+    # with _temporary_dir(path) as temporary: ... replaces the directory path by the one written.
+    # A directory cannot be renamed over another one, so the old one is moved aside first: after a crash in
+    # between, the path is missing (and found by `flask strava verify-streams`), but never incomplete.
+    def __init__(self, path: str):
+        self.path = path
+        self.temporary = _temporary_path(path)
+
+    def __enter__(self):
+        os.makedirs(self.temporary)
+        return self.temporary
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            shutil.rmtree(self.temporary, ignore_errors=True)
+            return
+        if os.path.exists(self.path):
+            old = _temporary_path(self.path, 'old')
+            os.rename(self.path, old)
+            os.rename(self.temporary, self.path)
+            shutil.rmtree(old)
+        else:
+            os.rename(self.temporary, self.path)
+
+
+def _save_npy(path: str, values):
+    with open(path, 'wb') as f:
+        np.save(f, np.asarray(values), allow_pickle=False)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def _parse_latlng(value):
+    if not isinstance(value, str):
+        return [np.nan, np.nan]
+    lat, lng = value.strip('[]').split(',')
+    return [float(lat), float(lng)]
+
+
+STORES = {store.name: store for store in (NpyStreamStore, PackedStreamStore, CsvStreamStore)}
+
+
+def get_store(name: str = STREAM_FORMAT) -> StreamStore:
+    # store used for writing new stream files
+    return STORES[name]()
+
+
+def store_for_path(path: str) -> StreamStore:
+    # store able to read an existing stream file, whatever format it was written in
+    for store in STORES.values():
+        instance = store()
+        if instance.handles(path):
+            return instance
+    raise FileNotFoundError(f'No stream data at {path}')
+
+
+def read_streams(path: str, keys=None) -> dict:
+    # Columns of the stream file, memory mapped or decoded lazily where the format allows it, so only what is
+    # accessed is read. Damaged data may therefore only raise once it is accessed, see load_streams.
+    columns = store_for_path(path).read(path, keys=keys)
+    STREAM_BYTES.labels('read').inc(sum(values.nbytes for values in columns.values()))
+    return columns
+
+
+def load_streams(path: str, keys=None) -> dict:
+    # read_streams, decoded completely, so that damaged data raises here
+    return {key: np.asarray(values) for key, values in read_streams(path, keys=keys).items()}
+
+
+def write_streams(strava_activity_id: int, columns: dict, store: StreamStore = None) -> str:
+    # write with the configured store (or the given one), returns the path to keep in stream_file_path
+    store = store or get_store()
+    STREAM_BYTES.labels('written').inc(sum(np.asarray(values).nbytes for values in columns.values()))
+    return store.write(strava_activity_id, columns)
+
+
+def stream_hash(columns: dict) -> str:
+    # sha256 of the stream content, independent of the store format: the column names, kinds and values, with
+    # decimals rounded to the precision the packed store keeps (stream_codec.DECIMALS) and one NaN value
+    digest = hashlib.sha256()
+    for key in sorted(columns):
+        values = np.asarray(columns[key])
+        if values.dtype.kind == 'f':
+            values = values.astype(np.float64)
+            if key in stream_codec.DECIMALS:
+                values = np.round(values, stream_codec.DECIMALS[key])
+            values[np.isnan(values)] = np.nan
+            values = values + 0.0  # -0.0 -> 0.0
+        elif values.dtype.kind in 'iub':
+            values = values.astype(np.int64)
+        digest.update(f'{key}:{values.dtype.str}:{len(values)}\n'.encode())
+        digest.update(np.ascontiguousarray(values).tobytes())
+    return digest.hexdigest()
+
+
+def stream_samples(columns: dict) -> int:
+    return max((len(values) for values in columns.values()), default=0)
+
+
+def stored_size(path: str) -> int:
+    # bytes of a stream file, or of the column files of a directory (the derived levels not included)
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)
+                   if os.path.isfile(os.path.join(path, name)))
+    return os.path.getsize(path)
+
+
+def delete_streams(path: str):
+    if path:
+        StreamStore().delete(path)
+
+
+def select_rows(columns: dict, key: str, start=None, end=None) -> slice:
+    # Row range of a window on a monotone stream (time or distance), found by binary search
+    values = columns[key]
+    lo = 0 if start is None else int(values.searchsorted(start, side='left'))
+    hi = len(values) if end is None else int(values.searchsorted(end, side='right'))
+    return slice(lo, max(lo, hi))
+
+
+def window_rows(columns: dict, windows: dict) -> slice:
+    # Intersection of the row ranges of windows {key: (start, end)} on monotone streams
+    lo, hi = 0, None
+    for key, (start, end) in sorted(windows.items()):
+        window = select_rows(columns, key, start, end)
+        lo = max(lo, window.start)
+        hi = window.stop if hi is None else min(hi, window.stop)
+    return slice(lo, max(lo, hi)) if hi is not None else slice(None)
+
+
+# Downsampled levels for plotting: every level keeps at most `points` rows of all columns, chosen with
+# Largest-Triangle-Three-Buckets on the streams whose shape matters most. Levels are built from each other,
+# largest first, when the streams are stored, and only where they are smaller than the stream itself.
+STREAM_LEVELS = (5000, 1000, 200)
+SHAPE_KEYS = ('heartrate', 'velocity_smooth', 'altitude')
+LEVELS_DIR = 'levels'
+
+
+def lttb(x: np.ndarray, y: np.ndarray, points: int) -> np.ndarray:
+    # Indices of the points of (x, y) kept by Largest-Triangle-Three-Buckets: the first and last point, and from
+    # each of points - 2 buckets the one forming the largest triangle with the point kept from the previous
+    # bucket and the average of the next bucket.
+    length = len(y)
+    if points >= length:
+        return np.arange(length)
+    if points < 3:
+        return np.array([0, length - 1])[:max(points, 0)]
+    x = np.asarray(x, dtype=np.float64)
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+    edges = np.linspace(1, length - 1, points - 1).astype(np.int64)
+    counts = np.diff(edges)
+    avg_x = np.add.reduceat(x[:edges[-1]], edges[:-1]) / counts
+    avg_y = np.add.reduceat(y[:edges[-1]], edges[:-1]) / counts
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(points, dtype=np.int64)
+    selected[0], selected[-1] = 0, length - 1
+    a = 0
+    for bucket in range(points - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        ax, ay = x[a], y[a]
+        area = np.abs((ax - next_x[bucket]) * (y[lo:hi] - ay) - (ax - x[lo:hi]) * (next_y[bucket] - ay))
+        a = lo + int(area.argmax())
+        selected[bucket + 1] = a
+    return selected
+
+
+def level_indices(columns: dict, points: int) -> np.ndarray:
+    # rows kept for a level: the union of the LTTB points of the shape streams, at most `points` in total
+    length = len(next(iter(columns.values())))
+    x = columns['time'] if 'time' in columns else np.arange(length)
+    keys = [key for key in SHAPE_KEYS if key in columns] or [key for key in columns if key != 'time'][:1] or ['time']
+    per_key = max(1, points // len(keys))
+    return np.unique(np.concatenate([lttb(x, columns.get(key, x), per_key) for key in keys]))
+
+
+def build_levels(columns: dict) -> dict:
+    # {points: downsampled columns}
+    levels = dict()
+    if not columns:
+        return levels
+    source = {key: np.asarray(values) for key, values in columns.items()}
+    for points in sorted(STREAM_LEVELS, reverse=True):
+        if points >= len(next(iter(source.values()))):
+            continue
+        indices = level_indices(source, points)
+        source = {key: values[indices] for key, values in source.items()}
+        levels[points] = source
+    return levels
+
+
+def downsample(path: str, columns: dict, rows: slice, max_points: int, windows: dict) -> tuple:
+    # Columns and rows to serve for at most max_points rows: the most detailed stored level that holds few enough
+    # rows within the window, and LTTB on the fly when even the smallest level has too many.
+    length = len(next(iter(columns.values())))
+    count = len(range(length)[rows])
+    if count <= max_points:
+        return columns, rows
+    store = store_for_path(path)
+    for points in sorted(store.levels(path), reverse=True):
+        # the rows of a level are spread over the stream roughly evenly
+        if count * points / length <= max_points:
+            columns = store.read_level(path, points, keys=list(columns.keys()))
+            rows = window_rows(columns, windows)
+            break
+    else:
+        levels = store.levels(path)
+        if levels:
+            columns = store.read_level(path, levels[0], keys=list(columns.keys()))
+            rows = window_rows(columns, windows)
+    columns = {key: np.asarray(values[rows]) for key, values in columns.items()}
+    if len(next(iter(columns.values()))) > max_points:
+        indices = level_indices(columns, max_points)
+        columns = {key: values[indices] for key, values in columns.items()}
+    return columns, slice(None)
+
+
+# Incremental serialisation of (memory mapped) columns, CHUNK_ROWS rows at a time,
+# so that a response never holds more than one chunk of text in memory.
+CHUNK_ROWS = 4096
+FLOAT_DECIMALS = 3
+
+
+def _chunk_list(values) -> list:
+    if values.dtype.kind == 'f':
+        if values.dtype.itemsize < 8:
+            # avoid float32 noise like 2.299999952316284 in the text output
+            values = np.round(values.astype(np.float64), FLOAT_DECIMALS)
+        if np.isnan(values).any():
+            return [None if value != value else value for value in values.tolist()]
+    return values.tolist()
+
+
+def _bounds(columns: dict, rows: slice):
+    if not columns:
+        return 0, 0
+    lo, hi, _ = rows.indices(len(next(iter(columns.values()))))
+    return lo, max(lo, hi)
+
+
+def iter_json(columns: dict, rows: slice = slice(None)):
+    # {"time": [...], "heartrate": [...]}
+    yield '{'
+    for i, (key, values) in enumerate(columns.items()):
+        values = values[rows]
+        yield f'{", " if i else ""}{json.dumps(key)}: ['
+        for start in range(0, len(values), CHUNK_ROWS):
+            chunk = json.dumps(_chunk_list(values[start:start + CHUNK_ROWS]))[1:-1]
+            yield f'{", " if start else ""}{chunk}'
+        yield ']'
+    yield '}'
+
+
+def iter_ndjson(columns: dict, rows: slice = slice(None)):
+    # one json object per sample
+    keys = list(columns.keys())
+    lo, hi = _bounds(columns, rows)
+    for start in range(lo, hi, CHUNK_ROWS):
+        stop = min(start + CHUNK_ROWS, hi)
+        chunk = [_chunk_list(columns[key][start:stop]) for key in keys]
+        yield ''.join(json.dumps(dict(zip(keys, row))) + '\n' for row in zip(*chunk))
+
+
+def iter_binary(columns: dict, rows: slice = slice(None)):
+    # A json header line {"length": n, "columns": [{"name": ..., "dtype": ...}, ...]} followed by the raw
+    # little endian data of every column in header order. Decode with numpy.frombuffer.
+    lo, hi = _bounds(columns, rows)
+    dtypes = {key: np.asarray(values[:0]).dtype.newbyteorder('<') for key, values in columns.items()}
+    header = {'length': hi - lo,
+              'columns': [{'name': key, 'dtype': dtype.str} for key, dtype in dtypes.items()]}
+    yield (json.dumps(header) + '\n').encode()
+    for key, values in columns.items():
+        values = values[rows]
+        for start in range(0, len(values), CHUNK_ROWS):
+            yield np.ascontiguousarray(values[start:start + CHUNK_ROWS], dtype=dtypes[key]).tobytes()
@@ -0,0 +1,113 @@
+from datetime import timezone
+
+from constants import STUDY_END
+from db import db
+from logger import logger
+from models.activity import ActivityModel, parse_strava_date
+from models.job import JobModel
+from models.subject import SubjectModel
+
+SYNC_ACTIVITIES = 'sync_activities'
+
+
+class PermanentJobError(Exception):
+    """Raised by a task when retrying the job cannot succeed."""
+
+
+def sync_activities(job: JobModel):
+    # Sync of a subject's activity list, formerly done inline in SubjectActivities.put.
+    # Without an explicit window only activities after the subject's sync cursor are requested.
+    payload = job.get_payload()
+    subject = SubjectModel.find_by_subject_id(job.subject_id)
+    if not subject:
+        raise PermanentJobError(f'Subject {job.subject_id} not found.')
+    explicit_window = payload.get('after') is not None or payload.get('before') is not None
+    # merged jobs (see merge_sync_payloads) cover the default window even with an explicit start
+    advance_cursor = payload.get('advance_cursor', not explicit_window)
+    after = payload.get('after')
+    if after is None:
+        after = subject.sync_window_start(full_resync=payload.get('full_resync', False))
+
+    def listing_progress(page, found):
+        job.update_progress(0, message=f'Listing activities: page {page}, {found} found')
+
+    activities = subject.get_activities(before=payload.get('before'),
+                                        after=after,
+                                        progress=listing_progress)
+    if activities is None:
+        raise RuntimeError(f'Activities request for subject {subject.subject_id} failed.')
+    logger.info(f'Found {len(activities)} activities')
+
+    total = len(activities)
+    job.update_progress(0, total=total, message='Adding activities', force=True)
+    # the progress updates are the job's heartbeat, so the stream downloads report progress as well (a job without
+    # updates for JOB_STALE_AFTER seconds is requeued)
+    counts = ActivityModel.get_all(activities=activities,
+                                   subject=subject,
+                                   progress=lambda done: job.update_progress(done),
+                                   stream_progress=lambda done, streams: job.update_progress(
+                                       done, total=streams, message='Downloading streams'))
+    if advance_cursor:
+        # an explicit window may leave gaps before it, so only default syncs move the cursor
+        latest_start = None
+        if total:
+            latest_start = int(max(parse_strava_date(record.start_date) for record in activities)
+                               .replace(tzinfo=timezone.utc).timestamp())
+        subject.advance_sync_cursor(latest_start)
+    job.update_progress(total, total=total, message='Done', force=True)
+    return dict(activities_found=total, after=after, **counts)
+
+
+def sync_window(subject: SubjectModel, payload: dict) -> tuple:
+    # (after, before, advances the cursor) of a sync job, as sync_activities requests it
+    after, before = payload.get('after'), payload.get('before')
+    advance_cursor = payload.get('advance_cursor', after is None and before is None)
+    if after is None:
+        after = subject.sync_window_start(full_resync=payload.get('full_resync', False))
+    return after, before or STUDY_END, advance_cursor
+
+
+def merge_sync_payloads(subject: SubjectModel, payload: dict, requested: dict) -> dict:
+    # payload of one sync covering both: the window from the earlier start to the later end, moving the
+    # cursor if either does (that window then reaches from before the cursor to the study end)
+    first, second = sync_window(subject, payload), sync_window(subject, requested)
+    after, before, advance_cursor = min(first[0], second[0]), max(first[1], second[1]), first[2] or second[2]
+    if advance_cursor and after == subject.sync_window_start(full_resync=True):
+        return {'after': None, 'before': None, 'full_resync': True}
+    if advance_cursor and after == subject.sync_window_start():
+        return {'after': None, 'before': None, 'full_resync': False}
+    merged = {'after': after, 'before': None if before == STUDY_END else before, 'full_resync': False}
+    if advance_cursor:
+        merged['advance_cursor'] = True
+    return merged
+
+
+def enqueue_sync(subject: SubjectModel, after: int = None, before: int = None, full_resync: bool = False) -> JobModel:
+    # the sync job of the subject: a new one, or the queued or running one extended to the requested window
+    return JobModel.enqueue_or_merge(SYNC_ACTIVITIES, subject.subject_id,
+                                     {'after': after, 'before': before, 'full_resync': full_resync},
+                                     lambda payload, requested: merge_sync_payloads(subject, payload, requested))
+
+
+TASKS = {
+    SYNC_ACTIVITIES: sync_activities,
+}
+
+
+def run_job(job: JobModel):
+    task = TASKS.get(job.job_type)
+    if task is None:
+        job.mark_failed(f'Unknown job type {job.job_type}', retry=False)
+        return
+    logger.info(f'Job {job.id} ({job.job_type}) started, attempt {job.attempts}/{job.max_attempts}')
+    try:
+        result = task(job)
+    except PermanentJobError as err:
+        job.mark_failed(err, retry=False)
+    except Exception as err:
+        logger.exception(err)
+        # the session may be unusable after a failed flush/commit
+        db.session.rollback()
+        job.mark_failed(err)
+    else:
+        job.mark_succeeded(result)
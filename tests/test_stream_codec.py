@@ -0,0 +1,397 @@
+import io
+import json
+
+import numpy as np
+import pytest
+
+import stream_codec
+from stream_codec import BLOCK_SAMPLES, CodecError, MAGIC, decode, decode_column, encode, encode_column, mismatches, \
+    open_section, read_header, read_section
+
+# Round trips of stream_codec (the packed stream store's file format), run with `python -m pytest tests`
+
+
+def round_trip(columns: dict, levels: dict = None) -> tuple:
+    # (header, decoded columns, decoded levels) of the encoded file contents
+    f = io.BytesIO(encode(columns, levels))
+    header, data_offset = read_header(f)
+    decoded = read_section(f, header, data_offset)
+    decoded_levels = {int(points): read_section(f, section, data_offset)
+                      for points, section in header['levels'].items()}
+    return header, decoded, decoded_levels
+
+
+def codec_of(header: dict, key: str) -> str:
+    return entry_of(header, key)['codec']
+
+
+def entry_of(header: dict, key: str) -> dict:
+    # the entry of a column, with the codec fields of its first block for a column in blocks
+    entry = next(entry for entry in header['columns'] if entry['name'] == key)
+    return dict(entry, **entry['blocks'][0]) if 'blocks' in entry else entry
+
+
+# codecs
+
+def test_delta_varint_time():
+    time = np.concatenate((np.arange(5000), np.arange(5010, 9000, 3), [10 ** 9])).astype(np.int32)
+    header, decoded, _ = round_trip({'time': time})
+    assert codec_of(header, 'time') == 'delta_varint'
+    assert decoded['time'].dtype == np.int32
+    np.testing.assert_array_equal(decoded['time'], time)
+
+
+def test_delta_varint_decreasing_values():
+    # zigzag keeps negative differences small
+    time = np.array([100, 90, 95, 0, 2 ** 31 - 1, -2 ** 31], dtype=np.int64)
+    header, decoded, _ = round_trip({'time': time})
+    assert codec_of(header, 'time') == 'delta_varint'
+    np.testing.assert_array_equal(decoded['time'], time)
+
+
+def test_fixed_delta_decimals():
+    rng = np.random.default_rng(0)
+    distance = np.round(np.cumsum(rng.random(1000) * 3), 2)
+    altitude = np.round(50 + rng.normal(0, 5, 1000), 2).astype(np.float32)
+    header, decoded, _ = round_trip({'distance': distance, 'altitude': altitude})
+    assert codec_of(header, 'distance') == codec_of(header, 'altitude') == 'fixed_delta'
+    assert entry_of(header, 'distance')['decimals'] == 2
+    np.testing.assert_array_equal(decoded['distance'], distance)
+    assert decoded['altitude'].dtype == np.float32
+    np.testing.assert_array_equal(decoded['altitude'], altitude)
+
+
+def test_fixed_delta_latlng_seven_decimals():
+    rng = np.random.default_rng(1)
+    lat = 53.5 + np.cumsum(rng.normal(0, 1e-5, 2000))
+    lng = -10.0 + np.cumsum(rng.normal(0, 1e-5, 2000))
+    header, decoded, _ = round_trip({'lat': lat, 'lng': lng})
+    for key, values in (('lat', lat), ('lng', lng)):
+        assert codec_of(header, key) == 'fixed_delta'
+        assert entry_of(header, key)['decimals'] == 7
+        assert np.abs(decoded[key] - values).max() <= 0.5e-7 + 1e-12
+        np.testing.assert_array_equal(decoded[key], np.round(values, 7))
+    assert mismatches({'lat': lat, 'lng': lng}, decoded) == []
+
+
+def test_fixed_delta_values_beyond_precision_are_rounded():
+    velocity = np.array([1.23456789, 2.0, 3.0005], dtype=np.float64)
+    _, decoded, _ = round_trip({'velocity_smooth': velocity})
+    np.testing.assert_array_equal(decoded['velocity_smooth'], np.round(velocity, 3))
+
+
+def test_small_int_heartrate_one_byte():
+    heartrate = np.array([60, 61, 180, 255, 200], dtype=np.int16)
+    header, decoded, _ = round_trip({'heartrate': heartrate})
+    entry = entry_of(header, 'heartrate')
+    assert (entry['codec'], entry['base'], entry['width']) == ('small_int', 60, 1)
+    assert decoded['heartrate'].dtype == np.int16
+    np.testing.assert_array_equal(decoded['heartrate'], heartrate)
+
+
+def test_small_int_negative_temp():
+    temp = np.array([-12, -5, 0, 3, -12], dtype=np.int8)
+    header, decoded, _ = round_trip({'temp': temp})
+    entry = entry_of(header, 'temp')
+    assert (entry['codec'], entry['base'], entry['width']) == ('small_int', -12, 1)
+    assert decoded['temp'].dtype == np.int8
+    np.testing.assert_array_equal(decoded['temp'], temp)
+
+
+@pytest.mark.parametrize('span, width', [(255, 1), (256, 2), (65535, 2), (65536, 4), (2 ** 31, 4)])
+def test_small_int_widths(span, width):
+    cadence = np.array([-5, -5 + span, 0], dtype=np.int64)
+    header, decoded, _ = round_trip({'cadence': cadence})
+    assert entry_of(header, 'cadence')['width'] == width
+    np.testing.assert_array_equal(decoded['cadence'], cadence)
+
+
+def test_bits_moving():
+    moving = np.random.default_rng(2).random(1001) > 0.3
+    header, decoded, _ = round_trip({'moving': moving})
+    assert codec_of(header, 'moving') == 'bits'
+    assert decoded['moving'].dtype == bool
+    np.testing.assert_array_equal(decoded['moving'], moving)
+
+
+@pytest.mark.parametrize('key, values', [
+    ('watts_calc', np.array([1.5, 2.25, 3.0])),                      # no codec for the stream type
+    ('time', np.array([0.0, 1.5, 3.0])),                             # decimals in an integer stream
+    ('moving', np.array([0, 1, 2], dtype=np.int8)),                  # not boolean
+    ('distance', np.array([0.0, np.inf, 2.0])),                      # not finite
+    ('heartrate', np.array(['a', 'b'])),                             # not numeric
+])
+def test_raw_fallback(key, values):
+    header, decoded, _ = round_trip({key: values})
+    assert codec_of(header, key) == 'raw'
+    np.testing.assert_array_equal(decoded[key], values)
+
+
+def test_zlib_only_when_smaller():
+    constant_time, _ = encode_column('time', np.arange(10000))
+    random_heartrate, _ = encode_column('heartrate', np.random.default_rng(3).integers(0, 256, 100))
+    assert constant_time.get('zlib')
+    assert not random_heartrate.get('zlib')
+
+
+# NaN masks, empty and single sample columns
+
+@pytest.mark.parametrize('key', ['distance', 'lat', 'heartrate', 'watts_calc'])
+def test_nan_mask(key):
+    values = np.array([np.nan, 1.0, 2.0, np.nan, np.nan, 5.0, 6.0, 7.0, 8.0, np.nan], dtype=np.float32)
+    header, decoded, _ = round_trip({key: values})
+    entry = entry_of(header, key)
+    assert entry['mask_size'] == 2
+    assert decoded[key].dtype == np.float32
+    np.testing.assert_array_equal(decoded[key], values)
+
+
+def test_all_nan():
+    values = np.full(9, np.nan)
+    _, decoded, _ = round_trip({'altitude': values})
+    assert np.isnan(decoded['altitude']).all() and len(decoded['altitude']) == 9
+
+
+@pytest.mark.parametrize('length', [0, 1])
+def test_empty_and_single_sample_columns(length):
+    columns = {
+        'time': np.arange(length, dtype=np.int32) + 7,
+        'distance': np.full(length, 12.34),
+        'lat': np.full(length, 53.1234567),
+        'heartrate': np.full(length, 140, dtype=np.int16),
+        'temp': np.full(length, -3, dtype=np.int8),
+        'moving': np.full(length, True),
+        'watts_calc': np.full(length, 1.5),
+    }
+    header, decoded, _ = round_trip(columns)
+    assert header['length'] == length
+    for key, values in columns.items():
+        assert decoded[key].dtype == values.dtype
+        np.testing.assert_array_equal(decoded[key], values)
+
+
+def test_no_columns():
+    header, decoded, levels = round_trip({})
+    assert header['length'] == 0 and decoded == {} and levels == {}
+
+
+# levels
+
+def test_levels_sections():
+    time = np.arange(3000, dtype=np.int32)
+    heartrate = (120 + 30 * np.sin(time / 100)).astype(np.int16)
+    levels = {1000: {'time': time[::3], 'heartrate': heartrate[::3]},
+              200: {'time': time[::15], 'heartrate': heartrate[::15]}}
+    header, decoded, decoded_levels = round_trip({'time': time, 'heartrate': heartrate}, levels)
+    assert sorted(header['levels']) == ['1000', '200']
+    assert header['levels']['200']['length'] == 200
+    np.testing.assert_array_equal(decoded['time'], time)
+    for points, level in levels.items():
+        for key, values in level.items():
+            np.testing.assert_array_equal(decoded_levels[points][key], values)
+
+
+def test_decode_selected_keys(tmp_path):
+    path = tmp_path / 'a.strm'
+    path.write_bytes(encode({'time': np.arange(10), 'heartrate': np.arange(10) + 100}))
+    assert list(decode(str(path), keys={'heartrate'})) == ['heartrate']
+    assert sorted(decode(str(path))) == ['heartrate', 'time']
+
+
+# columns in blocks
+
+def long_columns(length: int) -> dict:
+    rng = np.random.default_rng(5)
+    distance = np.round(np.cumsum(rng.random(length) * 3), 2)
+    distance[length // 3:length // 3 + 50] = np.nan
+    return {
+        'time': np.cumsum(rng.integers(1, 4, length)).astype(np.int32),
+        'distance': distance,
+        'heartrate': rng.integers(100, 180, length).astype(np.int16),
+        'moving': rng.random(length) > 0.2,
+        'watts_calc': rng.random(length),
+    }
+
+
+def open_bytes(data: bytes) -> dict:
+    f = io.BytesIO(data)
+    header, data_offset = read_header(f)
+    return open_section(data, header, data_offset)
+
+
+@pytest.mark.parametrize('length', [BLOCK_SAMPLES - 1, BLOCK_SAMPLES, BLOCK_SAMPLES + 1, 3 * BLOCK_SAMPLES + 5])
+def test_blocks_round_trip(length):
+    columns = long_columns(length)
+    header, decoded, _ = round_trip(columns)
+    for key, values in columns.items():
+        entry = entry_of(header, key)
+        assert len(entry.get('blocks', [entry])) == -(-length // BLOCK_SAMPLES)
+        assert decoded[key].dtype == values.dtype
+        np.testing.assert_array_equal(decoded[key], values)
+
+
+def test_block_column_slices_decode_only_their_blocks():
+    columns = long_columns(5 * BLOCK_SAMPLES + 17)
+    opened = open_bytes(encode(columns))
+    for key, values in columns.items():
+        column = opened[key]
+        assert len(column) == len(values) and column.dtype == values.dtype
+        for rows in [slice(10, 20), slice(BLOCK_SAMPLES - 5, BLOCK_SAMPLES + 5), slice(-30, None), slice(0, 0),
+                     slice(3 * BLOCK_SAMPLES, None, 7), slice(None, None, -1), slice(50, 10)]:
+            np.testing.assert_array_equal(column[rows], values[rows])
+        assert column[-1] == values[-1] or np.isnan(values[-1])
+    window = open_bytes(encode(columns))['heartrate']
+    window_values = window[2 * BLOCK_SAMPLES + 1:2 * BLOCK_SAMPLES + 100]
+    assert len(window_values) == 99 and sorted(window._decoded) == [2]
+    np.testing.assert_array_equal(np.asarray(opened['time'], dtype=np.float64), columns['time'])
+
+
+@pytest.mark.parametrize('side', ['left', 'right'])
+def test_block_column_searchsorted(side):
+    time = np.repeat(np.arange(0, 4 * BLOCK_SAMPLES, 2), 2).astype(np.int32)
+    data = encode({'time': time})
+    for value in [-1, 0, 1, 2, BLOCK_SAMPLES - 1, BLOCK_SAMPLES, 2 * BLOCK_SAMPLES + 3, time[-1], time[-1] + 1]:
+        column = open_bytes(data)['time']
+        assert column.searchsorted(value, side=side) == np.searchsorted(time, value, side=side)
+        # the binary search over the 4 blocks and the one holding the position
+        assert len(column._decoded) <= 3
+
+
+def test_block_column_searchsorted_trailing_nan():
+    distance = np.arange(3 * BLOCK_SAMPLES, dtype=np.float64)
+    distance[-BLOCK_SAMPLES - 10:] = np.nan
+    column = open_bytes(encode({'distance': distance}))['distance']
+    for value in [0, 100.5, 2 * BLOCK_SAMPLES - 11, 2 * BLOCK_SAMPLES, 10 ** 6]:
+        for side in ('left', 'right'):
+            assert column.searchsorted(value, side=side) == np.searchsorted(distance, value, side=side)
+
+
+def test_strm1_files_are_read():
+    # files written before blocks: old magic, every column one entry
+    columns = long_columns(100)
+    data = b'STRM1\n' + encode(columns)[len(MAGIC):]
+    decoded = decode_bytes(data)
+    for key, values in columns.items():
+        np.testing.assert_array_equal(decoded[key], values)
+        np.testing.assert_array_equal(open_bytes(data)[key][5:50], values[5:50])
+
+
+def test_block_column_truncated_data():
+    data = encode(long_columns(2 * BLOCK_SAMPLES))
+    with pytest.raises(CodecError, match='truncated'):
+        open_bytes(data[:-1])
+
+
+def test_wrong_block_count():
+    data = encode(long_columns(2 * BLOCK_SAMPLES + 1))
+    with pytest.raises(CodecError, match='blocks'):
+        decode_bytes(corrupt_entry(data, 'time', length=4 * BLOCK_SAMPLES))
+
+
+# invalid files
+
+@pytest.fixture
+def encoded() -> bytes:
+    rng = np.random.default_rng(4)
+    return encode({
+        'time': np.arange(500),
+        'distance': np.round(np.cumsum(rng.random(500)), 2),
+        'heartrate': rng.integers(100, 180, 500).astype(np.int16),
+        'moving': rng.random(500) > 0.5,
+        'watts_calc': rng.random(500),
+    })
+
+
+def decode_bytes(data: bytes) -> dict:
+    f = io.BytesIO(data)
+    header, data_offset = read_header(f)
+    return read_section(f, header, data_offset)
+
+
+def corrupt_entry(data: bytes, key: str, **changes) -> bytes:
+    # the file with header fields of a column changed
+    header_end = data.index(b'\n', len(MAGIC)) + 1
+    header = json.loads(data[len(MAGIC):header_end])
+    for entry in header['columns']:
+        if entry['name'] == key:
+            entry.update(changes)
+    return MAGIC + json.dumps(header).encode() + b'\n' + data[header_end:]
+
+
+def test_bad_magic(encoded):
+    with pytest.raises(CodecError):
+        decode_bytes(b'STRM9\n' + encoded[len(MAGIC):])
+    with pytest.raises(CodecError):
+        decode_bytes(b'time,distance\n0,0.0\n')
+
+
+def test_invalid_header(encoded):
+    with pytest.raises(CodecError):
+        decode_bytes(encoded[:len(MAGIC) + 20])
+    with pytest.raises(CodecError):
+        decode_bytes(MAGIC + b'{"length": 3, "columns"\n')
+
+
+@pytest.mark.parametrize('cut', [1, 100, 1000])
+def test_truncated_data(encoded, cut):
+    with pytest.raises(CodecError):
+        decode_bytes(encoded[:-cut])
+
+
+def test_bad_varint_count(encoded):
+    with pytest.raises(CodecError, match='varints'):
+        decode_bytes(corrupt_entry(encoded, 'time', length=501))
+    with pytest.raises(CodecError, match='varints'):
+        decode_bytes(corrupt_entry(encoded, 'distance', length=499))
+
+
+def test_unterminated_varint():
+    entry, data = encode_column('time', np.array([1, 2, 3]))
+    assert not entry.get('zlib')
+    with pytest.raises(CodecError):
+        decode_column(entry, data[:-1] + bytes([data[-1] | 0x80]))
+
+
+@pytest.mark.parametrize('key', ['heartrate', 'moving', 'watts_calc'])
+def test_wrong_data_size(encoded, key):
+    entry = json.loads(encoded[len(MAGIC):encoded.index(b'\n', len(MAGIC))])
+    size = entry_of(entry, key)['size']
+    with pytest.raises(CodecError):
+        decode_bytes(corrupt_entry(encoded, key, size=size - 1))
+
+
+@pytest.mark.parametrize('key, values', [
+    ('watts_calc', np.array([0.123, 4.56, 7.89])),
+    ('heartrate', np.array([0, 300, 65000])),
+])
+def test_partial_values(key, values):
+    entry, data = encode_column(key, values)
+    assert not entry.get('zlib')
+    with pytest.raises(CodecError, match='whole number'):
+        decode_column(entry, data[:-1])
+
+
+def test_corrupt_zlib_data():
+    entry, data = encode_column('time', np.arange(10000))
+    assert entry['zlib']
+    corrupt = data[:10] + bytes(b ^ 0xff for b in data[10:20]) + data[20:]
+    with pytest.raises(CodecError):
+        decode_column(entry, corrupt)
+
+
+def test_wrong_nan_mask_size():
+    values = np.array([np.nan, 1.0, 2.0] * 10)
+    entry, data = encode_column('altitude', values)
+    with pytest.raises(CodecError):
+        decode_column(dict(entry, mask_size=entry['mask_size'] - 1), data[1:])
+
+
+def test_unknown_codec():
+    entry, data = encode_column('time', np.arange(3))
+    with pytest.raises(CodecError, match='Unknown codec'):
+        decode_column(dict(entry, codec='lz4'), data)
+
+
+def test_codec_error_is_a_value_error():
+    # callers (stream_store, the commands) catch ValueError for unreadable stream files
+    assert issubclass(stream_codec.CodecError, ValueError)
@@ -0,0 +1,80 @@
+import threading
+import time
+from collections import defaultdict
+
+from constants import STRAVA_TOKEN_REFRESH_TIMEOUT, TOKEN_REFRESH_MARGIN
+from db import db
+from logger import logger
+
+# Per-process cache of valid access tokens: subject_id -> (access_token, expires_at)
+_tokens = dict()
+# one lock per subject, so that threads of a process refresh a subject's tokens one at a time
+_locks = defaultdict(threading.Lock)
+_locks_lock = threading.Lock()
+
+
+def _valid(expires_at) -> bool:
+    # tokens are refreshed proactively, TOKEN_REFRESH_MARGIN seconds before they expire
+    return expires_at is not None and expires_at - TOKEN_REFRESH_MARGIN > time.time()
+
+
+def _lock_for(subject_id: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks[subject_id]
+
+
+def get_access_token(subject) -> str:
+    # Valid Strava access token of a SubjectModel, refreshed only when needed
+    return cached_access_token(subject) or refresh_access_token(subject)
+
+
+def cached_access_token(subject):
+    # the access token of a SubjectModel if it is still valid, otherwise None (without refreshing it)
+    cached = _tokens.get(subject.subject_id)
+    if cached and _valid(cached[1]):
+        return cached[0]
+    if _valid(subject.expires_at):
+        _tokens[subject.subject_id] = (subject.access_token, subject.expires_at)
+        return subject.access_token
+    return None
+
+
+def refresh_access_token(subject, force: bool = False, rejected_token: str = None) -> str:
+    # Single-flight token refresh. Strava rotates the refresh token on every refresh, so two concurrent
+    # refreshes would leave one of them with an invalidated refresh token in the db.
+    # Threads of one process are serialised by a lock per subject, processes by locking the subject row:
+    # SELECT ... FOR UPDATE on PostgreSQL. SQLite ignores FOR UPDATE and a plain SELECT takes no write lock, so
+    # there the row is "updated" first, which takes the database's write lock before the token is read.
+    # Whoever gets the lock second finds the fresh token in the row and does not refresh again.
+    # The lock is held during the Strava call, so it is tried once with short timeouts
+    # (STRAVA_TOKEN_REFRESH_TIMEOUT); a failed refresh raises and the next request tries again.
+    # rejected_token: a token Strava answered 401 to, refreshed even if it has not expired yet, unless the row
+    # already holds another one.
+    model = type(subject)
+    with _lock_for(subject.subject_id):
+        if db.engine.dialect.name == 'sqlite':
+            model.query.filter_by(id=subject.id).update({'id': model.id}, synchronize_session=False)
+        locked = model.query.filter_by(id=subject.id) \
+            .with_for_update() \
+            .populate_existing() \
+            .one()
+        if not force and _valid(locked.expires_at) and locked.access_token != rejected_token:
+            db.session.commit()
+            _tokens[locked.subject_id] = (locked.access_token, locked.expires_at)
+            return locked.access_token
+        try:
+            access_token, refresh_token, expires_at = locked.get_new_tokens(retries=0, timeout=STRAVA_TOKEN_REFRESH_TIMEOUT)
+        except Exception:
+            db.session.rollback()
+            raise
+        locked.access_token = access_token
+        locked.refresh_token = refresh_token
+        locked.expires_at = expires_at
+        db.session.commit()
+        _tokens[locked.subject_id] = (access_token, expires_at)
+        logger.info(f'Tokens of subject {locked.subject_id} refreshed')
+        return access_token
+
+
+def forget(subject_id: str):
+    _tokens.pop(subject_id, None)
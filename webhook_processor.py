@@ -0,0 +1,60 @@
+from collections import OrderedDict
+
+from db import db
+from logger import logger
+from models.activity import ActivityModel
+from models.webhook_event import WebhookEventModel
+
+# maximum number of events read per run
+WEBHOOK_BATCH_SIZE = 500
+
+
+def coalesce(events: list) -> dict:
+    # Reduce the pending events of one object (ordered by event_time) to the single event that has to be applied:
+    # - a delete wins, the activity is gone whatever happened before (no Strava request needed)
+    # - otherwise a create, which fetches the current state and so also covers later updates
+    # - otherwise one update for any number of update events
+    aspects = [event.aspect_type for event in events]
+    if aspects[-1] == 'delete':
+        effective = events[-1]
+    elif 'create' in aspects:
+        effective = events[aspects.index('create')]
+    else:
+        effective = events[-1]
+    return effective.json()
+
+
+def process_webhook_events(worker_id: str, limit: int = WEBHOOK_BATCH_SIZE) -> int:
+    # Apply the pending webhook events, called from the worker loop (worker.py). Returns the number of events handled.
+    WebhookEventModel.requeue_stale()
+    events = WebhookEventModel.find_pending(limit)
+    if not events:
+        return 0
+
+    by_object = OrderedDict()
+    for event in events:
+        by_object.setdefault((event.object_type, event.object_id), []).append(event)
+
+    handled = 0
+    for (object_type, object_id), object_events in by_object.items():
+        ids = [event.id for event in object_events]
+        effective = coalesce(object_events)
+        if not WebhookEventModel.claim(ids, worker_id):
+            # another worker is handling (some of) these events
+            continue
+        if len(object_events) > 1:
+            logger.info(f'Coalesced {len(object_events)} events of {object_type} {object_id} '
+                        f'into {effective["aspect_type"]}')
+        try:
+            ActivityModel.from_webhook_event(effective)
+        except Exception as err:
+            # retried later: a sync would pick up a missed create, but never an update or delete
+            logger.exception(err)
+            db.session.rollback()
+            WebhookEventModel.mark_failed(ids, err)
+        else:
+            WebhookEventModel.mark_processed(ids)
+        handled += len(ids)
+
+    WebhookEventModel.purge_processed()
+    return handled
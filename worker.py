@@ -0,0 +1,49 @@
+import os
+import socket
+import time
+
+from app import backend
+from constants import JOB_POLL_INTERVAL, BLOCKLIST_SWEEP_INTERVAL
+from db import db
+from logger import logger
+from models.job import JobModel
+from models.revoked_token import RevokedTokenModel
+from tasks import run_job
+from webhook_processor import process_webhook_events
+
+db.init_app(backend)
+
+WORKER_ID = f'{socket.gethostname()}:{os.getpid()}'
+
+
+def work(poll_interval: float = JOB_POLL_INTERVAL, burst: bool = False):
+    # Process pending webhook events and queued jobs one at a time.
+    # With burst=True the worker exits once there is nothing left to do.
+    with backend.app_context():
+        db.create_all()
+    logger.info(f'Worker {WORKER_ID} started')
+    next_purge = 0.0
+    while True:
+        # a fresh app context per job also gives every job a fresh db session
+        with backend.app_context():
+            if time.time() >= next_purge:
+                # revoked JWTs that have expired (the blocklist check of the app only reads)
+                RevokedTokenModel.purge_expired()
+                next_purge = time.time() + BLOCKLIST_SWEEP_INTERVAL
+            if process_webhook_events(WORKER_ID):
+                continue
+            job = JobModel.claim_next(WORKER_ID)
+            if job is not None:
+                run_job(job)
+                continue
+        if burst:
+            logger.info(f'Worker {WORKER_ID} finished, queue is empty')
+            return
+        time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    try:
+        work()
+    except KeyboardInterrupt:
+        logger.info(f'Worker {WORKER_ID} stopped')